@@ -20,6 +20,8 @@ from common.ripe.utils import (
     get_timestamp_from_date,
     get_date_from_str,
 )
+from common.ripe.bulk_fetcher import fetch_measurement_results
+from common.ripe.ip_encoding import get_ip_encoder
 from common.ripe.ripe_atlas_api import (
     get_atlas_anchors,
     get_atlas_probes,
@@ -181,33 +183,52 @@ def exo5(targets: list, start_time: str, stop_time: str, measurement_type: str)
 
 def exo6(vps: list) -> dict:
     """get all results for each measurement"""
+    # pairs of (target, vp) addresses are keyed by their encoded value
+    encoder = get_ip_encoder()
     event_related_measurements = defaultdict(list)
-    vps_src_list = [vp["address_v4"] for vp in vps]
+    # anchors description give their probe id in "probe", probes in "id"
+    vps_probe_ids = {vp["probe"] if "probe" in vp else vp["id"] for vp in vps}
 
     target_measurements: dict = load_pickle(TP1_RESULTS_PATH / "results_exo5.pickle")
 
     for target_ip, measurements in tqdm(target_measurements.items()):
-        for measurement in measurements:
-            for result in measurement["results"]:
-                result_url = result["result"]
-
-                measurement_results = requests.get(result_url).json()
-
-                for measurement_result in measurement_results:
-                    src_addr = measurement_result["src_addr"]
-
-                    if src_addr in vps_src_list:
-                        # save measurement and measurement results
-                        event_related_measurements[(target_ip, src_addr)].append(
-                            measurement_result  # we keep the whole measurement so we have its end time and creation time
-                        )
-
-                        # save partial results as connection might brake
-                        dump_pickle(
-                            event_related_measurements,
-                            TP1_RESULTS_PATH / "results_exo5.pickle",
-                        )
-    return event_related_measurements
+        target_key = encoder.encode(target_ip)
+        measurement_ids = [
+            result["id"]
+            for measurement in measurements
+            for result in measurement["results"]
+        ]
+
+        # only results from our vps are downloaded
+        results_per_measurement = fetch_measurement_results(
+            measurement_ids, probe_ids=vps_probe_ids
+        )
+
+        for measurement_results in results_per_measurement.values():
+            for measurement_result in measurement_results:
+                src_key = encoder.encode(measurement_result["src_addr"])
+
+                # save measurement and measurement results
+                event_related_measurements[(target_key, src_key)].append(
+                    measurement_result  # we keep the whole measurement so we have its end time and creation time
+                )
+
+        # save partial results as connection might brake
+        dump_pickle(
+            decode_pairs(event_related_measurements),
+            TP1_RESULTS_PATH / "results_exo5.pickle",
+        )
+    return decode_pairs(event_related_measurements)
+
+
+def decode_pairs(measurements_per_pair: dict) -> dict:
+    """(target, vp) keys back to ip addresses, as saved in pickles"""
+    decode = get_ip_encoder().decode
+
+    return {
+        (decode(target_key), decode(src_key)): measurements
+        for (target_key, src_key), measurements in measurements_per_pair.items()
+    }
 
 
 def exo7(event_date: str) -> None:
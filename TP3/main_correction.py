@@ -1,13 +1,24 @@
 """main correction TP3"""
-import requests
-import time
 import sys
 
 from collections import defaultdict
 from pathlib import Path
 
-from common.ripe.utils import get_coordinates_from_id
-from common.geoloc import distance, rtt_to_km
+import numpy as np
+
+from common.ripe.utils import get_cached_probes, get_coordinates_from_id
+from common.ripe.ip_encoding import get_ip_encoder
+from common.ledger import get_ledger, STATUS_FINISHED
+from common.ripe.reuse import get_reuse_index
+from common.ripe.fanout import submit_measurement
+from common.ripe.bulk_fetcher import fetch_measurement_results
+from common.ripe.rtt_aggregator import RttAggregator
+from common.ripe.ripe_atlas_api import RIPEAtlas
+from common.ripe.tracker import (
+    MeasurementTracker,
+    get_measurement_description as fetch_measurement_description,
+)
+from common.geoloc import distance_matrix, rtt_to_km
 from common.credentials import get_ripe_atlas_credentials
 from common.file_utils import dump_json, load_json, insert_json
 from common.default import TP3_DATASET_PATH, TP3_RESULTS_PATH
@@ -23,9 +34,8 @@ def get_measurement_description(measurement_id: int) -> dict:
     logger.info("###############################################")
     logger.info(f"# Get measuremet description {measurement_id} #")
     logger.info("###############################################")
-    base_url = "https://atlas.ripe.net/api/v2/measurements/"
-
-    measurement_description: dict = requests.get(f"{base_url}/{measurement_id}/").json()
+    # descriptions of finished measurements are served from the local cache
+    measurement_description: dict = fetch_measurement_description(measurement_id)
 
     if not measurement_description:
         logger.error("Measurement description is empty")
@@ -53,7 +63,7 @@ def get_servers_from_country(country_code: str, out_file: Path) -> None:
         sys.exit(1)
     else:
         # 2. perform request to get all RIPE Atlas servers in Ukraine
-        response = requests.get(url=base_url, params=params).json()
+        response = get_cached_probes(base_url, params=params)
 
         # 3. filter servers so they all :
         #   - have connected status (check the response)
@@ -79,7 +89,7 @@ def get_servers_from_country(country_code: str, out_file: Path) -> None:
 def ping(
     target: dict,
     vps: list,
-    output_file_path: Path,
+    output_file_path: Path = None,
 ) -> int:
     """perform a traceroute from one vp in UA towards one server in RU"""
     logger.info("###############################################")
@@ -93,92 +103,103 @@ def ping(
             "set .env file at the root dir of the project with correct credentials"
         )
 
-    response = requests.post(
-        f"https://atlas.ripe.net/api/v2/measurements/?key={ripe_credentials['secret_key']}",
-        json={
-            "definitions": [
-                {
-                    "target": target,
-                    "af": 4,
-                    "packets": 3,
-                    "size": 48,
-                    "tags": ["netmetAnycastDetection"],
-                    "description": f"Netmet anycast detection for target {target}",
-                    "resolve_on_probe": False,
-                    "skip_dns_check": True,
-                    "include_probe_id": False,
-                    "type": "ping",
-                }
-            ],
-            "probes": [{"value": vp, "type": "probes", "requested": 1} for vp in vps],
-            "is_oneoff": True,
-            "bill_to": ripe_credentials["username"],
-        },
-    ).json()
+    definition = {
+        "target": target,
+        "af": 4,
+        "packets": 3,
+        "size": 48,
+        "tags": ["netmetAnycastDetection"],
+        "description": f"Netmet anycast detection for target {target}",
+        "resolve_on_probe": False,
+        "skip_dns_check": True,
+        "include_probe_id": False,
+        "type": "ping",
+    }
+
+    # an identical recent measurement is reused instead of submitting a new one,
+    # its id is written to the output file all the same
+    measurement_id = get_reuse_index().lookup(definition, vps)
+    if measurement_id is None:
+        # large vp sets are split in chunks submitted concurrently,
+        # recorded in the ledger as one measurement that can be reused later
+        measurement_id = submit_measurement(
+            definition,
+            vps,
+            ripe_credentials["secret_key"],
+            ripe_credentials["username"],
+            tag=definition["tags"][0],
+        )
 
     measurement = {
-        "measurement_id": response["measurements"],
+        "measurement_id": [measurement_id],
     }
 
-    logger.info(f"measurement uuid (for retrieval): {response['measurements']}")
+    logger.info(f"measurement uuid (for retrieval): {measurement_id}")
 
-    insert_json(measurement, output_file_path)
+    if output_file_path is not None:
+        insert_json(measurement, output_file_path)
 
-    return response["measurements"][0]
+    return measurement_id
 
 
 def make_measurements(targets: list, vps: list, out_file_path: Path) -> list:
     """make measurement from a single vp toward a list of targets"""
-    # first we will ping every addresses from France
-    measurement_ids = []
-    for target in targets:
-        measurement_id = ping(
-            target=target["address_v4"],
-            vps=[vp["id"] for vp in vps],
-            output_file_path=out_file_path,
+    ripe_credentials = get_ripe_atlas_credentials()
+
+    if not ripe_credentials:
+        raise RuntimeError(
+            "set .env file at the root dir of the project with correct credentials"
         )
-        measurement_ids.append(measurement_id)
+
+    ripe_atlas = RIPEAtlas(
+        account=ripe_credentials["username"], key=ripe_credentials["secret_key"]
+    )
+
+    # ping every addresses, definitions are batched in a few requests
+    measurement_id_per_target = ripe_atlas.ping_batch(
+        targets=[target["address_v4"] for target in targets],
+        vps=[vp["id"] for vp in vps],
+        tag="netmetAnycastDetection",
+        description="Netmet anycast detection for target {target}",
+    )
+    measurement_ids = list(measurement_id_per_target.values())
+
+    logger.info(f"measurement uuids (for retrieval): {measurement_ids}")
+
+    # same format as ping output file, written once for all targets
+    insert_json(
+        [{"measurement_id": [measurement_id]} for measurement_id in measurement_ids],
+        out_file_path,
+    )
 
     return measurement_ids
 
 
 def retrieve_measurement_results(measurement_ids: list) -> list:
     """retrieve measurement results from a list of ids"""
-    # for each measurements, retrieve results
-    measurement_results = []
-    for measurement in measurement_ids:
-        measurement_id = measurement["measurement_id"][0]
-
-        measurement_description = get_measurement_description(measurement_id)
-
-        measurement_results_url = measurement_description["result"]
+    # results url is known from measurement id, no need to fetch descriptions
+    measurement_ids = [
+        measurement["measurement_id"][0] for measurement in measurement_ids
+    ]
 
-        req_results = requests.get(measurement_results_url).json()
+    # retrieve all measurements results concurrently
+    results_per_measurement = fetch_measurement_results(measurement_ids)
 
-        measurement_results.append(req_results)
+    measurement_results = list(results_per_measurement.values())
 
     return measurement_results
 
 
 def get_ping_results(measurement_results: list) -> None:
     """print all ping for manual analysis"""
-
-    ping_results_per_dst = defaultdict(dict)
+    aggregator = RttAggregator(key_fields=("src_addr", "dst_addr"))
     for results in measurement_results:
-        for result in results:
-            src_addr = result["src_addr"]
-            dst_addr = result["dst_addr"]
-
-            ping_results = result["result"]
-
-            rtts = []
-            for ping_result in ping_results:
-                if "rtt" in ping_result:
-                    rtts.append(ping_result["rtt"])
+        aggregator.add_results(results)
 
-            # get the lowest rtt
-            if rtts:
-                ping_results_per_dst[src_addr][dst_addr] = min(rtts)
+    # get the lowest rtt
+    ping_results_per_dst = defaultdict(dict)
+    for (src_addr, dst_addr), summary in aggregator.items():
+        ping_results_per_dst[src_addr][dst_addr] = summary.min
 
     # print results
     for src in ping_results_per_dst:
@@ -189,33 +210,49 @@ def get_ping_results(measurement_results: list) -> None:
 
 
 def get_max_distance_vps_to_target(results: dict) -> dict:
-    """for each ping results get higher bound distance between vps and targets"""
-    distances = defaultdict(list)
+    """
+    for each ping results get higher bound distance between vps and targets,
+    targets and vps are given by their encoded address
+    """
+    # find min rtt between each target and vp
+    aggregator = RttAggregator(key_fields=("dst_addr", "src_addr"))
     for measurement_results in results:
-        for measurement in measurement_results:
-            target_addr = measurement["dst_addr"]
-            vp_addr = measurement["src_addr"]
-            ping_results = measurement["result"]
-
-            # find min rtt between target and vp
-            rtts = []
-            for ping_result in ping_results:
-                if "rtt" in ping_result:
-                    rtts.append(ping_result["rtt"])
-
-            # get the lowest rtt
-            if rtts:
-                min_rtt = min(rtts)  # get the lowest latency
-                vp_to_target_max_distance = rtt_to_km(
-                    min_rtt
-                )  # convert this latency into distance
-
-                # store results
-                distances[target_addr].append((vp_addr, vp_to_target_max_distance))
+        aggregator.add_results(measurement_results)
+
+    encoder = get_ip_encoder()
+    distances = defaultdict(list)
+    for (target_addr, vp_addr), summary in aggregator.items():
+        # convert the lowest latency into distance
+        vp_to_target_max_distance = rtt_to_km(summary.min)
+
+        # store results
+        distances[encoder.encode(target_addr)].append(
+            (encoder.encode(vp_addr), vp_to_target_max_distance)
+        )
 
     return distances
 
 
+def get_distance_inter_vps(vps: list) -> tuple:
+    """
+    distance between each pair of vps, as a matrix indexed by vp position,
+    and the position of each vp encoded address
+    """
+    encoder = get_ip_encoder()
+
+    # a vp listed twice keeps its last position, as when overwriting a dict entry
+    vp_index = {}
+    for i, vp in enumerate(vps):
+        vp_index[encoder.encode(vp["address_v4"])] = i
+
+    # geojson coordinates: lon, lat
+    coordinates = np.array(
+        [vp["geometry"]["coordinates"] for vp in vps], dtype=np.float64
+    ).reshape(-1, 2)
+
+    return distance_matrix(coordinates[:, 1], coordinates[:, 0]), vp_index
+
+
 if __name__ == "__main__":
     ip_addresses_list = [
         {"address_v4": "142.250.201.4"},
@@ -259,8 +296,12 @@ if __name__ == "__main__":
 
         logger.info(f"Measurement ids for USA: {measurement_ids_us}")
 
-        # time to wait for accessing measurement results on RIPE Atlas API
-        time.sleep(60 * 3)
+        # wait for measurements to finish before accessing their results
+        for measurement_id in MeasurementTracker(
+            measurement_ids_fr + measurement_ids_us
+        ):
+            logger.info(f"measurement {measurement_id} finished")
+            get_ledger().update_status(measurement_id, STATUS_FINISHED)
 
     # finally we retrieve the results and print them
     retrieve_results = False
@@ -317,28 +358,10 @@ if __name__ == "__main__":
         logger.info("Get inter-vps distances")
 
         # get distance between vps and vps
-        distance_inter_vps = {}
         all_vps = ripe_vps_fr
         all_vps.extend(ripe_vps_us)
 
-        for vp in all_vps:
-            vp_lon, vp_lat = vp["geometry"]["coordinates"]
-
-            for next_vp in all_vps:
-                if next_vp["address_v4"] == vp["address_v4"]:
-                    continue
-
-                next_vp_lon, next_vp_lat = next_vp["geometry"]["coordinates"]
-
-                # store distance for each pair of targets
-                distance_inter_vps[
-                    (vp["address_v4"], next_vp["address_v4"])
-                ] = distance(
-                    lat1=vp_lat,
-                    lat2=next_vp_lat,
-                    lon1=vp_lon,
-                    lon2=next_vp_lon,
-                )
+        distance_inter_vps, vp_index = get_distance_inter_vps(all_vps)
 
         logger.info("Anycast address detection based on speed of light violation")
 
@@ -354,7 +377,7 @@ if __name__ == "__main__":
                     # servers are described with private address while results are given with public one
                     # TODO: only use probe id to identify probes, it works every time
                     try:
-                        distance_vps = distance_inter_vps[(vp, next_vp)]
+                        distance_vps = distance_inter_vps[vp_index[vp], vp_index[next_vp]]
                     except KeyError as e:
                         continue
 
@@ -362,6 +385,10 @@ if __name__ == "__main__":
                     if estimated_distance + next_estimated_distance < distance_vps:
                         anycast_addresses.add(target_addr)
 
+        # addresses are decoded for display only
+        decode = get_ip_encoder().decode
+        anycast_addresses = {decode(target_addr) for target_addr in anycast_addresses}
+
         logger.info(
             f"Anycast addresses: {anycast_addresses} (original set of ip addresses: {ip_addresses_list})"
         )
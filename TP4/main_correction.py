@@ -1,5 +1,4 @@
 """correction TP4"""
-import requests
 import sys
 import numpy as np
 
@@ -7,7 +6,15 @@ from collections import defaultdict
 from pathlib import Path
 
 from common.geoloc import distance, cbg
-from common.ripe.utils import get_coordinates_from_id
+from common.ripe.ip_encoding import ProbeIndex
+from common.ripe.utils import get_cached_probes
+from common.ripe.reuse import get_reuse_index
+from common.ripe.fanout import submit_measurement
+from common.ripe.tracker import (
+    get_measurement_description as fetch_measurement_description,
+)
+from common.ripe.rtt_aggregator import aggregate_measurement_results
+from common.ripe.ripe_atlas_api import RIPEAtlas
 from common.credentials import get_ripe_atlas_credentials
 from common.file_utils import dump_json, load_json, insert_json
 from common.default import TP4_DATASET_PATH, TP4_RESULTS_PATH
@@ -33,7 +40,7 @@ def get_servers_from_country(country_code: str, out_file: Path) -> None:
         sys.exit(1)
     else:
         # 2. perform request to get all RIPE Atlas servers in Ukraine
-        response = requests.get(url=base_url, params=params).json()
+        response = get_cached_probes(base_url, params=params)
 
         # 3. filter servers so they all :
         #   - have connected status (check the response)
@@ -59,7 +66,7 @@ def get_servers_from_country(country_code: str, out_file: Path) -> None:
 def ping(
     target: dict,
     vps: list,
-    output_file_path: Path,
+    output_file_path: Path = None,
 ) -> int:
     """perform a traceroute from one vp in UA towards one server in RU"""
     logger.info("###############################################")
@@ -73,38 +80,43 @@ def ping(
             "set .env file at the root dir of the project with correct credentials"
         )
 
-    response = requests.post(
-        f"https://atlas.ripe.net/api/v2/measurements/?key={ripe_credentials['secret_key']}",
-        json={
-            "definitions": [
-                {
-                    "target": target,
-                    "af": 4,
-                    "packets": 3,
-                    "size": 48,
-                    "tags": ["netmetgeolocation"],
-                    "description": f"Geolocation of target: {target}",
-                    "resolve_on_probe": False,
-                    "skip_dns_check": True,
-                    "include_probe_id": False,
-                    "type": "ping",
-                }
-            ],
-            "probes": [{"value": vp, "type": "probes", "requested": 1} for vp in vps],
-            "is_oneoff": True,
-            "bill_to": ripe_credentials["username"],
-        },
-    ).json()
+    definition = {
+        "target": target,
+        "af": 4,
+        "packets": 3,
+        "size": 48,
+        "tags": ["netmetgeolocation"],
+        "description": f"Geolocation of target: {target}",
+        "resolve_on_probe": False,
+        "skip_dns_check": True,
+        "include_probe_id": False,
+        "type": "ping",
+    }
+
+    # an identical recent measurement is reused instead of submitting a new one,
+    # its id is written to the output file all the same
+    measurement_id = get_reuse_index().lookup(definition, vps)
+    if measurement_id is None:
+        # large vp sets are split in chunks submitted concurrently,
+        # recorded in the ledger as one measurement that can be reused later
+        measurement_id = submit_measurement(
+            definition,
+            vps,
+            ripe_credentials["secret_key"],
+            ripe_credentials["username"],
+            tag=definition["tags"][0],
+        )
 
     measurement = {
-        "measurement_id": response["measurements"],
+        "measurement_id": [measurement_id],
     }
 
-    logger.info(f"measurement uuid (for retrieval): {response['measurements']}")
+    logger.info(f"measurement uuid (for retrieval): {measurement_id}")
 
-    insert_json(measurement, output_file_path)
+    if output_file_path is not None:
+        insert_json(measurement, output_file_path)
 
-    return response["measurements"][0]
+    return measurement_id
 
 
 def perform_measurements(targets: list, vps: list, out_file_path: Path) -> list:
@@ -113,15 +125,33 @@ def perform_measurements(targets: list, vps: list, out_file_path: Path) -> list:
     logger.info(f"# Pinging all targets from all vps           #")
     logger.info("###############################################")
 
-    # first we will ping every addresses from a list of vps
-    measurement_ids = []
-    for target in targets:
-        measurement_id = ping(
-            target=target["address_v4"],
-            vps=[vp["id"] for vp in vps],
-            output_file_path=out_file_path,
+    ripe_credentials = get_ripe_atlas_credentials()
+
+    if not ripe_credentials:
+        raise RuntimeError(
+            "set .env file at the root dir of the project with correct credentials"
         )
-        measurement_ids.append(measurement_id)
+
+    ripe_atlas = RIPEAtlas(
+        account=ripe_credentials["username"], key=ripe_credentials["secret_key"]
+    )
+
+    # ping every addresses from a list of vps, definitions are batched in a few requests
+    measurement_id_per_target = ripe_atlas.ping_batch(
+        targets=[target["address_v4"] for target in targets],
+        vps=[vp["id"] for vp in vps],
+        tag="netmetgeolocation",
+        description="Geolocation of target: {target}",
+    )
+    measurement_ids = list(measurement_id_per_target.values())
+
+    logger.info(f"measurement uuids (for retrieval): {measurement_ids}")
+
+    # same format as ping output file, written once for all targets
+    insert_json(
+        [{"measurement_id": [measurement_id]} for measurement_id in measurement_ids],
+        out_file_path,
+    )
 
     return measurement_ids
 
@@ -135,9 +165,8 @@ def get_measurement_description(measurement_id: int) -> dict:
     logger.info("###############################################")
     logger.info(f"# Get measurement description {measurement_id} #")
     logger.info("###############################################")
-    base_url = "https://atlas.ripe.net/api/v2/measurements/"
-
-    measurement_description = requests.get(f"{base_url}/{measurement_id}/").json()
+    # descriptions of finished measurements are served from the local cache
+    measurement_description = fetch_measurement_description(measurement_id)
 
     if not measurement_description:
         logger.error("Measurement description is empty")
@@ -154,39 +183,21 @@ def retrieve_geolocation_measurements(measurement_descriptions: Path) -> list:
     logger.info("###############################################")
 
     # for each target find results
-    vps_to_target_min_rtts = defaultdict(list)
+    measurement_ids = []
     for measurement in measurement_descriptions:
-        measurement_ids = measurement["measurement_id"]
-
-        for measurement_id in measurement_ids:
-            # get measurement results url
-            measurement_description = get_measurement_description(measurement_id)
+        measurement_ids.extend(measurement["measurement_id"])
 
-            results_url = measurement_description["result"]
-
-            # get measurement results
-            measurement_results = requests.get(results_url).json()
-
-            # retrieve each minimum rtt per pair vp/target
-            for result in measurement_results:
-                vp_id = result["prb_id"]
-                target_addr = result["dst_addr"]
-                pring_results = result["result"]
-
-                min_rtt = None
-                rtts = []
-                for ping_result in pring_results:
-                    if "rtt" in ping_result:
-                        rtts.append(ping_result["rtt"])
+    # min rtt per pair vp/target, summarized while results are downloaded
+    aggregator = aggregate_measurement_results(
+        measurement_ids, key_fields=("dst_addr", "prb_id")
+    )
 
-                # it might happens that we do not get results
-                if rtts:
-                    min_rtt = min(rtts)
-                else:
-                    continue
+    vps_to_target_min_rtts = defaultdict(list)
+    for (target_addr, vp_id), summary in aggregator.items():
+        vps_to_target_min_rtts[target_addr].append((vp_id, summary.min))
 
-                logger.info(target_addr)
-                vps_to_target_min_rtts[target_addr].append((vp_id, min_rtt))
+    for target_addr, min_rtts in vps_to_target_min_rtts.items():
+        logger.info(f"{target_addr}: {len(min_rtts)} vps")
 
     # save results
     dump_json(
@@ -207,14 +218,23 @@ def shortest_ping_geolocation(
     logger.info(f"# Geolocation estimation with: Shortest ping #")
     logger.info("###############################################")
 
+    # vps coordinates indexed by probe, the first vp of a probe wins as in get_coordinates_from_id
+    probe_index = ProbeIndex(vp["id"] for vp in vps)
+    vps_coordinates = np.empty((len(probe_index), 2), dtype=np.float64)
+    for vp in reversed(vps):
+        vps_coordinates[probe_index.get(vp["id"])] = vp["geometry"]["coordinates"]
+
     geolocation_per_target = {}
     for target, min_rtts_list in vps_to_target_min_rtts.items():
         logger.info(f"shortest ping validation for target: {target}")
         # shortest ping
-        best_vp_addr, _ = min(min_rtts_list, key=lambda x: x[1])
-        target_coordinates_shortest_ping = get_coordinates_from_id(best_vp_addr, vps)
+        best_vp_id, _ = min(min_rtts_list, key=lambda x: x[1])
+        best_vp_index = probe_index.get(best_vp_id)
+        if best_vp_index is None:
+            logger.warning(f"no coordinates for vp {best_vp_id}, target {target} skipped")
+            continue
 
-        target_lon, target_lat = target_coordinates_shortest_ping
+        target_lon, target_lat = vps_coordinates[best_vp_index].tolist()
 
         geolocation_per_target[target] = {
             "lat": target_lat,
@@ -1,12 +1,17 @@
 """correction TP4"""
-import requests
 import sys
 import numpy as np
 
 from collections import defaultdict
 from pathlib import Path
 
-from common.ripe.utils import get_coordinates_from_id
+from common.ripe.utils import get_cached_probes, get_coordinates_from_id
+from common.ripe.reuse import get_reuse_index
+from common.ripe.fanout import submit_measurement
+from common.ripe.dns_engine import DnsAnswerTable, get_dns_answer_table
+from common.ripe.tracker import (
+    get_measurement_description as fetch_measurement_description,
+)
 from common.credentials import get_ripe_atlas_credentials
 from common.file_utils import dump_json, load_json, insert_json
 from common.default import TP5_DATASET_PATH, TP5_RESULTS_PATH
@@ -22,9 +27,8 @@ def get_measurement_description(measurement_id: int) -> dict:
     logger.info("###############################################")
     logger.info(f"# Get measurement description {measurement_id} #")
     logger.info("###############################################")
-    base_url = "https://atlas.ripe.net/api/v2/measurements/"
-
-    measurement_description = requests.get(f"{base_url}/{measurement_id}/").json()
+    # descriptions of finished measurements are served from the local cache
+    measurement_description = fetch_measurement_description(measurement_id)
 
     if not measurement_description:
         logger.error("Measurement description is empty")
@@ -52,7 +56,7 @@ def get_servers_from_country(country_code: str, out_file: Path) -> None:
         sys.exit(1)
     else:
         # 2. perform request to get all RIPE Atlas servers in Ukraine
-        response = requests.get(url=base_url, params=params).json()
+        response = get_cached_probes(base_url, params=params)
 
         # 3. filter servers so they all :
         #   - have connected status (check the response)
@@ -78,7 +82,7 @@ def get_servers_from_country(country_code: str, out_file: Path) -> None:
 def ping(
     target: dict,
     vps: list,
-    output_file_path: Path,
+    output_file_path: Path = None,
 ) -> int:
     """perform a traceroute from one vp in UA towards one server in RU"""
     logger.info("###############################################")
@@ -92,44 +96,49 @@ def ping(
             "set .env file at the root dir of the project with correct credentials"
         )
 
-    response = requests.post(
-        f"https://atlas.ripe.net/api/v2/measurements/?key={ripe_credentials['secret_key']}",
-        json={
-            "definitions": [
-                {
-                    "target": target,
-                    "af": 4,
-                    "packets": 3,
-                    "size": 48,
-                    "tags": ["netmetgeolocation"],
-                    "description": f"Geolocation of target: {target}",
-                    "resolve_on_probe": False,
-                    "skip_dns_check": True,
-                    "include_probe_id": False,
-                    "type": "ping",
-                }
-            ],
-            "probes": [{"value": vp, "type": "probes", "requested": 1} for vp in vps],
-            "is_oneoff": True,
-            "bill_to": ripe_credentials["username"],
-        },
-    ).json()
+    definition = {
+        "target": target,
+        "af": 4,
+        "packets": 3,
+        "size": 48,
+        "tags": ["netmetgeolocation"],
+        "description": f"Geolocation of target: {target}",
+        "resolve_on_probe": False,
+        "skip_dns_check": True,
+        "include_probe_id": False,
+        "type": "ping",
+    }
+
+    # an identical recent measurement is reused instead of submitting a new one,
+    # its id is written to the output file all the same
+    measurement_id = get_reuse_index().lookup(definition, vps)
+    if measurement_id is None:
+        # large vp sets are split in chunks submitted concurrently,
+        # recorded in the ledger as one measurement that can be reused later
+        measurement_id = submit_measurement(
+            definition,
+            vps,
+            ripe_credentials["secret_key"],
+            ripe_credentials["username"],
+            tag=definition["tags"][0],
+        )
 
     measurement = {
-        "measurement_id": response["measurements"],
+        "measurement_id": [measurement_id],
     }
 
-    logger.info(f"measurement uuid (for retrieval): {response['measurements']}")
+    logger.info(f"measurement uuid (for retrieval): {measurement_id}")
 
-    insert_json(measurement, output_file_path)
+    if output_file_path is not None:
+        insert_json(measurement, output_file_path)
 
-    return response["measurements"][0]
+    return measurement_id
 
 
 def dns(
     hostname: dict,
     vps: list,
-    output_file_path: Path,
+    output_file_path: Path = None,
 ) -> int:
     """perform a DNS request from one vp in UA towards one server in RU"""
     logger.info("###############################################")
@@ -143,46 +152,52 @@ def dns(
             "set .env file at the root dir of the project with correct credentials"
         )
 
-    response = requests.post(
-        f"https://atlas.ripe.net/api/v2/measurements/?key={ripe_credentials['secret_key']}",
-        json={
-            "definitions": [
-                {
-                    "type": "dns",
-                    "af": 4,
-                    "resolve_on_probe": True,
-                    "description": f"DNS measurement for {hostname}",
-                    "query_class": "IN",
-                    "query_type": "A",
-                    "protocol": "UDP",
-                    "udp_payload_size": 512,
-                    "retry": 0,
-                    "skip_dns_check": False,
-                    "include_qbuf": False,
-                    "include_abuf": True,
-                    "prepend_probe_id": False,
-                    "timeout": 5000,
-                    "use_probe_resolver": False,
-                    "set_nsid_bit": True,
-                    "query_argument": f"{hostname}",
-                    "target": "8.8.8.8",
-                }
-            ],
-            "probes": [{"value": vp, "type": "probes", "requested": 1} for vp in vps],
-            "is_oneoff": True,
-            "bill_to": ripe_credentials["username"],
-        },
-    ).json()
+    definition = {
+        "type": "dns",
+        "af": 4,
+        "resolve_on_probe": True,
+        "description": f"DNS measurement for {hostname}",
+        "tags": ["netmetDNS"],
+        "query_class": "IN",
+        "query_type": "A",
+        "protocol": "UDP",
+        "udp_payload_size": 512,
+        "retry": 0,
+        "skip_dns_check": False,
+        "include_qbuf": False,
+        "include_abuf": True,
+        "prepend_probe_id": False,
+        "timeout": 5000,
+        "use_probe_resolver": False,
+        "set_nsid_bit": True,
+        "query_argument": f"{hostname}",
+        "target": "8.8.8.8",
+    }
+
+    # an identical recent measurement is reused instead of submitting a new one,
+    # its id is written to the output file all the same
+    measurement_id = get_reuse_index().lookup(definition, vps)
+    if measurement_id is None:
+        # large vp sets are split in chunks submitted concurrently,
+        # recorded in the ledger as one measurement that can be reused later
+        measurement_id = submit_measurement(
+            definition,
+            vps,
+            ripe_credentials["secret_key"],
+            ripe_credentials["username"],
+            tag=definition["tags"][0],
+        )
 
     measurement = {
-        "measurement_id": response["measurements"],
+        "measurement_id": [measurement_id],
     }
 
-    logger.info(f"measurement uuid (for retrieval): {response['measurements']}")
+    logger.info(f"measurement uuid (for retrieval): {measurement_id}")
 
-    insert_json(measurement, output_file_path)
+    if output_file_path is not None:
+        insert_json(measurement, output_file_path)
 
-    return response["measurements"][0]
+    return measurement_id
 
 
 def perform_measurements_dns(hostnames: list, vps: list, out_file_path: Path) -> list:
@@ -194,20 +209,45 @@ def perform_measurements_dns(hostnames: list, vps: list, out_file_path: Path) ->
         measurement_id = dns(
             hostname=hostname,
             vps=[vp["id"] for vp in vps],
-            output_file_path=out_file_path,
         )
         measurement_ids.append(measurement_id)
 
+    # output file is written once for all hostnames
+    insert_json(
+        [{"measurement_id": [measurement_id]} for measurement_id in measurement_ids],
+        out_file_path,
+    )
+
     return measurement_ids
 
 
-def retrieve_dns_measurements(measurement_descriptions: Path) -> list:
-    """retrieve an save all measurements"""
+def retrieve_dns_measurements(measurement_descriptions: Path) -> DnsAnswerTable:
+    """retrieve all measurements, save the answers of each vp per hostname"""
 
     logger.info("###############################################")
     logger.info(f"# Retrieving all measurement results         #")
     logger.info("###############################################")
-    pass
+
+    measurement_ids = []
+    for measurement in measurement_descriptions:
+        measurement_ids.extend(measurement["measurement_id"])
+
+    # abuf payloads are decoded while results are downloaded
+    dns_answers = get_dns_answer_table(measurement_ids)
+
+    for hostname in dns_answers.hostnames:
+        replicas = dns_answers.get_replicas(hostname)
+        logger.info(f"{hostname}: {len(replicas)} replicas")
+        for replica_addr, prb_ids in replicas.items():
+            logger.info(f"    {replica_addr}: answered to {len(prb_ids)} vps")
+
+    # save results
+    dump_json(
+        dns_answers.as_dict(),
+        TP5_RESULTS_PATH / "dns_answers_correction.json",
+    )
+
+    return dns_answers
 
 
 if __name__ == "__main__":
@@ -4,6 +4,14 @@ from pathlib import Path
 # Default path
 DEFAULT_PATH: Path = Path(__file__).resolve().parent
 
+# local cache of RIPE Atlas responses
+CACHE_PATH: Path = DEFAULT_PATH / "../.cache/ripe"
+
+# local stores (measurement results, submitted measurements)
+STORE_PATH: Path = DEFAULT_PATH / "../.store"
+RESULTS_STORE_PATH: Path = STORE_PATH / "results.db"
+LEDGER_PATH: Path = STORE_PATH / "ledger.db"
+
 
 ##############################################################################################
 # TP1                                                                                        #
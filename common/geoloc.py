@@ -214,6 +214,21 @@ def distance(lat1, lat2, lon1, lon2):
     return c * r
 
 
+def distance_matrix(lats, lons):
+    """same as distance, between all pairs of points at once"""
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+
+    dlon = lons[None, :] - lons[:, None]
+    dlat = lats[None, :] - lats[:, None]
+    a = (
+        np.sin(dlat / 2) ** 2
+        + np.cos(lats)[:, None] * np.cos(lats)[None, :] * np.sin(dlon / 2) ** 2
+    )
+
+    return 2 * np.arcsin(np.sqrt(np.minimum(a, 1))) * 6371
+
+
 def get_middle_intersection(intersections):
     """in case of only two intersection points, return the middle segment"""
     (lat1, lon1) = intersections[0]
@@ -0,0 +1,244 @@
+"""SQLite ledger of all submitted RIPE Atlas measurements"""
+import json
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+from typing import Iterable
+
+from common.default import LEDGER_PATH
+
+# measurement status in the ledger
+STATUS_SUBMITTED: str = "submitted"
+STATUS_FINISHED: str = "finished"
+STATUS_FAILED: str = "failed"
+# chunked measurement with chunks still to submit, not reusable yet
+STATUS_PARTIAL: str = "partial"
+
+MAX_QUERY_PARAMETERS: int = 500
+
+
+class MeasurementLedger(object):
+    """
+    one row per submitted measurement (definition, target, vps, tag, status),
+    rows are appended and updated in place, never rewritten
+    """
+
+    def __init__(self, path: Path = LEDGER_PATH) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS measurements (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    measurement_id INTEGER UNIQUE,
+                    type TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    vps TEXT NOT NULL,
+                    tag TEXT,
+                    definition TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    reuse_key TEXT,
+                    parent_id INTEGER
+                )
+                """
+            )
+            # ledgers created before reuse keys and chunked measurements
+            columns = [
+                row["name"]
+                for row in self._db.execute("PRAGMA table_info(measurements)")
+            ]
+            if "reuse_key" not in columns:
+                self._db.execute("ALTER TABLE measurements ADD COLUMN reuse_key TEXT")
+            if "parent_id" not in columns:
+                self._db.execute("ALTER TABLE measurements ADD COLUMN parent_id INTEGER")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS measurements_tag_status ON measurements (tag, status)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS measurements_type_target ON measurements (type, target)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS measurements_reuse_key ON measurements (reuse_key, created_at)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS measurements_parent_id ON measurements (parent_id)"
+            )
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        measurement = dict(row)
+        measurement["vps"] = json.loads(measurement["vps"])
+        measurement["definition"] = json.loads(measurement["definition"])
+        return measurement
+
+    def record(
+        self,
+        measurement_id: int,
+        definition: dict,
+        vps: list,
+        tag: str = None,
+        status: str = STATUS_SUBMITTED,
+        reuse_key: str = None,
+        parent_id: int = None,
+    ) -> None:
+        """
+        append a submitted measurement, a measurement is only recorded once,
+        chunks of a measurement split over several vp sets are recorded with parent_id
+        """
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                """
+                INSERT OR IGNORE INTO measurements
+                (measurement_id, type, target, vps, tag, definition, status, created_at, updated_at, reuse_key, parent_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    measurement_id,
+                    definition["type"],
+                    definition.get("target") or definition.get("query_argument"),
+                    json.dumps(list(vps)),
+                    tag,
+                    json.dumps(definition),
+                    status,
+                    now,
+                    now,
+                    reuse_key,
+                    parent_id,
+                ),
+            )
+
+    def update_status(self, measurement_id: int, status: str) -> None:
+        """change the status of a measurement and of its chunks"""
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE measurements SET status = ?, updated_at = ? WHERE measurement_id = ? OR parent_id = ?",
+                (status, time.time(), measurement_id, measurement_id),
+            )
+
+    def get(self, measurement_id: int) -> dict:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM measurements WHERE measurement_id = ?",
+                (measurement_id,),
+            ).fetchone()
+
+        return self._to_dict(row) if row else None
+
+    def find(
+        self,
+        tag: str = None,
+        status: str = None,
+        measurement_type: str = None,
+        targets: Iterable[str] = None,
+    ) -> list:
+        """return all measurements matching the given criteria, oldest first, chunks excluded"""
+        query = "SELECT * FROM measurements WHERE parent_id IS NULL"
+        params = []
+        if tag is not None:
+            query += " AND tag = ?"
+            params.append(tag)
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        if measurement_type is not None:
+            query += " AND type = ?"
+            params.append(measurement_type)
+        if targets is not None:
+            targets = list(targets)
+            if not targets:
+                return []
+            query += f" AND target IN ({', '.join('?' for _ in targets)})"
+            params.extend(targets)
+        query += " ORDER BY id"
+
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+
+        return [self._to_dict(row) for row in rows]
+
+    def find_reusable(self, reuse_key: str, since: float) -> dict:
+        """most recent measurement with this reuse key created after since, if any"""
+        with self._lock:
+            row = self._db.execute(
+                """
+                SELECT * FROM measurements
+                WHERE reuse_key = ? AND created_at >= ? AND status NOT IN (?, ?)
+                ORDER BY created_at DESC LIMIT 1
+                """,
+                (reuse_key, since, STATUS_FAILED, STATUS_PARTIAL),
+            ).fetchone()
+
+        return self._to_dict(row) if row else None
+
+    def find_partial(self, reuse_key: str) -> dict:
+        """most recent chunked measurement with this reuse key whose submission was interrupted"""
+        with self._lock:
+            row = self._db.execute(
+                """
+                SELECT * FROM measurements
+                WHERE reuse_key = ? AND status = ?
+                ORDER BY created_at DESC LIMIT 1
+                """,
+                (reuse_key, STATUS_PARTIAL),
+            ).fetchone()
+
+        return self._to_dict(row) if row else None
+
+    def get_chunks(self, measurement_ids: Iterable[int]) -> dict:
+        """return the chunk ids of each measurement split over several vp sets"""
+        measurement_ids = list(measurement_ids)
+
+        chunks = {}
+        # stay below sqlite limit on the number of query parameters
+        for i in range(0, len(measurement_ids), MAX_QUERY_PARAMETERS):
+            ids = measurement_ids[i : i + MAX_QUERY_PARAMETERS]
+            with self._lock:
+                rows = self._db.execute(
+                    f"""
+                    SELECT parent_id, measurement_id FROM measurements
+                    WHERE parent_id IN ({', '.join('?' for _ in ids)})
+                    ORDER BY id
+                    """,
+                    ids,
+                ).fetchall()
+
+            for parent_id, measurement_id in rows:
+                chunks.setdefault(parent_id, []).append(measurement_id)
+
+        return chunks
+
+    def pending(self, tag: str = None) -> list:
+        """all measurements submitted but not finished yet"""
+        return self.find(tag=tag, status=STATUS_SUBMITTED)
+
+    def measurement_ids(self, tag: str = None, status: str = None) -> list:
+        return [
+            measurement["measurement_id"]
+            for measurement in self.find(tag=tag, status=status)
+        ]
+
+
+_ledger: MeasurementLedger = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger() -> MeasurementLedger:
+    """return the process wide ledger, create it on first use"""
+    global _ledger
+
+    if _ledger is None:
+        with _ledger_lock:
+            if _ledger is None:
+                _ledger = MeasurementLedger()
+
+    return _ledger
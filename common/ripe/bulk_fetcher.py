@@ -0,0 +1,302 @@
+"""Asyncio bulk fetcher for the results of many RIPE Atlas measurements"""
+import asyncio
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterable, Iterator
+
+from common.ledger import get_ledger
+from common.ripe.cache import get_cache
+from common.ripe.results_reader import stream_results
+from common.ripe.tracker import get_finished_measurements
+from common.ripe.utils import get_measurement_url
+from common.logger_config import logger
+
+DEFAULT_CONCURRENCY: int = 16
+
+# larger probe selections are filtered locally, keeps urls short
+MAX_PROBE_IDS_PER_QUERY: int = 500
+
+# time sliced downloads of long measurement histories
+DEFAULT_WINDOW: int = 24 * 60 * 60  # seconds
+DEFAULT_WINDOW_RETRY: int = 3
+
+
+def run_coroutine(coroutine):
+    """
+    asyncio.run, also when called from a running event loop (Jupyter):
+    the coroutine then runs in its own loop on a helper thread
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def _get_results(
+    measurement_id: int,
+    params: dict,
+    transform=None,
+    use_cache: bool = True,
+    probe_ids: set = None,
+    finished: bool = False,
+) -> list:
+    """
+    blocking download of one measurement results, run in the fetcher thread pool,
+    results are cached only if the measurement was finished before the download
+    """
+    if probe_ids is not None and len(probe_ids) <= MAX_PROBE_IDS_PER_QUERY:
+        # only results of the selected probes are sent by Atlas
+        params = {
+            **params,
+            "probe_ids": ",".join(str(probe_id) for probe_id in sorted(probe_ids)),
+        }
+
+    results = stream_results(
+        get_measurement_url(measurement_id),
+        params=params,
+        cache=get_cache() if use_cache else None,
+        # results of finished measurements never change
+        immutable=finished,
+    )
+
+    # too many probes for the url or filter ignored by Atlas: filter locally
+    if probe_ids is not None:
+        results = (result for result in results if result["prb_id"] in probe_ids)
+
+    # transform each result while streaming so raw results are never all in memory
+    if transform is not None:
+        return [transform(result) for result in results]
+
+    return list(results)
+
+
+async def iter_measurement_results(
+    measurement_ids: Iterable[int],
+    max_concurrency: int = DEFAULT_CONCURRENCY,
+    params: dict = None,
+    transform=None,
+    use_cache: bool = True,
+    probe_ids: Iterable[int] = None,
+) -> AsyncIterator[tuple]:
+    """
+    yield (measurement_id, results) as soon as each measurement results are downloaded,
+    at most max_concurrency downloads are in flight at any time,
+    params is a dict or a function returning the parameters of a measurement id,
+    transform is applied on each result as it is streamed,
+    probe_ids restricts results to a set of probes,
+    results of finished measurements are read from the local cache when available,
+    results of measurements split in chunks are merged under the measurement id
+    """
+    if not params:
+        params = {}
+
+    if probe_ids is not None:
+        probe_ids = set(probe_ids)
+
+    # same parameters for all measurements or a function of measurement id
+    get_params = params if callable(params) else lambda _: params
+
+    # chunks are downloaded as any measurement, with the parameters of their parent
+    measurement_ids = list(measurement_ids)
+    chunks = get_ledger().get_chunks(measurement_ids)
+    parents = {
+        chunk_id: measurement_id
+        for measurement_id, chunk_ids in chunks.items()
+        for chunk_id in chunk_ids
+    }
+    remaining = {
+        measurement_id: len(chunk_ids) + 1
+        for measurement_id, chunk_ids in chunks.items()
+    }
+    merged = {measurement_id: [] for measurement_id in chunks}
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+    ids = measurement_ids + list(parents)
+
+    # statuses are known before any download starts, one list query per batch of ids,
+    # a measurement finishing during its download is not cached
+    finished = (
+        await loop.run_in_executor(None, get_finished_measurements, ids)
+        if use_cache
+        else set()
+    )
+    ids = iter(ids)
+
+    async def worker(executor: ThreadPoolExecutor) -> None:
+        try:
+            # workers share the id iterator, no id is fetched twice
+            for measurement_id in ids:
+                try:
+                    results = await loop.run_in_executor(
+                        executor,
+                        _get_results,
+                        measurement_id,
+                        get_params(parents.get(measurement_id, measurement_id)),
+                        transform,
+                        use_cache,
+                        probe_ids,
+                        measurement_id in finished,
+                    )
+                except Exception as e:
+                    logger.error(f"could not fetch results of {measurement_id}: {e}")
+                    results = None
+
+                queue.put_nowait((measurement_id, results))
+        finally:
+            queue.put_nowait(done)
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        workers = [
+            asyncio.create_task(worker(executor)) for _ in range(max_concurrency)
+        ]
+        try:
+            running = len(workers)
+            while running:
+                item = await queue.get()
+                if item is done:
+                    running -= 1
+                    continue
+
+                measurement_id, results = item
+                measurement_id = parents.get(measurement_id, measurement_id)
+                if measurement_id not in merged:
+                    if results is not None:
+                        yield measurement_id, results
+                    continue
+
+                # a chunked measurement is complete once all its chunks are
+                if results is not None:
+                    merged[measurement_id].extend(results)
+                remaining[measurement_id] -= 1
+                if not remaining[measurement_id]:
+                    yield measurement_id, merged.pop(measurement_id)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+
+def fetch_measurement_results(
+    measurement_ids: Iterable[int],
+    max_concurrency: int = DEFAULT_CONCURRENCY,
+    params: dict = None,
+    transform=None,
+    use_cache: bool = True,
+    probe_ids: Iterable[int] = None,
+) -> dict:
+    """blocking version of iter_measurement_results, return results per measurement id"""
+    measurement_ids = list(measurement_ids)
+
+    async def collect() -> dict:
+        return {
+            measurement_id: results
+            async for measurement_id, results in iter_measurement_results(
+                measurement_ids,
+                max_concurrency=max_concurrency,
+                params=params,
+                transform=transform,
+                use_cache=use_cache,
+                probe_ids=probe_ids,
+            )
+        }
+
+    results = run_coroutine(collect())
+
+    # keep the order of the input measurement ids
+    return {
+        measurement_id: results[measurement_id]
+        for measurement_id in measurement_ids
+        if measurement_id in results
+    }
+
+
+def _get_window_results(
+    measurement_id: int,
+    window: tuple,
+    max_retry: int,
+    use_cache: bool,
+    probe_ids: set,
+    finished: bool = False,
+) -> list:
+    """download results of one time window, retry only this window on failure"""
+    start, stop = window
+    for attempt in range(max_retry + 1):
+        try:
+            results = _get_results(
+                measurement_id,
+                {"start": start, "stop": stop},
+                use_cache=use_cache,
+                probe_ids=probe_ids,
+                finished=finished,
+            )
+            break
+        except Exception as e:
+            if attempt == max_retry:
+                raise
+            logger.warning(
+                f"measurement {measurement_id} window [{start}, {stop}] failed ({e}), retrying"
+            )
+            time.sleep(2**attempt)
+
+    return sorted(results, key=lambda result: result["timestamp"])
+
+
+def iter_results_time_sliced(
+    measurement_id: int,
+    start: int,
+    stop: int,
+    window: int = DEFAULT_WINDOW,
+    max_concurrency: int = DEFAULT_CONCURRENCY,
+    max_retry: int = DEFAULT_WINDOW_RETRY,
+    use_cache: bool = True,
+    probe_ids: Iterable[int] = None,
+) -> Iterator[dict]:
+    """
+    split [start, stop] into time windows downloaded concurrently,
+    yield results by increasing timestamp, only max_concurrency windows are buffered
+    """
+    if probe_ids is not None:
+        probe_ids = set(probe_ids)
+
+    # the status is checked once, before any window is downloaded
+    finished = use_cache and measurement_id in get_finished_measurements(
+        [measurement_id]
+    )
+
+    windows = [
+        (window_start, min(window_start + window - 1, stop))
+        for window_start in range(start, stop + 1, window)
+    ]
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        pending = deque()
+        windows = iter(windows)
+        while True:
+            # keep max_concurrency windows downloading ahead of the consumer
+            for next_window in windows:
+                pending.append(
+                    executor.submit(
+                        _get_window_results,
+                        measurement_id,
+                        next_window,
+                        max_retry,
+                        use_cache,
+                        probe_ids,
+                        finished,
+                    )
+                )
+                if len(pending) >= max_concurrency:
+                    break
+
+            if not pending:
+                break
+
+            # windows do not overlap, window order is timestamp order
+            yield from pending.popleft().result()
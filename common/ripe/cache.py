@@ -0,0 +1,288 @@
+"""Disk backed, content addressed cache of RIPE Atlas responses"""
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from pathlib import Path
+from urllib.parse import urlencode
+
+from common.ripe.http_client import get_client
+from common.default import CACHE_PATH
+from common.logger_config import logger
+
+DEFAULT_MAX_SIZE: int = 2 * 1024**3  # bytes
+
+
+class ResponseCache(object):
+    """
+    response bodies are stored once per content digest under objects/,
+    an sqlite index maps each request (url + params) to its body digest,
+    entries without expiry date are kept forever (immutable objects),
+    least recently used entries are evicted when the cache grows over max_size
+    """
+
+    def __init__(self, path: Path = CACHE_PATH, max_size: int = DEFAULT_MAX_SIZE):
+        self.path = Path(path)
+        self.objects_path = self.path / "objects"
+        self.objects_path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path / "index.db", check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    stored_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    expires_at REAL,
+                    etag TEXT,
+                    last_modified TEXT
+                )
+                """
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)"
+            )
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(url: str, params: dict = None) -> str:
+        if params:
+            url += "?" + urlencode(sorted(params.items()))
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _object_path(self, digest: str) -> Path:
+        return self.objects_path / digest[:2] / digest
+
+    def _lookup(self, key: str) -> sqlite3.Row:
+        return self._db.execute(
+            "SELECT * FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+
+    @staticmethod
+    def _is_fresh(entry: sqlite3.Row) -> bool:
+        return entry["expires_at"] is None or entry["expires_at"] > time.time()
+
+    def get_path(self, url: str, params: dict = None) -> Path:
+        """return the path of a fresh cached body, None if absent or expired"""
+        key = self._key(url, params)
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None or not self._is_fresh(entry):
+                self.misses += 1
+                return None
+
+            object_path = self._object_path(entry["digest"])
+            if not object_path.exists():
+                self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._db.commit()
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._db.execute(
+                "UPDATE entries SET accessed_at = ? WHERE key = ?", (time.time(), key)
+            )
+            self._db.commit()
+
+        return object_path
+
+    def get(self, url: str, params: dict = None) -> bytes:
+        """return a fresh cached body, None if absent or expired"""
+        object_path = self.get_path(url, params)
+        if object_path is None:
+            return None
+
+        return object_path.read_bytes()
+
+    def put_file(
+        self,
+        url: str,
+        params: dict,
+        file_path: Path,
+        ttl: float = None,
+        etag: str = None,
+        last_modified: str = None,
+    ) -> None:
+        """move file into the cache as body of url, ttl None means kept forever"""
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+
+        object_path = self._object_path(digest)
+        size = os.path.getsize(file_path)
+        now = time.time()
+        with self._lock:
+            object_path.parent.mkdir(exist_ok=True)
+            if object_path.exists():
+                os.remove(file_path)
+            else:
+                shutil.move(file_path, object_path)
+
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self._key(url, params),
+                    url,
+                    digest,
+                    size,
+                    now,
+                    now,
+                    now + ttl if ttl is not None else None,
+                    etag,
+                    last_modified,
+                ),
+            )
+            self._db.commit()
+            self._evict()
+
+    def put(
+        self,
+        url: str,
+        params: dict,
+        content: bytes,
+        ttl: float = None,
+        etag: str = None,
+        last_modified: str = None,
+    ) -> None:
+        """store content as body of url, ttl None means kept forever"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+
+        self.put_file(url, params, tmp_path, ttl, etag, last_modified)
+
+    def writer(self):
+        """temporary file in the cache directory, to be committed with put_file"""
+        return tempfile.NamedTemporaryFile(dir=self.path, delete=False)
+
+    def _evict(self) -> None:
+        """remove least recently used entries until cache size is under max_size"""
+        total_size = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+        if total_size <= self.max_size:
+            return
+
+        for entry in self._db.execute(
+            "SELECT key, digest, size FROM entries ORDER BY accessed_at"
+        ).fetchall():
+            self._db.execute("DELETE FROM entries WHERE key = ?", (entry["key"],))
+            self.evictions += 1
+            total_size -= entry["size"]
+
+            # body might still be shared by another entry
+            shared = self._db.execute(
+                "SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (entry["digest"],)
+            ).fetchone()
+            if not shared:
+                self._object_path(entry["digest"]).unlink(missing_ok=True)
+
+            if total_size <= self.max_size:
+                break
+
+        self._db.commit()
+
+    def fetch(self, url: str, params: dict = None, ttl: float = None) -> bytes:
+        """
+        return url body from cache if fresh, otherwise from Atlas API,
+        stale entries are revalidated with ETag / If-Modified-Since
+        """
+        content = self.get(url, params)
+        if content is not None:
+            return content
+
+        key = self._key(url, params)
+        with self._lock:
+            entry = self._lookup(key)
+
+        headers = {}
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = get_client().get(url, params=params, headers=headers)
+
+        object_path = self._object_path(entry["digest"]) if entry else None
+        if response.status_code == 304 and object_path and object_path.exists():
+            with self._lock:
+                self.revalidations += 1
+                self._db.execute(
+                    "UPDATE entries SET accessed_at = ?, expires_at = ? WHERE key = ?",
+                    (
+                        time.time(),
+                        time.time() + ttl if ttl is not None else None,
+                        key,
+                    ),
+                )
+                self._db.commit()
+            return object_path.read_bytes()
+
+        response.raise_for_status()
+        self.put(
+            url,
+            params,
+            response.content,
+            ttl=ttl,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+
+        return response.content
+
+    def stats(self) -> dict:
+        with self._lock:
+            nb_entries, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "evictions": self.evictions,
+            "entries": nb_entries,
+            "size": size,
+        }
+
+    def __str__(self) -> str:
+        return " | ".join(f"{key}: {value}" for key, value in self.stats().items())
+
+
+_cache: ResponseCache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> ResponseCache:
+    """return the process wide response cache, create it on first use"""
+    global _cache
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache()
+                logger.info(f"RIPE Atlas response cache at {_cache.path.resolve()}")
+
+    return _cache
@@ -0,0 +1,343 @@
+"""Columnar parsing of ping results: parallel NumPy arrays instead of one dict per result"""
+import array
+
+from collections.abc import Mapping
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from common.ripe.ip_encoding import IPEncoder, KEY_DTYPE, get_ip_encoder
+from common.logger_config import logger
+
+
+def get_rtts(result: dict) -> list:
+    """rtts of a ping result without stars, None if the result is not usable"""
+    try:
+        if type(result["result"]) == list:
+            rtt_list = [list(rtt.values())[0] for rtt in result["result"]]
+        else:
+            rtt_list = [result["result"]["rtt"]]
+    except (KeyError, IndexError, AttributeError):
+        return None
+
+    # remove stars from results
+    rtt_list = [rtt for rtt in rtt_list if rtt != "*"]
+    if not rtt_list:
+        return None
+
+    # sometimes connection error with vantage point cause result to be string message
+    try:
+        min_rtt = min(rtt_list)
+    except TypeError:
+        return None
+
+    if isinstance(min_rtt, str):
+        return None
+
+    return rtt_list
+
+
+class PingTable(object):
+    """
+    one row per (destination, vp) ping: dst_id, vp_id, min_rtt, n_rtts, timestamp,
+    rtts of row i are rtts[offsets[i] : offsets[i + 1]],
+    ids index dst_keys and vp_keys: addresses encoded by encoder
+    (probe ids as is when vps are identified by prb_id)
+    """
+
+    def __init__(
+        self,
+        dst_keys: np.ndarray,
+        vp_keys: np.ndarray,
+        dst_id: np.ndarray,
+        vp_id: np.ndarray,
+        min_rtt: np.ndarray,
+        n_rtts: np.ndarray,
+        timestamp: np.ndarray,
+        rtts: np.ndarray,
+        offsets: np.ndarray,
+        encoder: IPEncoder = None,
+        vp_field: str = "from",
+    ) -> None:
+        self.dst_keys = dst_keys
+        self.vp_keys = vp_keys
+        self.dst_id = dst_id
+        self.vp_id = vp_id
+        self.min_rtt = min_rtt
+        self.n_rtts = n_rtts
+        self.timestamp = timestamp
+        self.rtts = rtts
+        self.offsets = offsets
+        self.encoder = encoder or get_ip_encoder()
+        self.vp_field = vp_field
+
+    @property
+    def vp_is_address(self) -> bool:
+        return self.vp_field != "prb_id"
+
+    @property
+    def dst_addrs(self) -> list:
+        return self.encoder.decode_array(self.dst_keys)
+
+    @property
+    def vp_addrs(self) -> list:
+        if not self.vp_is_address:
+            return self.vp_keys.tolist()
+        return self.encoder.decode_array(self.vp_keys)
+
+    def decode_vp(self, vp_key: int):
+        return self.encoder.decode(vp_key) if self.vp_is_address else int(vp_key)
+
+    def vp_key(self, vp):
+        """key of a vp given as an address (or probe id), None if never encoded"""
+        if isinstance(vp, str):
+            return self.encoder.lookup(vp) if self.vp_is_address else None
+        return vp
+
+    def dst_key(self, dst_addr):
+        return self.encoder.lookup(dst_addr) if isinstance(dst_addr, str) else dst_addr
+
+    def __len__(self) -> int:
+        return len(self.dst_id)
+
+    def rtt_list(self, row: int) -> np.ndarray:
+        return self.rtts[self.offsets[row] : self.offsets[row + 1]]
+
+    def take(self, rows: np.ndarray) -> "PingTable":
+        """new table made of rows, in this order"""
+        n_rtts = self.n_rtts[rows]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(n_rtts, out=offsets[1:])
+
+        # position of each rtt of the selected rows in the current rtt buffer
+        rtt_rows = np.repeat(np.arange(len(rows)), n_rtts)
+        rtt_index = self.offsets[rows][rtt_rows] + (
+            np.arange(offsets[-1]) - offsets[:-1][rtt_rows]
+        )
+
+        return PingTable(
+            self.dst_keys,
+            self.vp_keys,
+            self.dst_id[rows],
+            self.vp_id[rows],
+            self.min_rtt[rows],
+            n_rtts,
+            self.timestamp[rows],
+            self.rtts[rtt_index],
+            offsets,
+            self.encoder,
+            self.vp_field,
+        )
+
+    def deduplicate(self) -> "PingTable":
+        """
+        keep only the last row of each (destination, vp) pair,
+        at the position of the first one (as when overwriting a dict entry)
+        """
+        pair = self.dst_id.astype(np.int64) * max(len(self.vp_keys), 1) + self.vp_id
+        _, first, inverse = np.unique(pair, return_index=True, return_inverse=True)
+        last = np.zeros(len(first), dtype=np.int64)
+        np.maximum.at(last, inverse.ravel(), np.arange(len(pair)))
+        rows = last[np.argsort(first)]
+
+        if len(rows) == len(self):
+            return self
+
+        return self.take(rows)
+
+    def sort_by_destination(self) -> "PingTable":
+        """rows grouped by destination, by increasing min rtt within a destination"""
+        return self.take(np.lexsort((self.min_rtt, self.dst_id)))
+
+    def destination_bounds(self) -> Iterator[tuple]:
+        """yield (dst_id, start, stop) of each destination rows, table must be sorted"""
+        if not len(self):
+            return
+
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(self.dst_id)) + 1))
+        stops = np.concatenate((starts[1:], [len(self)]))
+        for start, stop in zip(starts.tolist(), stops.tolist()):
+            yield int(self.dst_id[start]), start, stop
+
+    def as_dict(self) -> "PingResultsView":
+        """read only view with the dict of dict layout of parse_measurements_results, see to_dict"""
+        return PingResultsView(self.deduplicate().sort_by_destination())
+
+
+class PingTableBuilder(object):
+    """append ping results one by one into growable typed buffers"""
+
+    def __init__(self, vp_field: str = "from", encoder: IPEncoder = None) -> None:
+        self.vp_field = vp_field
+        self.encoder = encoder or get_ip_encoder()
+
+        # addresses are only encoded the first time they are seen
+        self._dst_ids = {}
+        self._vp_ids = {}
+        self.dst_index = {}
+        self.vp_index = {}
+
+        self.dst_id = array.array("i")
+        self.vp_id = array.array("i")
+        self.min_rtt = array.array("d")
+        self.n_rtts = array.array("i")
+        self.timestamp = array.array("q")
+        self.rtts = array.array("d")
+
+    def _get_id(self, value, ids: dict, index: dict, is_address: bool) -> int:
+        dense_id = ids.get(value)
+        if dense_id is None:
+            key = self.encoder.encode(value) if is_address else int(value)
+            # different spellings of an IPv6 address share the same key
+            dense_id = ids[value] = index.setdefault(key, len(index))
+
+        return dense_id
+
+    def add(self, result: dict) -> bool:
+        """append one result, return False if it has no usable rtt"""
+        if result.get("result") is None:
+            logger.warning(f"no results: {result}")
+            return False
+
+        rtt_list = get_rtts(result)
+        if rtt_list is None:
+            return False
+
+        try:
+            dst_id = self._get_id(result["dst_addr"], self._dst_ids, self.dst_index, True)
+            vp_id = self._get_id(
+                result[self.vp_field],
+                self._vp_ids,
+                self.vp_index,
+                self.vp_field != "prb_id",
+            )
+        except (ValueError, OSError):
+            logger.debug(f"malformed address: {result}")
+            return False
+
+        self.dst_id.append(dst_id)
+        self.vp_id.append(vp_id)
+        self.min_rtt.append(min(rtt_list))
+        self.n_rtts.append(len(rtt_list))
+        self.timestamp.append(result.get("timestamp", 0))
+        self.rtts.extend(rtt_list)
+
+        return True
+
+    def extend(self, results: Iterable[dict]) -> "PingTableBuilder":
+        for result in results:
+            self.add(result)
+        return self
+
+    def build(self) -> PingTable:
+        n_rtts = np.frombuffer(self.n_rtts, dtype=np.int32).astype(np.int64)
+        offsets = np.zeros(len(n_rtts) + 1, dtype=np.int64)
+        np.cumsum(n_rtts, out=offsets[1:])
+
+        return PingTable(
+            dst_keys=np.fromiter(self.dst_index, dtype=KEY_DTYPE, count=len(self.dst_index)),
+            vp_keys=np.fromiter(self.vp_index, dtype=KEY_DTYPE, count=len(self.vp_index)),
+            dst_id=np.array(self.dst_id, dtype=np.int32),
+            vp_id=np.array(self.vp_id, dtype=np.int32),
+            min_rtt=np.array(self.min_rtt, dtype=np.float64),
+            n_rtts=n_rtts.astype(np.int32),
+            timestamp=np.array(self.timestamp, dtype=np.int64),
+            rtts=np.array(self.rtts, dtype=np.float64),
+            offsets=offsets,
+            encoder=self.encoder,
+            vp_field=self.vp_field,
+        )
+
+
+def parse_ping_results(results: Iterable[dict], vp_field: str = "from") -> PingTable:
+    """parse ping results in a single pass into a PingTable"""
+    return PingTableBuilder(vp_field=vp_field).extend(results).build()
+
+
+class DestinationView(Mapping):
+    """
+    ping results towards one destination: vp addr -> {node, min_rtt, rtt_list},
+    vps can also be looked up by their encoded key
+    """
+
+    def __init__(self, table: PingTable, start: int, stop: int) -> None:
+        self._table = table
+        self._start = start
+        self._stop = stop
+        self._rows = None
+
+    def _get_rows(self) -> dict:
+        if self._rows is None:
+            vp_keys = self._table.vp_keys[self._table.vp_id[self._start : self._stop]]
+            self._rows = {
+                vp_key: row for row, vp_key in enumerate(vp_keys.tolist(), self._start)
+            }
+        return self._rows
+
+    def __getitem__(self, vp_addr) -> dict:
+        row = self._get_rows()[self._table.vp_key(vp_addr)]
+
+        return {
+            "node": vp_addr if isinstance(vp_addr, str) else self._table.decode_vp(vp_addr),
+            "min_rtt": self._table.min_rtt[row].item(),
+            "rtt_list": self._table.rtt_list(row).tolist(),
+        }
+
+    def __contains__(self, vp_addr) -> bool:
+        return self._table.vp_key(vp_addr) in self._get_rows()
+
+    def keys_encoded(self) -> np.ndarray:
+        """vp keys by increasing min rtt"""
+        return self._table.vp_keys[self._table.vp_id[self._start : self._stop]]
+
+    def __iter__(self) -> Iterator:
+        # vps by increasing min rtt, decoded only when iterated
+        for vp_key in self.keys_encoded().tolist():
+            yield self._table.decode_vp(vp_key)
+
+    def __len__(self) -> int:
+        return self._stop - self._start
+
+    def to_dict(self) -> dict:
+        """plain dict of the results, json serializable"""
+        return {vp_addr: self[vp_addr] for vp_addr in self}
+
+
+class PingResultsView(Mapping):
+    """
+    dst addr -> DestinationView, rows are only turned into dicts when accessed,
+    destinations can also be looked up by their encoded key
+    """
+
+    def __init__(self, table: PingTable) -> None:
+        self.table = table
+        self._bounds = {
+            table.dst_keys[dst_id].item(): (start, stop)
+            for dst_id, start, stop in table.destination_bounds()
+        }
+
+    def __getitem__(self, dst_addr) -> DestinationView:
+        start, stop = self._bounds.get(self.table.dst_key(dst_addr), (0, 0))
+
+        # like a defaultdict, an unknown destination has no results
+        return DestinationView(self.table, start, stop)
+
+    def __contains__(self, dst_addr) -> bool:
+        return self.table.dst_key(dst_addr) in self._bounds
+
+    def get(self, dst_addr, default=None):
+        return self[dst_addr] if dst_addr in self else default
+
+    def keys_encoded(self) -> list:
+        return list(self._bounds)
+
+    def __iter__(self) -> Iterator:
+        for dst_key in self._bounds:
+            yield self.table.encoder.decode(dst_key)
+
+    def __len__(self) -> int:
+        return len(self._bounds)
+
+    def to_dict(self) -> dict:
+        """plain dict of dicts of all the results, json serializable (dump_json)"""
+        return {dst_addr: self[dst_addr].to_dict() for dst_addr in self}
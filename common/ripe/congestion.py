@@ -0,0 +1,181 @@
+"""Congestion control of the HTTP client: AIMD concurrency window and per endpoint circuit breakers"""
+import re
+import threading
+import time
+
+from urllib.parse import urlsplit
+
+import requests
+
+from common.logger_config import logger
+
+# concurrency window
+DEFAULT_INITIAL_LIMIT: float = 8
+DEFAULT_MIN_LIMIT: float = 1
+DEFAULT_INCREASE: float = 1  # requests added per window of successful requests
+DEFAULT_DECREASE: float = 0.5  # window factor after an overload signal
+
+# a request slower than this factor times the fastest one stops the window growth
+DEFAULT_LATENCY_TOLERANCE: float = 3
+LATENCY_SMOOTHING: float = 0.2
+
+# circuit breaker
+DEFAULT_FAILURE_THRESHOLD: int = 5
+DEFAULT_COOLDOWN: float = 5
+DEFAULT_MAX_COOLDOWN: float = 120
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """an endpoint failed too many times in a row, requests are not sent for a while"""
+
+    def __init__(self, endpoint: str, retry_in: float) -> None:
+        super().__init__(f"circuit open for {endpoint}, retry in {retry_in:.1f}s")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+class AdaptiveLimiter(object):
+    """
+    limit the number of requests in flight with an AIMD window:
+    it grows by increase for each window of fast successful requests
+    and is multiplied by decrease (at most once per round trip) on overload
+    """
+
+    def __init__(
+        self,
+        max_limit: float,
+        initial_limit: float = DEFAULT_INITIAL_LIMIT,
+        min_limit: float = DEFAULT_MIN_LIMIT,
+        increase: float = DEFAULT_INCREASE,
+        decrease: float = DEFAULT_DECREASE,
+        latency_tolerance: float = DEFAULT_LATENCY_TOLERANCE,
+    ) -> None:
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = min(initial_limit, max_limit)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+
+        self.in_flight = 0
+        self.min_latency = None
+        self.latency = None
+        self.nb_decreases = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        """wait for a free slot in the window"""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency: float, overloaded: bool) -> None:
+        """free a slot and adapt the window to the outcome of the request"""
+        with self._condition:
+            self.in_flight -= 1
+
+            if overloaded:
+                # requests sent before the last decrease carry the same signal
+                now = time.monotonic()
+                if now - self._last_decrease > (self.latency or 0):
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self._last_decrease = now
+                    self.nb_decreases += 1
+                    logger.debug(f"concurrency window decreased to {self.limit:.1f}")
+            else:
+                self.latency = (
+                    latency
+                    if self.latency is None
+                    else (1 - LATENCY_SMOOTHING) * self.latency
+                    + LATENCY_SMOOTHING * latency
+                )
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+
+                # queueing on the server side: hold the window
+                if self.latency <= self.latency_tolerance * self.min_latency:
+                    self.limit = min(
+                        self.max_limit, self.limit + self.increase / self.limit
+                    )
+
+            self._condition.notify_all()
+
+    def __str__(self) -> str:
+        return f"window: {self.limit:.1f} | in flight: {self.in_flight} | decreases: {self.nb_decreases}"
+
+
+class CircuitBreaker(object):
+    """
+    stop sending requests to an endpoint after threshold consecutive failures,
+    let a single request through once the cooldown is over (half open)
+    and close the circuit again if it succeeds, otherwise double the cooldown
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+        cooldown: float = DEFAULT_COOLDOWN,
+        max_cooldown: float = DEFAULT_MAX_COOLDOWN,
+    ) -> None:
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+        self.failures = 0
+        self.open_until = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_request(self) -> bool:
+        """
+        raise CircuitOpenError if the request must not be sent,
+        return True if the request is the trial of a half open circuit
+        """
+        with self._lock:
+            if self.open_until is None:
+                return False
+
+            retry_in = self.open_until - time.monotonic()
+            if retry_in > 0 or self._trial_in_flight:
+                raise CircuitOpenError(self.endpoint, max(retry_in, 0.1))
+
+            self._trial_in_flight = True
+            return True
+
+    def after_request(self, success: bool, is_trial: bool = False) -> None:
+        with self._lock:
+            if is_trial:
+                self._trial_in_flight = False
+
+            if success:
+                if self.open_until is not None:
+                    logger.info(f"circuit closed for {self.endpoint}")
+                self.failures = 0
+                self.open_until = None
+                self.cooldown = self.base_cooldown
+                return
+
+            self.failures += 1
+            if is_trial:
+                # endpoint still failing, wait longer before the next trial
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            elif self.open_until is not None or self.failures < self.failure_threshold:
+                return
+
+            self.open_until = time.monotonic() + self.cooldown
+            logger.warning(
+                f"circuit open for {self.endpoint} after {self.failures} failures ({self.cooldown:.0f}s)"
+            )
+
+
+def get_endpoint(url: str) -> str:
+    """group urls by endpoint: host and path with ids replaced"""
+    url = urlsplit(url)
+    path = re.sub(r"/\d+(?=/|$)", "/{id}", url.path)
+
+    return f"{url.netloc}{path}"
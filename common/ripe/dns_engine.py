@@ -0,0 +1,332 @@
+"""Decode the DNS results of Atlas measurements into a hostname x vp -> answer set table"""
+import base64
+import binascii
+import hashlib
+import socket
+import struct
+import threading
+
+from collections import OrderedDict
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from common.ripe.bulk_fetcher import (
+    DEFAULT_CONCURRENCY,
+    iter_measurement_results,
+    run_coroutine,
+)
+from common.ripe.records import DnsAnswer
+from common.logger_config import logger
+
+TYPE_A: int = 1
+TYPE_CNAME: int = 5
+TYPE_AAAA: int = 28
+
+# a name can not have more labels, bounds compression pointer loops
+MAX_LABELS: int = 128
+
+# decoded answers kept in memory
+DEFAULT_MAX_DECODED: int = 100_000
+
+_HEADER = struct.Struct("!HHHHHH")
+_RR = struct.Struct("!HHIH")
+
+
+class DnsParseError(ValueError):
+    """a DNS payload is truncated or malformed"""
+
+
+def read_name(payload: bytes, offset: int) -> tuple:
+    """(lowercase name, offset after the name), compression pointers are followed"""
+    labels = []
+    end = None
+    for _ in range(MAX_LABELS):
+        length = payload[offset]
+        if length & 0xC0 == 0xC0:
+            # pointer: the name continues elsewhere, it ends here for the caller
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | payload[offset + 1]
+            continue
+
+        offset += 1
+        if not length:
+            break
+
+        labels.append(payload[offset : offset + length].decode("ascii", "replace"))
+        offset += length
+    else:
+        raise DnsParseError("name too long or pointer loop")
+
+    return ".".join(labels).lower(), end if end is not None else offset
+
+
+def parse_message(payload: bytes) -> tuple:
+    """
+    (qname, rcode, addresses, cnames) of a DNS response in wire format,
+    addresses is the frozenset of the A and AAAA records of the answer section
+    """
+    try:
+        _, flags, qdcount, ancount, _, _ = _HEADER.unpack_from(payload, 0)
+        offset = _HEADER.size
+
+        qname = None
+        for _ in range(qdcount):
+            name, offset = read_name(payload, offset)
+            qname = qname or name
+            # qtype, qclass
+            offset += 4
+
+        addresses = []
+        cnames = []
+        for _ in range(ancount):
+            _, offset = read_name(payload, offset)
+            rr_type, _, _, rdlength = _RR.unpack_from(payload, offset)
+            offset += _RR.size
+            if offset + rdlength > len(payload):
+                raise DnsParseError("truncated answer section")
+
+            if rr_type == TYPE_A and rdlength == 4:
+                addresses.append(socket.inet_ntoa(payload[offset : offset + 4]))
+            elif rr_type == TYPE_AAAA and rdlength == 16:
+                addresses.append(
+                    socket.inet_ntop(socket.AF_INET6, payload[offset : offset + 16])
+                )
+            elif rr_type == TYPE_CNAME:
+                cnames.append(read_name(payload, offset)[0])
+            offset += rdlength
+    except DnsParseError:
+        raise
+    except (struct.error, IndexError, OSError, ValueError) as e:
+        # inet_ntoa raises OSError and inet_ntop ValueError on short addresses
+        raise DnsParseError(f"truncated payload: {e}")
+
+    return qname, flags & 0xF, frozenset(addresses), tuple(cnames)
+
+
+class AbufDecoder(object):
+    """
+    decode base64 abuf payloads, decoded answers are cached by payload hash,
+    the message id (2 first bytes) differs for each query and is left out of the hash
+    """
+
+    def __init__(self, max_decoded: int = DEFAULT_MAX_DECODED) -> None:
+        self.max_decoded = max_decoded
+        self._decoded = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def decode(self, abuf: str) -> tuple:
+        """parse_message of an abuf, None if it can not be decoded"""
+        try:
+            payload = base64.b64decode(abuf)
+        except (binascii.Error, ValueError):
+            self.errors += 1
+            return None
+
+        digest = hashlib.blake2b(payload[2:], digest_size=16).digest()
+        with self._lock:
+            message = self._decoded.get(digest)
+            if message is not None:
+                self._decoded.move_to_end(digest)
+                self.hits += 1
+                return message
+
+        try:
+            message = parse_message(payload)
+        except DnsParseError as e:
+            logger.debug(f"could not decode abuf {abuf}: {e}")
+            self.errors += 1
+            return None
+
+        with self._lock:
+            self.misses += 1
+            self._decoded[digest] = message
+            if len(self._decoded) > self.max_decoded:
+                self._decoded.popitem(last=False)
+
+        return message
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "errors": self.errors}
+
+
+_abuf_decoder: AbufDecoder = None
+_abuf_decoder_lock = threading.Lock()
+
+
+def get_abuf_decoder() -> AbufDecoder:
+    """return the process wide abuf decoder, create it on first use"""
+    global _abuf_decoder
+
+    if _abuf_decoder is None:
+        with _abuf_decoder_lock:
+            if _abuf_decoder is None:
+                _abuf_decoder = AbufDecoder()
+
+    return _abuf_decoder
+
+
+def iter_dns_answers(
+    results: Iterable[dict], decoder: AbufDecoder = None
+) -> Iterator[tuple]:
+    """
+    yield (hostname, DnsAnswer) for each decoded answer of DNS results,
+    results of probe resolvers (resultset) give one answer per resolver
+    """
+    decoder = decoder or get_abuf_decoder()
+    for result in results:
+        for answer in result.get("resultset") or [result]:
+            abuf = (answer.get("result") or {}).get("abuf")
+            if not abuf:
+                # timeout or error, nothing was answered
+                continue
+
+            message = decoder.decode(abuf)
+            if message is None:
+                continue
+
+            qname, _, addresses, _ = message
+            if answer is not result:
+                answer = {**result, **answer}
+
+            yield qname, DnsAnswer.from_atlas(answer, addresses)
+
+
+class DnsAnswerTable(object):
+    """
+    one row per (hostname, vp): hostname_id indexes hostnames,
+    answer_set_id indexes answer_sets, each distinct answer set is stored once
+    """
+
+    def __init__(
+        self,
+        hostnames: list,
+        answer_sets: list,
+        hostname_id: np.ndarray,
+        prb_id: np.ndarray,
+        answer_set_id: np.ndarray,
+    ) -> None:
+        self.hostnames = hostnames
+        self.answer_sets = answer_sets
+        self.hostname_id = hostname_id
+        self.prb_id = prb_id
+        self.answer_set_id = answer_set_id
+        self._hostname_ids = {hostname: i for i, hostname in enumerate(hostnames)}
+
+    def __len__(self) -> int:
+        return len(self.prb_id)
+
+    def _rows(self, hostname: str) -> np.ndarray:
+        hostname_id = self._hostname_ids.get(hostname.lower().rstrip("."))
+        if hostname_id is None:
+            return np.empty(0, dtype=np.int64)
+        return np.flatnonzero(self.hostname_id == hostname_id)
+
+    def get_answers(self, hostname: str) -> dict:
+        """prb id -> answer set of a hostname"""
+        rows = self._rows(hostname)
+
+        return {
+            prb_id: self.answer_sets[answer_set_id]
+            for prb_id, answer_set_id in zip(
+                self.prb_id[rows].tolist(), self.answer_set_id[rows].tolist()
+            )
+        }
+
+    def get_replicas(self, hostname: str) -> dict:
+        """answered address -> prb ids of the vps it was given to, for replica mapping"""
+        replicas = {}
+        for prb_id, answers in self.get_answers(hostname).items():
+            for addr in answers:
+                replicas.setdefault(addr, []).append(prb_id)
+
+        return replicas
+
+    def as_dict(self) -> dict:
+        """hostname -> prb id -> sorted answers, json serializable"""
+        return {
+            hostname: {
+                str(prb_id): sorted(answers)
+                for prb_id, answers in self.get_answers(hostname).items()
+            }
+            for hostname in self.hostnames
+        }
+
+
+class DnsAnswerTableBuilder(object):
+    """
+    append answers one by one, answer sets are interned,
+    answers of a vp for the same hostname (several resolvers or runs) are merged
+    """
+
+    def __init__(self) -> None:
+        self.hostnames = {}
+        self.answer_sets = []
+        self._answer_set_ids = {}
+        self.rows = {}
+
+    def _intern(self, answers: frozenset) -> int:
+        answer_set_id = self._answer_set_ids.get(answers)
+        if answer_set_id is None:
+            answer_set_id = self._answer_set_ids[answers] = len(self.answer_sets)
+            self.answer_sets.append(answers)
+
+        return answer_set_id
+
+    def add(self, hostname: str, prb_id: int, answers: Iterable[str]) -> None:
+        hostname_id = self.hostnames.setdefault(hostname, len(self.hostnames))
+        key = (hostname_id, prb_id)
+        answers = frozenset(answers)
+
+        answer_set_id = self.rows.get(key)
+        if answer_set_id is not None:
+            answers |= self.answer_sets[answer_set_id]
+        self.rows[key] = self._intern(answers)
+
+    def extend(self, answers: Iterable[tuple]) -> "DnsAnswerTableBuilder":
+        """add (hostname, DnsAnswer) as yielded by iter_dns_answers"""
+        for hostname, answer in answers:
+            self.add(hostname, answer.prb_id, answer.answers)
+        return self
+
+    def build(self) -> DnsAnswerTable:
+        keys = list(self.rows)
+
+        return DnsAnswerTable(
+            hostnames=list(self.hostnames),
+            answer_sets=list(self.answer_sets),
+            hostname_id=np.array([key[0] for key in keys], dtype=np.int32),
+            prb_id=np.array([key[1] for key in keys], dtype=np.uint32),
+            answer_set_id=np.fromiter(self.rows.values(), dtype=np.int32, count=len(keys)),
+        )
+
+
+def get_dns_answer_table(
+    measurement_ids: Iterable[int],
+    max_concurrency: int = DEFAULT_CONCURRENCY,
+    probe_ids: Iterable[int] = None,
+    decoder: AbufDecoder = None,
+) -> DnsAnswerTable:
+    """
+    download DNS measurement results in bulk and decode them into a table,
+    each measurement results are decoded as soon as downloaded and dropped right after
+    """
+    decoder = decoder or get_abuf_decoder()
+    builder = DnsAnswerTableBuilder()
+
+    async def decode() -> None:
+        async for _, results in iter_measurement_results(
+            measurement_ids, max_concurrency=max_concurrency, probe_ids=probe_ids
+        ):
+            builder.extend(iter_dns_answers(results, decoder))
+
+    run_coroutine(decode())
+
+    logger.info(f"abuf decoder: {decoder.stats()}")
+
+    return builder.build()
@@ -0,0 +1,207 @@
+"""Split measurements over too many vantage points into chunks submitted concurrently"""
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from common.ledger import STATUS_PARTIAL, STATUS_SUBMITTED
+from common.ripe.http_client import get_client
+from common.ripe.reuse import MeasurementReuseIndex, get_reuse_index, get_reuse_key
+from common.ripe.scheduler import QuotaExceededError
+from common.ripe.utils import MEASUREMENTS_URL
+from common.logger_config import logger
+
+# largest number of probes Atlas accepts for one measurement
+MAX_PROBES_PER_MEASUREMENT: int = 1000
+DEFAULT_WORKERS: int = 8
+
+# failed chunks are submitted again this many times
+DEFAULT_CHUNK_RETRY: int = 2
+
+# words of Atlas error details refusing a submission for one of our quotas
+# (concurrent measurements, measurements per target, daily spending, credits)
+QUOTA_ERROR_KEYWORDS: tuple = ("concurrent", "quota", "same target", "credit", "daily")
+
+
+def chunk_vps(vps: list, chunk_size: int = MAX_PROBES_PER_MEASUREMENT) -> list:
+    """split vps into chunks small enough for one measurement"""
+    vps = list(dict.fromkeys(vps))
+
+    return [vps[i : i + chunk_size] for i in range(0, len(vps), chunk_size)]
+
+
+def post_definitions(definitions: list, vps: list, key: str, account: str):
+    """post one-off measurement definitions, all performed by vps"""
+    return get_client().post(
+        f"{MEASUREMENTS_URL}?key={key}",
+        json={
+            "definitions": definitions,
+            "probes": [{"value": vp, "type": "probes", "requested": 1} for vp in vps],
+            "is_oneoff": True,
+            "bill_to": account,
+        },
+    )
+
+
+def get_error_detail(response) -> str:
+    """error details of a refused submission, the raw body if it is not an Atlas error"""
+    try:
+        error = response.json()["error"]
+    except (ValueError, KeyError, TypeError):
+        return response.text
+
+    details = [error.get("detail") or ""] + [
+        sub_error.get("detail") or "" for sub_error in error.get("errors") or []
+    ]
+
+    return " ".join(detail for detail in details if detail) or response.text
+
+
+def is_quota_refusal(response) -> bool:
+    """a submission refused because a quota is reached, not because of its definitions"""
+    if response.status_code not in (400, 403, 429):
+        return False
+
+    detail = get_error_detail(response).lower()
+
+    return response.status_code == 429 or any(
+        keyword in detail for keyword in QUOTA_ERROR_KEYWORDS
+    )
+
+
+def fan_out_outcomes(submit, chunks: list, max_workers: int = DEFAULT_WORKERS) -> list:
+    """call submit on each chunk concurrently, return its result or exception in chunks order"""
+    if not chunks:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+        futures = [executor.submit(submit, chunk) for chunk in chunks]
+
+    outcomes = []
+    for future in futures:
+        try:
+            outcomes.append(future.result())
+        except Exception as e:
+            outcomes.append(e)
+
+    return outcomes
+
+
+def fan_out(submit, chunks: list, max_workers: int = DEFAULT_WORKERS) -> list:
+    """call submit on each chunk concurrently, return results in chunks order"""
+    if len(chunks) <= 1:
+        return [submit(chunk) for chunk in chunks]
+
+    results = []
+    errors = []
+    for outcome in fan_out_outcomes(submit, chunks, max_workers):
+        if isinstance(outcome, Exception):
+            results.append(None)
+            errors.append(outcome)
+        else:
+            results.append(outcome)
+
+    if errors:
+        submitted = [result for result in results if result is not None]
+        logger.error(
+            f"{len(errors)}/{len(chunks)} chunks failed, submitted chunks: {submitted}"
+        )
+        raise errors[0]
+
+    return results
+
+
+def submit_measurement(
+    definition: dict,
+    vps: list,
+    key: str,
+    account: str,
+    tag: str = None,
+    reuse_index: MeasurementReuseIndex = None,
+    chunk_size: int = MAX_PROBES_PER_MEASUREMENT,
+    max_workers: int = DEFAULT_WORKERS,
+    max_retry: int = DEFAULT_CHUNK_RETRY,
+) -> int:
+    """
+    submit one measurement from vps, split in chunks of at most chunk_size vps
+    submitted concurrently, return the id of the logical measurement.
+    Each accepted chunk is recorded at once and only failed chunks are retried,
+    a submission interrupted by an error is completed by the next identical call.
+    Results of all chunks are merged under this id by the bulk fetcher
+    """
+    reuse_index = reuse_index or get_reuse_index()
+    ledger = reuse_index.ledger
+    chunks = chunk_vps(vps, chunk_size)
+    reuse_key = get_reuse_key(definition, vps)
+
+    def submit_chunk(chunk: list) -> int:
+        response = post_definitions([definition], chunk, key, account)
+        if response.ok:
+            return response.json()["measurements"][0]
+
+        if is_quota_refusal(response):
+            raise QuotaExceededError(get_error_detail(response))
+        raise RuntimeError(
+            f"measurement submission failed ({response.status_code}): {get_error_detail(response)}"
+        )
+
+    # the first chunk is the logical measurement, the other chunks hang on its id
+    partial = ledger.find_partial(reuse_key)
+    if partial is None:
+        measurement_id = submit_chunk(chunks[0])
+        ledger.record(
+            measurement_id,
+            definition,
+            vps,
+            tag,
+            status=STATUS_PARTIAL if len(chunks) > 1 else STATUS_SUBMITTED,
+            reuse_key=reuse_key,
+        )
+        submitted = set()
+    else:
+        measurement_id = partial["measurement_id"]
+        submitted = {
+            tuple(ledger.get(chunk_id)["vps"])
+            for chunk_id in ledger.get_chunks([measurement_id]).get(measurement_id, [])
+        }
+        logger.info(f"completing the submission of measurement {measurement_id}")
+
+    def submit_and_record(chunk: list) -> int:
+        chunk_id = submit_chunk(chunk)
+        ledger.record(chunk_id, definition, chunk, tag, parent_id=measurement_id)
+        return chunk_id
+
+    remaining = [chunk for chunk in chunks[1:] if tuple(chunk) not in submitted]
+    for attempt in range(max_retry + 1):
+        if not remaining:
+            break
+
+        outcomes = fan_out_outcomes(submit_and_record, remaining, max_workers)
+        failed = [
+            (chunk, outcome)
+            for chunk, outcome in zip(remaining, outcomes)
+            if isinstance(outcome, Exception)
+        ]
+        if not failed:
+            break
+
+        logger.warning(
+            f"measurement {measurement_id}: {len(failed)}/{len(remaining)} chunks failed"
+        )
+        error = failed[0][1]
+        # refused for quota: retried once capacity frees up, by the next identical call
+        if attempt == max_retry or any(
+            isinstance(outcome, QuotaExceededError) for _, outcome in failed
+        ):
+            raise error
+
+        remaining = [chunk for chunk, _ in failed]
+        time.sleep(2**attempt)
+
+    if len(chunks) > 1:
+        # all chunks accepted, the measurement can be waited for and reused
+        ledger.update_status(measurement_id, STATUS_SUBMITTED)
+        logger.info(
+            f"measurement {measurement_id} split in {len(chunks)} chunks over {len(vps)} vps"
+        )
+
+    return measurement_id
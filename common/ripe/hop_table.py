@@ -0,0 +1,248 @@
+"""Typed columnar table of traceroute hop replies, built in chunks and exported to CSV by streaming"""
+import array
+
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from common.ripe.ip_encoding import (
+    IPEncoder,
+    KEY_DTYPE,
+    KEY_TYPECODE,
+    NO_ADDRESS,
+    get_ip_encoder,
+    get_prefix,
+)
+from common.logger_config import logger
+
+PROTOCOLS: dict = {"ICMP": 1, "TCP": 6, "UDP": 17}
+
+# rows per chunk when traceroutes are streamed
+DEFAULT_CHUNK_ROWS: int = 1 << 20
+
+# column name, array.array typecode while building, numpy dtype once built
+COLUMNS: list = [
+    ("src_addr", KEY_TYPECODE, KEY_DTYPE),
+    ("dst_prefix", KEY_TYPECODE, KEY_DTYPE),
+    ("dst_addr", KEY_TYPECODE, KEY_DTYPE),
+    ("reply_addr", KEY_TYPECODE, KEY_DTYPE),
+    ("proto", "B", np.uint8),
+    ("hop", "B", np.uint8),
+    ("rtt", "f", np.float32),
+    ("ttl", "B", np.uint8),
+    ("prb_id", "I", np.uint32),
+    ("msm_id", "I", np.uint32),
+    ("timestamp", "q", np.int64),
+]
+
+ADDRESS_COLUMNS: set = {"src_addr", "dst_prefix", "dst_addr", "reply_addr"}
+
+# csv layout of ripe_traceroute_to_csv rows
+CSV_HEADER: str = "src,dst_prefix,dst,reply,proto,hop,rtt,ttl,prb_id,msm_id,timestamp"
+
+
+class HopTable(object):
+    """
+    one row per hop reply, one numpy array per column,
+    addresses are encoded with the table encoder (NO_ADDRESS for unanswered probes)
+    """
+
+    def __init__(self, columns: dict, encoder: IPEncoder) -> None:
+        self.columns = columns
+        self.encoder = encoder
+
+    def __len__(self) -> int:
+        return len(self.columns["hop"])
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.columns[column]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(values.nbytes for values in self.columns.values())
+
+    @classmethod
+    def empty(cls, encoder: IPEncoder = None) -> "HopTable":
+        return cls(
+            {name: np.empty(0, dtype=dtype) for name, _, dtype in COLUMNS},
+            encoder or get_ip_encoder(),
+        )
+
+    @classmethod
+    def concatenate(cls, tables: list, encoder: IPEncoder = None) -> "HopTable":
+        """one table with the rows of tables, addresses translated into a common encoder"""
+        tables = list(tables)
+        if not tables:
+            return cls.empty(encoder)
+
+        encoder = encoder or tables[0].encoder
+        columns = {}
+        for name, _, _ in COLUMNS:
+            values = [table.columns[name] for table in tables]
+            if name in ADDRESS_COLUMNS:
+                values = [
+                    encoder.translate(column, table.encoder)
+                    for column, table in zip(values, tables)
+                ]
+            columns[name] = np.concatenate(values)
+
+        return cls(columns, encoder)
+
+
+class HopTableBuilder(object):
+    """append the hop replies of traceroutes into typed buffers, without copying the dicts"""
+
+    def __init__(self, encoder: IPEncoder = None) -> None:
+        self.encoder = encoder or get_ip_encoder()
+        self._reset()
+
+    def _reset(self) -> None:
+        self._buffers = {name: array.array(typecode) for name, typecode, _ in COLUMNS}
+
+    def __len__(self) -> int:
+        return len(self._buffers["hop"])
+
+    def add(self, traceroute: dict) -> int:
+        """append all hop replies of a traceroute, return the number of rows added"""
+        try:
+            src_addr = self.encoder.encode(traceroute["from"])
+            dst_addr = traceroute["dst_addr"]
+            dst_prefix = self.encoder.encode(get_prefix(dst_addr, traceroute["af"]))
+            dst_addr = self.encoder.encode(dst_addr)
+            proto = PROTOCOLS[traceroute["proto"]]
+            prb_id = traceroute["prb_id"]
+            msm_id = traceroute["msm_id"]
+            timestamp = traceroute["timestamp"]
+        except (KeyError, ValueError, OSError):
+            return 0
+
+        buffers = self._buffers
+        nb_rows = 0
+        for hop in traceroute.get("result") or []:
+            for response in hop.get("result", []):
+                if not response or response.get("error"):
+                    continue
+
+                # unanswered probe: no reply address, rtt and ttl
+                if response.get("x") == "*" or not response.get("rtt"):
+                    reply_addr, rtt, ttl = NO_ADDRESS, 0, 0
+                else:
+                    try:
+                        reply_addr = self.encoder.encode(response["from"])
+                        rtt = float(response["rtt"])
+                        ttl = int(response["ttl"])
+                    except (KeyError, ValueError, TypeError, OSError):
+                        logger.debug(f"malformed hop reply: {response}")
+                        continue
+
+                # a row is appended to all columns or to none
+                hop_number = hop.get("hop")
+                if not (
+                    isinstance(hop_number, int) and 0 <= hop_number <= 255 and 0 <= ttl <= 255
+                ):
+                    logger.debug(f"hop or ttl out of range: {hop_number} {ttl}")
+                    continue
+
+                buffers["src_addr"].append(src_addr)
+                buffers["dst_prefix"].append(dst_prefix)
+                buffers["dst_addr"].append(dst_addr)
+                buffers["reply_addr"].append(reply_addr)
+                buffers["proto"].append(proto)
+                buffers["hop"].append(hop_number)
+                buffers["rtt"].append(rtt)
+                buffers["ttl"].append(ttl)
+                buffers["prb_id"].append(prb_id)
+                buffers["msm_id"].append(msm_id)
+                buffers["timestamp"].append(timestamp)
+                nb_rows += 1
+
+        return nb_rows
+
+    def build(self) -> HopTable:
+        """return the rows appended so far as a table and start a new chunk"""
+        table = HopTable(
+            {
+                name: np.frombuffer(self._buffers[name], dtype=dtype)
+                for name, _, dtype in COLUMNS
+            },
+            self.encoder,
+        )
+        self._reset()
+
+        return table
+
+
+def iter_hop_tables(
+    traceroutes: Iterable[dict],
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+    encoder: IPEncoder = None,
+) -> Iterator[HopTable]:
+    """yield hop tables of about chunk_rows rows while traceroutes are read"""
+    builder = HopTableBuilder(encoder)
+    for traceroute in traceroutes:
+        builder.add(traceroute)
+        if len(builder) >= chunk_rows:
+            yield builder.build()
+
+    if len(builder):
+        yield builder.build()
+
+
+def get_hop_table(traceroutes: Iterable[dict], encoder: IPEncoder = None) -> HopTable:
+    """hop table of all traceroutes"""
+    return HopTable.concatenate(
+        iter_hop_tables(traceroutes, encoder=encoder or get_ip_encoder())
+    )
+
+
+def _format_rtt(rtt: float) -> str:
+    """shortest text giving back the float32 rtt"""
+    return np.format_float_positional(rtt, trim="0")
+
+
+def iter_csv_rows(table: HopTable) -> Iterator[str]:
+    """yield each row of the table in ripe_traceroute_to_csv format"""
+    decode = table.encoder.decode
+    # python values are read once per column, not once per cell
+    columns = {
+        name: values if name == "rtt" else values.tolist()
+        for name, values in table.columns.items()
+    }
+    for i in range(len(table)):
+        reply_addr = columns["reply_addr"][i]
+        yield ",".join(
+            (
+                decode(columns["src_addr"][i]),
+                decode(columns["dst_prefix"][i]),
+                decode(columns["dst_addr"][i]),
+                decode(reply_addr),
+                str(columns["proto"][i]),
+                str(columns["hop"][i]),
+                _format_rtt(columns["rtt"][i]) if reply_addr != NO_ADDRESS else "0",
+                str(columns["ttl"][i]),
+                str(columns["prb_id"][i]),
+                str(columns["msm_id"][i]),
+                str(columns["timestamp"][i]),
+            )
+        )
+
+
+def write_hops_csv(tables: Iterable[HopTable], path: Path, header: bool = True) -> int:
+    """stream hop tables (or chunks of one) into a csv file, return the number of rows"""
+    if isinstance(tables, HopTable):
+        tables = [tables]
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    nb_rows = 0
+    with path.open("w") as f:
+        if header:
+            f.write(CSV_HEADER + "\n")
+        for table in tables:
+            for row in iter_csv_rows(table):
+                f.write(row + "\n")
+                nb_rows += 1
+
+    return nb_rows
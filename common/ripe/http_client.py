@@ -0,0 +1,331 @@
+"""Shared HTTP transport used by every RIPE Atlas call (pooled keep-alive connections)"""
+import copy
+import threading
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from common.ripe.congestion import (
+    AdaptiveLimiter,
+    CircuitBreaker,
+    CircuitOpenError,
+    get_endpoint,
+)
+from common.logger_config import logger
+
+# transport defaults
+DEFAULT_POOL_SIZE: int = 32
+DEFAULT_TIMEOUT: tuple = (10, 300)  # (connect, read) in seconds
+DEFAULT_MAX_RETRY: int = 5
+DEFAULT_BACKOFF_FACTOR: float = 0.5
+DEFAULT_MAX_BACKOFF: float = 60
+
+RETRY_STATUS_CODES: set = {429, 500, 502, 503, 504}
+# a POST rejected with these codes was not processed, so it is safe to resend it
+POST_RETRY_STATUS_CODES: set = {429, 503}
+
+
+class ConnectionStats(object):
+    """thread safe counters of new vs reused connections"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.new_connections = 0
+        self.requests = 0
+        self.retries = 0
+        self.coalesced = 0
+
+    def incr(self, counter: str, value: int = 1) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + value)
+
+    @property
+    def reused_connections(self) -> int:
+        return self.checkouts - self.new_connections
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "coalesced": self.coalesced,
+            "new_connections": self.new_connections,
+            "reused_connections": self.reused_connections,
+        }
+
+    def __str__(self) -> str:
+        return " | ".join(f"{key}: {value}" for key, value in self.as_dict().items())
+
+
+class _CountingPoolMixin(object):
+    """count each connection checkout and each new connection opened by urllib3"""
+
+    stats: ConnectionStats = None
+
+    def _get_conn(self, timeout=None):
+        self.stats.incr("checkouts")
+        return super()._get_conn(timeout=timeout)
+
+    def _new_conn(self):
+        self.stats.incr("new_connections")
+        return super()._new_conn()
+
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    """HTTP adapter whose connection pools report to a ConnectionStats instance"""
+
+    def __init__(self, stats: ConnectionStats, **kwargs) -> None:
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": type(
+                "CountingHTTPConnectionPool",
+                (_CountingPoolMixin, HTTPConnectionPool),
+                {"stats": self.stats},
+            ),
+            "https": type(
+                "CountingHTTPSConnectionPool",
+                (_CountingPoolMixin, HTTPSConnectionPool),
+                {"stats": self.stats},
+            ),
+        }
+
+
+class _InFlightRequest(object):
+    """a GET being performed, waited for by identical concurrent GETs"""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class AtlasHTTPClient(object):
+    """
+    keep-alive HTTP client with one connection pool per host,
+    default timeouts and retry with exponential backoff on 5xx/429,
+    concurrent identical GETs share a single request.
+    The number of requests in flight follows an AIMD window driven by latency
+    and 429/5xx responses, endpoints failing repeatedly are paused (circuit breaker)
+    """
+
+    def __init__(
+        self,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        timeout: tuple = DEFAULT_TIMEOUT,
+        max_retry: int = DEFAULT_MAX_RETRY,
+        backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+        coalesce: bool = True,
+    ) -> None:
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retry = max_retry
+        self.backoff_factor = backoff_factor
+        self.coalesce = coalesce
+        self.stats = ConnectionStats()
+
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+        # the window never exceeds the number of pooled connections
+        self.limiter = AdaptiveLimiter(max_limit=pool_size)
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+
+        adapter = _CountingHTTPAdapter(
+            self.stats,
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=0,
+        )
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _backoff(self, attempt: int, response: requests.Response = None) -> float:
+        """time to wait before next attempt, honor Retry-After when given"""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                return min(float(retry_after), DEFAULT_MAX_BACKOFF)
+
+        return min(self.backoff_factor * (2**attempt), DEFAULT_MAX_BACKOFF)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """perform a request, retry on connection errors and on retryable status codes"""
+        kwargs.setdefault("timeout", self.timeout)
+        method = method.upper()
+        retry_status_codes = (
+            POST_RETRY_STATUS_CODES if method == "POST" else RETRY_STATUS_CODES
+        )
+
+        breaker = self._get_breaker(get_endpoint(url))
+        for attempt in range(self.max_retry + 1):
+            try:
+                is_trial = breaker.before_request()
+            except CircuitOpenError as e:
+                # nothing was sent, even a POST can wait for the circuit to close
+                if attempt == self.max_retry:
+                    raise
+                wait_time = min(e.retry_in, DEFAULT_MAX_BACKOFF)
+                logger.warning(f"{method} {url}: {e}")
+                self.stats.incr("retries")
+                time.sleep(wait_time)
+                continue
+
+            self.stats.incr("requests")
+            self.limiter.acquire()
+            start = time.monotonic()
+            overloaded = False
+            hold_slot = False
+            try:
+                response = self.session.request(method, url, **kwargs)
+                overloaded = response.status_code in RETRY_STATUS_CODES
+            except (requests.ConnectionError, requests.Timeout) as e:
+                overloaded = True
+                # a POST might have been processed, do not send it twice
+                if method == "POST" or attempt == self.max_retry:
+                    raise
+                wait_time = self._backoff(attempt)
+                logger.warning(f"{method} {url} failed ({e}), retry in {wait_time}s")
+            else:
+                if (
+                    response.status_code not in retry_status_codes
+                    or attempt == self.max_retry
+                ):
+                    # a streamed body is still downloading, its connection is busy
+                    hold_slot = bool(kwargs.get("stream"))
+                    return response
+                wait_time = self._backoff(attempt, response)
+                logger.warning(
+                    f"{method} {url} returned {response.status_code}, retry in {wait_time}s"
+                )
+                response.close()
+            finally:
+                # latency and errors adapt the concurrency window and the circuit
+                latency = time.monotonic() - start
+                if hold_slot:
+                    self._release_on_close(response, latency, overloaded)
+                else:
+                    self.limiter.release(latency, overloaded)
+                breaker.after_request(not overloaded, is_trial)
+
+            self.stats.incr("retries")
+            time.sleep(wait_time)
+
+    def _release_on_close(
+        self, response: requests.Response, latency: float, overloaded: bool
+    ) -> None:
+        """
+        free the window slot of a streamed response once it is closed,
+        the latency is still the one of the headers
+        """
+        close = response.close
+        released = threading.Lock()
+
+        def close_and_release() -> None:
+            try:
+                close()
+            finally:
+                # closing twice (with block then explicit close) frees one slot
+                if released.acquire(blocking=False):
+                    self.limiter.release(latency, overloaded)
+
+        response.close = close_and_release
+
+    def _get_breaker(self, endpoint: str) -> CircuitBreaker:
+        with self._breakers_lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(endpoint)
+            return self._breakers[endpoint]
+
+    @staticmethod
+    def _request_key(url: str, kwargs: dict) -> tuple:
+        """identify a GET by its full url (with encoded params) and its headers"""
+        params = kwargs.get("params")
+        if isinstance(params, dict):
+            params = sorted(params.items())
+
+        prepared = requests.Request(
+            "GET", url, params=params, headers=kwargs.get("headers")
+        ).prepare()
+
+        return prepared.url, tuple(sorted((kwargs.get("headers") or {}).items()))
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """
+        perform a GET, a GET identical to one already in flight waits for it
+        and receives a copy of its response instead of being sent again
+        """
+        # a streamed body can only be read once, it cannot be shared
+        if not self.coalesce or kwargs.get("stream"):
+            return self.request("GET", url, **kwargs)
+
+        key = self._request_key(url, kwargs)
+        with self._in_flight_lock:
+            in_flight = self._in_flight.get(key)
+            is_leader = in_flight is None
+            if is_leader:
+                in_flight = self._in_flight[key] = _InFlightRequest()
+
+        if not is_leader:
+            self.stats.incr("coalesced")
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return copy.copy(in_flight.response)
+
+        try:
+            in_flight.response = self.request("GET", url, **kwargs)
+            return in_flight.response
+        except BaseException as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+            in_flight.done.set()
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __str__(self):
+        return f"Atlas HTTP client ({self.stats} | {self.limiter})"
+
+
+_client: AtlasHTTPClient = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> AtlasHTTPClient:
+    """return the process wide HTTP client, create it on first use"""
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = AtlasHTTPClient()
+
+    return _client
+
+
+def configure_client(**kwargs) -> AtlasHTTPClient:
+    """replace the process wide HTTP client with a new configuration"""
+    global _client
+
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = AtlasHTTPClient(**kwargs)
+
+    return _client
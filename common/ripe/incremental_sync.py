@@ -0,0 +1,149 @@
+"""Incremental synchronisation of long running measurements results"""
+import json
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from common.ripe.bulk_fetcher import fetch_measurement_results
+from common.default import RESULTS_STORE_PATH
+from common.logger_config import logger
+
+# results can reach Atlas after newer ones (probes buffering results),
+# each sync goes back this many seconds before the high-water mark
+DEFAULT_OVERLAP: int = 15 * 60
+
+
+class ResultStore(object):
+    """
+    sqlite store of measurement results with one high-water timestamp per measurement,
+    a result is identified by (msm_id, prb_id, timestamp) so merging is idempotent
+    """
+
+    def __init__(self, path: Path = RESULTS_STORE_PATH) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS results (
+                    msm_id INTEGER NOT NULL,
+                    prb_id INTEGER NOT NULL,
+                    timestamp INTEGER NOT NULL,
+                    result TEXT NOT NULL,
+                    PRIMARY KEY (msm_id, prb_id, timestamp)
+                )
+                """
+            )
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cursors (
+                    msm_id INTEGER PRIMARY KEY,
+                    last_timestamp INTEGER NOT NULL,
+                    synced_at REAL NOT NULL
+                )
+                """
+            )
+
+    def get_cursor(self, measurement_id: int) -> int:
+        """return the timestamp of the newest stored result, None if nothing stored"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT last_timestamp FROM cursors WHERE msm_id = ?",
+                (measurement_id,),
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def merge(self, measurement_id: int, results: Iterable[dict]) -> list:
+        """insert results not stored yet, return them"""
+        new_results = []
+        last_timestamp = self.get_cursor(measurement_id)
+
+        with self._lock, self._db:
+            for result in results:
+                cursor = self._db.execute(
+                    "INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?)",
+                    (
+                        measurement_id,
+                        result["prb_id"],
+                        result["timestamp"],
+                        json.dumps(result),
+                    ),
+                )
+                if cursor.rowcount:
+                    new_results.append(result)
+
+                if last_timestamp is None or result["timestamp"] > last_timestamp:
+                    last_timestamp = result["timestamp"]
+
+            if last_timestamp is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO cursors VALUES (?, ?, ?)",
+                    (measurement_id, last_timestamp, time.time()),
+                )
+
+        return new_results
+
+    def iter_results(
+        self, measurement_id: int, start: int = None, stop: int = None
+    ) -> Iterator[dict]:
+        """yield stored results of a measurement by increasing timestamp"""
+        query = "SELECT result FROM results WHERE msm_id = ?"
+        params = [measurement_id]
+        if start is not None:
+            query += " AND timestamp >= ?"
+            params.append(start)
+        if stop is not None:
+            query += " AND timestamp <= ?"
+            params.append(stop)
+        query += " ORDER BY timestamp, prb_id"
+
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+
+        for (result,) in rows:
+            yield json.loads(result)
+
+
+def sync_measurements(
+    measurement_ids: Iterable[int],
+    store: ResultStore = None,
+    start: int = None,
+    overlap: int = DEFAULT_OVERLAP,
+) -> dict:
+    """
+    download only results newer than each measurement high-water mark
+    (or than start for measurements never synced), merge them in the store
+    and return the new results per measurement id
+    """
+    if store is None:
+        store = ResultStore()
+
+    def get_params(measurement_id: int) -> dict:
+        last_timestamp = store.get_cursor(measurement_id)
+        if last_timestamp is not None:
+            return {"start": last_timestamp - overlap}
+        if start is not None:
+            return {"start": start}
+        return {}
+
+    # recurring measurements results change, they are not cached
+    results_per_measurement = fetch_measurement_results(
+        measurement_ids, params=get_params, use_cache=False
+    )
+
+    new_results = {}
+    for measurement_id, results in results_per_measurement.items():
+        new_results[measurement_id] = store.merge(measurement_id, results)
+
+        logger.info(
+            f"measurement {measurement_id}: {len(new_results[measurement_id])} new results"
+        )
+
+    return new_results
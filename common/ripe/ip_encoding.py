@@ -0,0 +1,186 @@
+"""
+Encode IP addresses as uint64: IPv4 as their integer value, IPv6 through a side table,
+and probe ids as dense indexes. Parsers and analyses share the process wide encoders
+so their keys can be compared without decoding
+"""
+import ipaddress
+import socket
+import threading
+
+from typing import Iterable
+
+import numpy as np
+
+# keys above the IPv4 range never collide with an address:
+# "*" of unanswered probes, then the ids of IPv6 addresses
+NO_ADDRESS: int = 1 << 32
+IPV6_BASE: int = NO_ADDRESS + 1
+MAX_IPV6: int = 1 << 32
+
+# encoded keys in numpy arrays and in array.array buffers
+KEY_DTYPE = np.uint64
+KEY_TYPECODE: str = "Q"
+
+
+class IPEncoder(object):
+    """IPv4 <-> uint64 by value, IPv6 <-> uint64 through a table shared by all encoded columns"""
+
+    def __init__(self) -> None:
+        self.ipv6_addrs = []
+        self._ipv6_ids = {}
+        self._lock = threading.Lock()
+
+    def encode(self, addr: str) -> int:
+        if addr is None or addr == "*":
+            return NO_ADDRESS
+
+        try:
+            return int.from_bytes(socket.inet_aton(addr), "big")
+        except OSError:
+            pass
+
+        # normalize so that the same IPv6 address always gets the same id
+        addr = str(ipaddress.IPv6Address(addr))
+        with self._lock:
+            ipv6_id = self._ipv6_ids.get(addr)
+            if ipv6_id is None:
+                if len(self.ipv6_addrs) >= MAX_IPV6:
+                    raise OverflowError("too many IPv6 addresses to encode")
+                ipv6_id = self._ipv6_ids[addr] = IPV6_BASE + len(self.ipv6_addrs)
+                self.ipv6_addrs.append(addr)
+
+        return ipv6_id
+
+    def lookup(self, addr: str) -> int:
+        """encoded value of addr, None for an IPv6 address never encoded (the table is unchanged)"""
+        if addr is None or addr == "*":
+            return NO_ADDRESS
+
+        try:
+            return int.from_bytes(socket.inet_aton(addr), "big")
+        except OSError:
+            pass
+
+        try:
+            return self._ipv6_ids.get(str(ipaddress.IPv6Address(addr)))
+        except ValueError:
+            return None
+
+    def encode_many(self, addrs: Iterable[str]) -> np.ndarray:
+        return np.fromiter((self.encode(addr) for addr in addrs), dtype=KEY_DTYPE)
+
+    def translate(self, values: np.ndarray, source: "IPEncoder") -> np.ndarray:
+        """values encoded by source, encoded by this encoder (only IPv6 ids differ)"""
+        values = np.asarray(values, dtype=KEY_DTYPE)
+        if source is self:
+            return values
+
+        values = values.copy()
+        ipv6 = values >= IPV6_BASE
+        values[ipv6] = [
+            self.encode(source.decode(value)) for value in values[ipv6].tolist()
+        ]
+
+        return values
+
+    def decode(self, value: int) -> str:
+        value = int(value)
+        if value == NO_ADDRESS:
+            return "*"
+        if value >= IPV6_BASE:
+            return self.ipv6_addrs[value - IPV6_BASE]
+
+        return socket.inet_ntoa(value.to_bytes(4, "big"))
+
+    def decode_array(self, values: np.ndarray) -> list:
+        return [self.decode(value) for value in values.tolist()]
+
+    def __getstate__(self) -> dict:
+        # tables parsed in worker processes carry their encoder
+        return {"ipv6_addrs": self.ipv6_addrs}
+
+    def __setstate__(self, state: dict) -> None:
+        self.ipv6_addrs = state["ipv6_addrs"]
+        self._ipv6_ids = {
+            addr: IPV6_BASE + i for i, addr in enumerate(self.ipv6_addrs)
+        }
+        self._lock = threading.Lock()
+
+
+class ProbeIndex(object):
+    """probe id <-> dense index, to index arrays (coordinates, distances) by probe"""
+
+    def __init__(self, probe_ids: Iterable[int] = ()) -> None:
+        self.probe_ids = []
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+        for probe_id in probe_ids:
+            self.index(probe_id)
+
+    def __len__(self) -> int:
+        return len(self.probe_ids)
+
+    def __contains__(self, probe_id: int) -> bool:
+        return probe_id in self._indexes
+
+    def index(self, probe_id: int) -> int:
+        """dense index of probe_id, a new probe gets the next index"""
+        index = self._indexes.get(probe_id)
+        if index is None:
+            with self._lock:
+                index = self._indexes.get(probe_id)
+                if index is None:
+                    index = self._indexes[probe_id] = len(self.probe_ids)
+                    self.probe_ids.append(probe_id)
+
+        return index
+
+    def index_many(self, probe_ids: Iterable[int]) -> np.ndarray:
+        return np.fromiter((self.index(probe_id) for probe_id in probe_ids), dtype=np.int32)
+
+    def get(self, probe_id: int) -> int:
+        """dense index of probe_id, None if it was never indexed"""
+        return self._indexes.get(probe_id)
+
+    def probe_id(self, index: int) -> int:
+        return self.probe_ids[index]
+
+
+_ip_encoder: IPEncoder = None
+_probe_index: ProbeIndex = None
+_lock = threading.Lock()
+
+
+def get_ip_encoder() -> IPEncoder:
+    """return the process wide ip encoder, create it on first use"""
+    global _ip_encoder
+
+    if _ip_encoder is None:
+        with _lock:
+            if _ip_encoder is None:
+                _ip_encoder = IPEncoder()
+
+    return _ip_encoder
+
+
+def get_probe_index() -> ProbeIndex:
+    """return the process wide probe index, create it on first use"""
+    global _probe_index
+
+    if _probe_index is None:
+        with _lock:
+            if _probe_index is None:
+                _probe_index = ProbeIndex()
+
+    return _probe_index
+
+
+def get_prefix(addr: str, af: int = 4) -> str:
+    """/24 prefix of an IPv4 address, /48 of an IPv6 address"""
+    if af == 4:
+        return socket.inet_ntoa(
+            (int.from_bytes(socket.inet_aton(addr), "big") & 0xFFFFFF00).to_bytes(4, "big")
+        )
+
+    return str(ipaddress.ip_network(addr + "/48", strict=False).network_address)
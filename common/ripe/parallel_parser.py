@@ -0,0 +1,187 @@
+"""Parse large NDJSON ping result dumps in a process pool, chunk by chunk"""
+import json
+import os
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+from common.ripe.columnar import PingTable, PingTableBuilder
+from common.ripe.ip_encoding import IPEncoder, KEY_DTYPE, get_ip_encoder
+
+# smaller files are parsed in the calling process
+MIN_PARALLEL_BYTES: int = 8 * 1024 * 1024
+
+# lines per chunk when parsing a stream
+DEFAULT_CHUNK_LINES: int = 50_000
+
+
+def split_byte_ranges(path: Path, nb_chunks: int) -> list:
+    """split a file in nb_chunks byte ranges, lines are assigned to the range they start in"""
+    size = os.path.getsize(path)
+    chunk_size = max(1, -(-size // nb_chunks))
+
+    return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+
+def _add_line(builder: PingTableBuilder, line: bytes) -> None:
+    line = line.strip()
+    if not line:
+        return
+
+    result = json.loads(line)
+    if isinstance(result, dict):
+        builder.add(result)
+
+
+def _parse_range(path: Path, start: int, end: int, vp_field: str) -> PingTable:
+    """parse the lines starting within [start, end), run in a worker process"""
+    builder = PingTableBuilder(vp_field=vp_field)
+    with open(path, "rb") as f:
+        # a line starting before start belongs to the previous range
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            _add_line(builder, line)
+
+    return builder.build()
+
+
+def _parse_lines(lines: list, vp_field: str) -> PingTable:
+    """parse a chunk of lines, run in a worker process"""
+    builder = PingTableBuilder(vp_field=vp_field)
+    for line in lines:
+        _add_line(builder, line)
+
+    return builder.build()
+
+
+def merge_ping_tables(tables: Iterable[PingTable], encoder: IPEncoder = None) -> PingTable:
+    """
+    concatenate tables parsed from consecutive chunks, destination and vp ids are
+    renumbered by first appearance, so the result equals a table parsed serially,
+    keys of tables parsed by other processes are translated into encoder
+    """
+    encoder = encoder or get_ip_encoder()
+    vp_field = "from"
+    dst_index = {}
+    vp_index = {}
+    columns = {
+        "dst_id": [],
+        "vp_id": [],
+        "min_rtt": [],
+        "n_rtts": [],
+        "timestamp": [],
+        "rtts": [],
+    }
+    offsets = [np.zeros(1, dtype=np.int64)]
+    nb_rtts = 0
+
+    for table in tables:
+        vp_field = table.vp_field
+        dst_keys = encoder.translate(table.dst_keys, table.encoder)
+        vp_keys = (
+            encoder.translate(table.vp_keys, table.encoder)
+            if table.vp_is_address
+            else table.vp_keys
+        )
+
+        dst_map = np.array(
+            [dst_index.setdefault(key, len(dst_index)) for key in dst_keys.tolist()],
+            dtype=np.int32,
+        )
+        vp_map = np.array(
+            [vp_index.setdefault(key, len(vp_index)) for key in vp_keys.tolist()],
+            dtype=np.int32,
+        )
+
+        columns["dst_id"].append(dst_map[table.dst_id])
+        columns["vp_id"].append(vp_map[table.vp_id])
+        columns["min_rtt"].append(table.min_rtt)
+        columns["n_rtts"].append(table.n_rtts)
+        columns["timestamp"].append(table.timestamp)
+        columns["rtts"].append(table.rtts)
+        offsets.append(table.offsets[1:] + nb_rtts)
+        nb_rtts += len(table.rtts)
+
+    dtypes = {
+        "dst_id": np.int32,
+        "vp_id": np.int32,
+        "min_rtt": np.float64,
+        "n_rtts": np.int32,
+        "timestamp": np.int64,
+        "rtts": np.float64,
+    }
+
+    return PingTable(
+        dst_keys=np.fromiter(dst_index, dtype=KEY_DTYPE, count=len(dst_index)),
+        vp_keys=np.fromiter(vp_index, dtype=KEY_DTYPE, count=len(vp_index)),
+        offsets=np.concatenate(offsets),
+        encoder=encoder,
+        vp_field=vp_field,
+        **{
+            name: np.concatenate(values) if values else np.empty(0, dtype=dtypes[name])
+            for name, values in columns.items()
+        },
+    )
+
+
+def parse_ping_file(
+    path: Path, max_workers: int = None, vp_field: str = "from"
+) -> PingTable:
+    """parse an NDJSON file of ping results, byte ranges are parsed in parallel"""
+    max_workers = max_workers or os.cpu_count() or 1
+
+    if max_workers == 1 or os.path.getsize(path) < MIN_PARALLEL_BYTES:
+        return _parse_range(path, 0, os.path.getsize(path), vp_field)
+
+    # a few ranges per worker evens out ranges slower to parse
+    byte_ranges = split_byte_ranges(path, max_workers * 4)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # map keeps ranges order, the merge is deterministic
+        tables = executor.map(
+            _parse_range,
+            *zip(*[(path, start, end, vp_field) for start, end in byte_ranges]),
+        )
+        return merge_ping_tables(tables)
+
+
+def parse_ping_stream(
+    lines: Iterable[bytes],
+    max_workers: int = None,
+    chunk_lines: int = DEFAULT_CHUNK_LINES,
+    vp_field: str = "from",
+) -> PingTable:
+    """parse a stream of NDJSON lines, chunks of lines are parsed in parallel"""
+    max_workers = max_workers or os.cpu_count() or 1
+
+    def chunks():
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) >= chunk_lines:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # at most two chunks per worker are read ahead of the merge
+        pending = deque()
+        tables = []
+        for chunk in chunks():
+            pending.append(executor.submit(_parse_lines, chunk, vp_field))
+            if len(pending) >= 2 * max_workers:
+                tables.append(pending.popleft().result())
+        tables.extend(future.result() for future in pending)
+
+    return merge_ping_tables(tables)
@@ -0,0 +1,213 @@
+"""Build probes and anchors datasets from RIPE Atlas daily probe archive, in one streamed pass"""
+import bz2
+import codecs
+import datetime
+import json
+
+from pathlib import Path
+from typing import Iterator
+
+from common.file_utils import dump_json
+from common.ripe.http_client import get_client
+from common.ripe.probe_crawler import STATUS_CONNECTED
+from common.ripe.ripe_atlas_api import (
+    is_located,
+    is_geoloc_disputed,
+    reduce_probe,
+    reduce_anchor,
+)
+from common.default import TP1_PROBES_PATH, TP1_ANCHORS_PATH
+from common.logger_config import logger
+
+# daily dump of all probes, published the day after
+ARCHIVE_URL: str = (
+    "https://ftp.ripe.net/ripe/atlas/probes/archive/{date:%Y}/{date:%m}/{date:%Y%m%d}.json.bz2"
+)
+
+# read size on the socket or the file
+CHUNK_SIZE: int = 256 * 1024
+
+
+def get_archive_url(date: datetime.date = None) -> str:
+    """url of the archive of date, yesterday by default"""
+    if date is None:
+        date = datetime.datetime.utcnow().date() - datetime.timedelta(days=1)
+
+    return ARCHIVE_URL.format(date=date)
+
+
+def _read_chunks(source) -> Iterator[bytes]:
+    """raw bytes of a local file or of a remote archive"""
+    if str(source).startswith(("http://", "https://")):
+        with get_client().get(str(source), stream=True) as response:
+            response.raise_for_status()
+            yield from response.iter_content(chunk_size=CHUNK_SIZE)
+        return
+
+    with open(source, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            yield chunk
+
+
+def _decompress(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """decompress bz2 chunks as they are read, archives can hold several bz2 streams"""
+    decompressor = bz2.BZ2Decompressor()
+    for chunk in chunks:
+        while chunk:
+            yield decompressor.decompress(chunk)
+            if not decompressor.eof:
+                break
+            # next stream starts in the unused data
+            chunk = decompressor.unused_data
+            decompressor = bz2.BZ2Decompressor()
+
+
+def _iter_objects(chunks: Iterator[bytes]) -> Iterator[dict]:
+    """
+    yield each probe of the archive while it is decompressed, the archive is either
+    a json list of probes or an object with the list of probes under "objects"
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    eof = False
+
+    def read() -> bool:
+        """append the next chunk to the buffer, dropping already decoded probes"""
+        nonlocal buffer, position
+        if position:
+            buffer = buffer[position:]
+            position = 0
+        for chunk in chunks:
+            text = text_decoder.decode(chunk)
+            if text:
+                buffer += text
+                return True
+        buffer += text_decoder.decode(b"", final=True)
+        return False
+
+    # find the beginning of the probes list
+    start = None
+    while start is None:
+        stripped = buffer.lstrip()
+        if stripped.startswith("["):
+            start = len(buffer) - len(stripped) + 1
+        elif '"objects"' in buffer and "[" in buffer[buffer.index('"objects"') :]:
+            start = buffer.index("[", buffer.index('"objects"')) + 1
+        elif not read():
+            raise ValueError("no probes list found in archive")
+    position = start
+
+    while True:
+        # skip separators between probes
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) or eof:
+                break
+            eof = not read()
+
+        if position >= len(buffer):
+            raise ValueError("truncated archive")
+        if buffer[position] == "]":
+            return
+
+        try:
+            probe, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # probe split across chunks: read more
+            if eof:
+                raise
+            eof = not read()
+            continue
+
+        yield probe
+        position = end
+
+
+def _normalize(probe: dict) -> dict:
+    """give an archived probe the shape of a probe returned by Atlas API"""
+    if not isinstance(probe.get("status"), dict) and "status" in probe:
+        probe["status"] = {
+            "id": probe["status"],
+            "name": probe.get("status_name"),
+            "since": probe.get("status_since"),
+        }
+
+    probe["tags"] = [
+        tag if isinstance(tag, dict) else {"slug": tag} for tag in probe.get("tags") or []
+    ]
+
+    if (
+        probe.get("geometry") is None
+        and probe.get("latitude") is not None
+        and probe.get("longitude") is not None
+    ):
+        probe["geometry"] = {
+            "type": "Point",
+            "coordinates": [probe["longitude"], probe["latitude"]],
+        }
+
+    return probe
+
+
+def get_probes_from_archive(source=None) -> tuple:
+    """
+    read the probe archive (url or local .json.bz2/.json file, yesterday archive by default)
+    and apply get_atlas_probes and get_atlas_anchors filters in the same pass,
+    return probes, anchors, number of rejected and of geoloc disputed probes
+    """
+    if source is None:
+        source = get_archive_url()
+
+    chunks = _read_chunks(source)
+    if str(source).endswith(".bz2"):
+        chunks = _decompress(chunks)
+
+    probes = []
+    anchors = []
+    rejected = 0
+    geoloc_disputed = 0
+    nb_probes = 0
+    for probe in _iter_objects(chunks):
+        nb_probes += 1
+        probe = _normalize(probe)
+
+        # disconnected probes are kept only if they are anchors
+        is_anchor = probe.get("is_anchor")
+        if not is_anchor and probe.get("status", {}).get("id") != STATUS_CONNECTED:
+            continue
+
+        if not is_located(probe):
+            rejected += 1
+            continue
+
+        if is_geoloc_disputed(probe):
+            geoloc_disputed += 1
+            continue
+
+        if is_anchor:
+            anchors.append(reduce_anchor(probe))
+        else:
+            probes.append(reduce_probe(probe))
+
+    logger.info(
+        f"archive {source}: {nb_probes} probes read, {len(probes)} probes and {len(anchors)} anchors kept"
+    )
+
+    return probes, anchors, rejected, geoloc_disputed
+
+
+def ingest_probe_archive(
+    source=None,
+    probes_path: Path = TP1_PROBES_PATH,
+    anchors_path: Path = TP1_ANCHORS_PATH,
+) -> tuple:
+    """write probes and anchors datasets from the probe archive"""
+    probes, anchors, _, _ = get_probes_from_archive(source)
+
+    dump_json(probes, probes_path)
+    dump_json(anchors, anchors_path)
+
+    return probes, anchors
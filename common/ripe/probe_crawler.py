@@ -0,0 +1,116 @@
+"""Parallel crawler of RIPE Atlas probes endpoint, with server side filters and field projection"""
+import json
+import math
+
+from concurrent.futures import ThreadPoolExecutor
+
+from common.ripe.cache import get_cache
+from common.logger_config import logger
+
+PROBES_URL: str = "https://atlas.ripe.net/api/v2/probes/"
+
+# largest page size accepted by Atlas API
+MAX_PAGE_SIZE: int = 500
+DEFAULT_WORKERS: int = 16
+
+# probes pages are cached for one hour
+PROBES_CACHE_TTL: float = 60 * 60
+
+# Atlas probe status ids
+STATUS_CONNECTED: int = 1
+
+# fields needed to build probes and anchors datasets
+PROBE_FIELDS: list = [
+    "id",
+    "status",
+    "is_anchor",
+    "address_v4",
+    "asn_v4",
+    "country_code",
+    "geometry",
+    "tags",
+]
+ANCHOR_FIELDS: list = PROBE_FIELDS + ["first_connected"]
+
+
+def _get_page(url: str, params: dict = None) -> tuple:
+    """return one page of results and its size in bytes"""
+    # probes change over time: cached pages expire and are revalidated
+    content = get_cache().fetch(url, params=params, ttl=PROBES_CACHE_TTL)
+
+    return json.loads(content), len(content)
+
+
+def _crawl_id_range(id_range: tuple, params: dict) -> tuple:
+    """follow next links for all probes with id in [id_gte, id_lt)"""
+    id_gte, id_lt = id_range
+    probes = []
+    nb_bytes = 0
+
+    page, size = _get_page(
+        PROBES_URL, params={**params, "id__gte": id_gte, "id__lt": id_lt}
+    )
+    while True:
+        nb_bytes += size
+        probes.extend(page["results"])
+
+        if not page["next"]:
+            break
+
+        # next url already contains all parameters
+        page, size = _get_page(page["next"])
+
+    return probes, nb_bytes
+
+
+def _get_id_ranges(params: dict, page_size: int, max_workers: int) -> list:
+    """split the probe id space into ranges that can be crawled concurrently"""
+    # highest probe id matching the filters and number of matching probes
+    page, _ = _get_page(
+        PROBES_URL, params={**params, "sort": "-id", "page_size": 1, "fields": "id"}
+    )
+    if not page["results"]:
+        return []
+
+    max_id = page["results"][0]["id"]
+    nb_ranges = max(max_workers, math.ceil(page["count"] / page_size))
+    range_size = math.ceil((max_id + 1) / nb_ranges)
+
+    return [
+        (id_gte, min(id_gte + range_size, max_id + 1))
+        for id_gte in range(0, max_id + 1, range_size)
+    ]
+
+
+def crawl_probes(
+    filters: dict = None,
+    fields: list = None,
+    page_size: int = MAX_PAGE_SIZE,
+    max_workers: int = DEFAULT_WORKERS,
+) -> list:
+    """
+    return all probes matching filters (Atlas API query parameters),
+    only the requested fields are downloaded, id ranges are crawled concurrently
+    """
+    params = dict(filters) if filters else {}
+    params["page_size"] = page_size
+    if fields:
+        params["fields"] = ",".join(fields)
+
+    id_ranges = _get_id_ranges(params, page_size, max_workers)
+
+    probes = []
+    nb_bytes = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # map keeps id ranges order, so probes are sorted by id
+        for range_probes, range_bytes in executor.map(
+            lambda id_range: _crawl_id_range(id_range, params), id_ranges
+        ):
+            probes.extend(range_probes)
+            nb_bytes += range_bytes
+
+    logger.info(
+        f"crawled {len(probes)} probes in {len(id_ranges)} id ranges ({nb_bytes / 1e6:.2f} MB)"
+    )
+
+    return probes
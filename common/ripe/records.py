@@ -0,0 +1,246 @@
+"""Compact records for probes, ping results, traceroute hops and DNS answers, built from Atlas JSON"""
+import sys
+
+from typing import Iterable
+
+from common.ripe.columnar import get_rtts
+from common.ripe.ip_encoding import NO_ADDRESS, get_ip_encoder
+
+GEOLOC_DISPUTED_TAG: str = "system-geoloc-disputed"
+
+
+def get_probe_id(probe: dict) -> int:
+    """return the probe id of a probe or an anchor, anchors give it in their probe field"""
+    return probe["probe"] if "probe" in probe else probe["id"]
+
+
+class Probe(object):
+    """a probe or an anchor, addresses are kept encoded"""
+
+    __slots__ = (
+        "id",
+        "address_key",
+        "asn_v4",
+        "country_code",
+        "lon",
+        "lat",
+        "is_anchor",
+        "geoloc_disputed",
+    )
+
+    def __init__(
+        self,
+        id: int,
+        address_key: int,
+        asn_v4: int,
+        country_code: str,
+        lon: float,
+        lat: float,
+        is_anchor: bool = False,
+        geoloc_disputed: bool = False,
+    ) -> None:
+        self.id = id
+        self.address_key = address_key
+        self.asn_v4 = asn_v4
+        self.country_code = country_code
+        self.lon = lon
+        self.lat = lat
+        self.is_anchor = is_anchor
+        self.geoloc_disputed = geoloc_disputed
+
+    @classmethod
+    def from_atlas(cls, probe: dict) -> "Probe":
+        """from a probe (or anchor) of the Atlas API or of our datasets"""
+        geometry = probe.get("geometry") or {}
+        lon, lat = geometry.get("coordinates") or (None, None)
+        country_code = probe.get("country_code")
+
+        return cls(
+            id=get_probe_id(probe),
+            address_key=get_ip_encoder().encode(probe.get("address_v4")),
+            asn_v4=probe.get("asn_v4"),
+            # a few hundred countries for thousands of probes
+            country_code=sys.intern(country_code) if country_code else None,
+            lon=lon,
+            lat=lat,
+            is_anchor=bool(probe.get("is_anchor", False)),
+            geoloc_disputed=any(
+                tag.get("slug") == GEOLOC_DISPUTED_TAG for tag in probe.get("tags") or []
+            ),
+        )
+
+    @property
+    def address_v4(self) -> str:
+        if self.address_key == NO_ADDRESS:
+            return None
+        return get_ip_encoder().decode(self.address_key)
+
+    @property
+    def coordinates(self) -> tuple:
+        """lon, lat as in probe["geometry"]["coordinates"]"""
+        return self.lon, self.lat
+
+    def as_dict(self) -> dict:
+        """same layout as reduce_probe"""
+        return {
+            "id": self.id,
+            "address_v4": self.address_v4,
+            "asn_v4": self.asn_v4,
+            "country_code": self.country_code,
+            "geometry": {"type": "Point", "coordinates": [self.lon, self.lat]},
+        }
+
+    def __repr__(self) -> str:
+        return f"Probe(id={self.id}, address_v4={self.address_v4}, country_code={self.country_code})"
+
+
+class PingSample(object):
+    """one ping result: rtts without stars, addresses kept encoded"""
+
+    __slots__ = ("msm_id", "prb_id", "src_key", "dst_key", "timestamp", "min_rtt", "rtts")
+
+    def __init__(
+        self,
+        msm_id: int,
+        prb_id: int,
+        src_key: int,
+        dst_key: int,
+        timestamp: int,
+        rtts: tuple,
+    ) -> None:
+        self.msm_id = msm_id
+        self.prb_id = prb_id
+        self.src_key = src_key
+        self.dst_key = dst_key
+        self.timestamp = timestamp
+        self.rtts = rtts
+        self.min_rtt = min(rtts)
+
+    @classmethod
+    def from_atlas(cls, result: dict) -> "PingSample":
+        """from an Atlas ping result, None if it has no usable rtt"""
+        rtts = get_rtts(result)
+        if rtts is None:
+            return None
+
+        encoder = get_ip_encoder()
+
+        return cls(
+            msm_id=result.get("msm_id"),
+            prb_id=result.get("prb_id"),
+            src_key=encoder.encode(result.get("from")),
+            dst_key=encoder.encode(result["dst_addr"]),
+            timestamp=result.get("timestamp", 0),
+            rtts=tuple(rtts),
+        )
+
+    @property
+    def src_addr(self) -> str:
+        return get_ip_encoder().decode(self.src_key)
+
+    @property
+    def dst_addr(self) -> str:
+        return get_ip_encoder().decode(self.dst_key)
+
+    def __repr__(self) -> str:
+        return f"PingSample(prb_id={self.prb_id}, dst_addr={self.dst_addr}, min_rtt={self.min_rtt})"
+
+
+class Hop(object):
+    """
+    replies of one traceroute hop: encoded addresses (NO_ADDRESS for stars)
+    and their rtt (None when not given)
+    """
+
+    __slots__ = ("hop", "reply_keys", "rtts")
+
+    def __init__(self, hop: int, reply_keys: tuple, rtts: tuple) -> None:
+        self.hop = hop
+        self.reply_keys = reply_keys
+        self.rtts = rtts
+
+    @classmethod
+    def from_atlas(cls, hop_results: dict) -> "Hop":
+        """from an element of the "result" list of an Atlas traceroute"""
+        encoder = get_ip_encoder()
+        replies = [
+            (encoder.encode(result["from"]), result.get("rtt"))
+            if "from" in result
+            else (NO_ADDRESS, None)
+            for result in hop_results["result"]
+        ]
+
+        return cls(
+            hop=hop_results["hop"],
+            reply_keys=tuple(reply_key for reply_key, _ in replies),
+            rtts=tuple(rtt for _, rtt in replies),
+        )
+
+    @classmethod
+    def from_traceroute(cls, traceroute_results: Iterable[dict]) -> list:
+        return [cls.from_atlas(hop_results) for hop_results in traceroute_results]
+
+    def replies(self) -> list:
+        """(address or None for stars, rtt or None) of each reply"""
+        decode = get_ip_encoder().decode
+
+        return [
+            (decode(reply_key) if reply_key != NO_ADDRESS else None, rtt)
+            for reply_key, rtt in zip(self.reply_keys, self.rtts)
+        ]
+
+    def __repr__(self) -> str:
+        return f"Hop(hop={self.hop}, replies={self.replies()})"
+
+
+class DnsAnswer(object):
+    """
+    one DNS result of a probe: the answer set is given by the caller
+    (abuf payloads are not decoded here)
+    """
+
+    __slots__ = ("msm_id", "prb_id", "src_key", "dst_key", "timestamp", "rt", "answers")
+
+    def __init__(
+        self,
+        msm_id: int,
+        prb_id: int,
+        src_key: int,
+        dst_key: int,
+        timestamp: int,
+        rt: float,
+        answers: frozenset = frozenset(),
+    ) -> None:
+        self.msm_id = msm_id
+        self.prb_id = prb_id
+        self.src_key = src_key
+        self.dst_key = dst_key
+        self.timestamp = timestamp
+        self.rt = rt
+        self.answers = answers
+
+    @classmethod
+    def from_atlas(cls, result: dict, answers: Iterable[str] = ()) -> "DnsAnswer":
+        """from an Atlas DNS result, rt is None for failed resolutions"""
+        encoder = get_ip_encoder()
+
+        return cls(
+            msm_id=result.get("msm_id"),
+            prb_id=result.get("prb_id"),
+            src_key=encoder.encode(result.get("from")),
+            dst_key=encoder.encode(result.get("dst_addr")),
+            timestamp=result.get("timestamp", 0),
+            rt=(result.get("result") or {}).get("rt"),
+            answers=frozenset(answers),
+        )
+
+    @property
+    def dst_addr(self) -> str:
+        return get_ip_encoder().decode(self.dst_key)
+
+    def __repr__(self) -> str:
+        return f"DnsAnswer(prb_id={self.prb_id}, dst_addr={self.dst_addr}, answers={set(self.answers)})"
+
+
+def load_probes(probes: Iterable[dict]) -> list:
+    return [Probe.from_atlas(probe) for probe in probes]
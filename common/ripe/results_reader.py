@@ -0,0 +1,80 @@
+"""Streaming reader of RIPE Atlas results, decodes one result at a time"""
+import json
+import os
+
+from typing import Iterator
+
+from common.ripe.cache import ResponseCache
+from common.ripe.http_client import get_client
+
+# read size on the socket
+CHUNK_SIZE: int = 64 * 1024
+
+
+def _decode_lines(lines: Iterator[bytes]) -> Iterator[dict]:
+    """
+    decode each result line, an "error" key is part of a result
+    (DNS timeouts for instance), API errors are failed responses
+    """
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        # endpoint ignored format parameter and answered a json array
+        if line.startswith(b"["):
+            line += b"".join(lines)
+            yield from json.loads(line)
+            return
+
+        yield json.loads(line)
+
+
+def _tee(lines: Iterator[bytes], f) -> Iterator[bytes]:
+    """copy each line into file f while it is read"""
+    for line in lines:
+        f.write(line + b"\n")
+        yield line
+
+
+def stream_results(
+    url: str,
+    params: dict = None,
+    cache: ResponseCache = None,
+    immutable: bool = False,
+) -> Iterator[dict]:
+    """
+    request line delimited results (format=txt) and yield each result
+    as soon as its line is read, the whole body is never held in memory.
+    With a cache, results are read from disk when available, otherwise they
+    are written to the cache while streamed if immutable, i.e. the measurement
+    was already finished before the download started
+    """
+    params = {**(params or {}), "format": "txt"}
+
+    if cache is not None:
+        cached_path = cache.get_path(url, params)
+        if cached_path is not None:
+            with open(cached_path, "rb") as f:
+                yield from _decode_lines(f)
+            return
+
+    with get_client().get(url, params=params, stream=True) as response:
+        # an error body still there after the client retries is not an empty result set
+        response.raise_for_status()
+        lines = response.iter_lines(chunk_size=CHUNK_SIZE)
+
+        # only cache results that will not change anymore
+        if cache is None or not immutable:
+            yield from _decode_lines(lines)
+            return
+
+        with cache.writer() as f:
+            try:
+                yield from _decode_lines(_tee(lines, f))
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+
+        cache.put_file(url, params, f.name)
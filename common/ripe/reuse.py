@@ -0,0 +1,112 @@
+"""Reuse index of recent measurements, avoids launching identical measurements twice"""
+import hashlib
+import json
+import threading
+import time
+
+from common.ledger import MeasurementLedger, get_ledger
+from common.logger_config import logger
+
+# measurements younger than this are reused (seconds)
+DEFAULT_FRESHNESS: float = 24 * 60 * 60
+
+# definition parameters that change what a measurement measures (DNS options
+# change the results), descriptions etc. do not prevent reuse
+REUSE_PARAMETERS: list = [
+    "type",
+    "af",
+    "target",
+    "query_argument",
+    "query_type",
+    "query_class",
+    "protocol",
+    "packets",
+    "size",
+    "use_probe_resolver",
+    "include_abuf",
+    "set_rd_bit",
+]
+
+
+def get_reuse_key(definition: dict, vps: list) -> str:
+    """
+    identify a measurement by its type, target, vantage points, packet parameters
+    and tags: a measurement is only reused under its own tags, so it is found by tag
+    """
+    key = {
+        parameter: definition[parameter]
+        for parameter in REUSE_PARAMETERS
+        if parameter in definition
+    }
+    key["tags"] = sorted(definition.get("tags") or [])
+    key["vps"] = sorted(set(vps))
+
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+class MeasurementReuseIndex(object):
+    """find in the ledger a recent measurement identical to the one about to be submitted"""
+
+    def __init__(
+        self, ledger: MeasurementLedger = None, freshness: float = DEFAULT_FRESHNESS
+    ) -> None:
+        self.ledger = ledger or get_ledger()
+        self.freshness = freshness
+
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, definition: dict, vps: list) -> int:
+        """return the id of a fresh identical measurement, None if it must be submitted"""
+        if not self.freshness:
+            return None
+
+        measurement = self.ledger.find_reusable(
+            get_reuse_key(definition, vps), since=time.time() - self.freshness
+        )
+
+        with self._lock:
+            if measurement is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        target = definition.get("target") or definition.get("query_argument")
+        logger.info(
+            f"reusing {definition['type']} measurement {measurement['measurement_id']} towards {target}"
+        )
+
+        return measurement["measurement_id"]
+
+    def record(
+        self, measurement_id: int, definition: dict, vps: list, tag: str = None
+    ) -> None:
+        """record a submitted measurement so it can be reused later"""
+        self.ledger.record(
+            measurement_id,
+            definition,
+            vps,
+            tag,
+            reuse_key=get_reuse_key(definition, vps),
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+_reuse_index: MeasurementReuseIndex = None
+_reuse_index_lock = threading.Lock()
+
+
+def get_reuse_index() -> MeasurementReuseIndex:
+    """return the process wide reuse index, create it on first use"""
+    global _reuse_index
+
+    if _reuse_index is None:
+        with _reuse_index_lock:
+            if _reuse_index is None:
+                _reuse_index = MeasurementReuseIndex()
+
+    return _reuse_index
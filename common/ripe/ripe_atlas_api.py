@@ -1,75 +1,462 @@
 """All functions to query RIPE Atlas API"""
 
-import json
 import logging
 import time
-import requests
-import ipaddress
 
-from collections import defaultdict, OrderedDict
+from concurrent.futures import Future
 from ipaddress import IPv4Network
+from pathlib import Path
 from random import randint
-
+from typing import Iterable
+
+from common.ledger import (
+    MeasurementLedger,
+    get_ledger,
+    STATUS_FAILED,
+    STATUS_PARTIAL,
+    STATUS_SUBMITTED,
+)
+from common.ripe.http_client import get_client
+from common.ripe.bulk_fetcher import (
+    fetch_measurement_results,
+    iter_results_time_sliced,
+    DEFAULT_WINDOW,
+)
+from common.ripe.results_reader import stream_results
+from common.ripe.columnar import PingResultsView, parse_ping_results
+from common.ripe.parallel_parser import parse_ping_file
+from common.ripe.ip_encoding import get_ip_encoder
+from common.ripe.records import GEOLOC_DISPUTED_TAG, Probe
+from common.ripe.hop_table import (
+    HopTable,
+    HopTableBuilder,
+    get_hop_table,
+    iter_hop_tables,
+    iter_csv_rows,
+)
+from common.ripe.incremental_sync import ResultStore, sync_measurements
+from common.ripe.utils import MEASUREMENTS_URL, get_measurement_url
+from common.ripe.scheduler import MeasurementScheduler
+from common.ripe.tracker import (
+    MeasurementTracker,
+    DEFAULT_BACKOFF,
+)
+from common.ripe.reuse import MeasurementReuseIndex, get_reuse_key
+from common.ripe.fanout import (
+    chunk_vps,
+    fan_out,
+    get_error_detail,
+    is_quota_refusal,
+    post_definitions,
+    submit_measurement,
+    MAX_PROBES_PER_MEASUREMENT,
+)
+from common.ripe.probe_crawler import (
+    crawl_probes,
+    PROBE_FIELDS,
+    ANCHOR_FIELDS,
+    STATUS_CONNECTED,
+)
 from common.logger_config import logger
 
+# number of measurement definitions sent within one POST request,
+# batches rejected by Atlas API are split further
+MAX_DEFINITIONS_PER_REQUEST: int = 100
+
 
 class RIPEAtlas(object):
     def __init__(
         self,
         account: str,
         key: str,
+        scheduler: MeasurementScheduler = None,
+        ledger: MeasurementLedger = None,
+        reuse_index: MeasurementReuseIndex = None,
     ) -> None:
         self.account = account
         self.key = key
+        self.scheduler = scheduler or MeasurementScheduler(self._submit_ping)
+        self.ledger = ledger or get_ledger()
+        self.reuse_index = reuse_index or MeasurementReuseIndex(self.ledger)
+
+    def _ping_definition(
+        self, target: str, tag: str, nb_packets: int, description: str
+    ) -> dict:
+        """return Atlas definition of a ping measurement towards target"""
+        return {
+            "target": target,
+            "af": 4,
+            "packets": nb_packets,
+            "size": 48,
+            "tags": [tag],
+            "description": description.format(target=target),
+            "resolve_on_probe": False,
+            "skip_dns_check": True,
+            "include_probe_id": False,
+            "type": "ping",
+        }
+
+    def _submit(self, definitions: list, vps: list):
+        """post one-off measurement definitions, all performed by vps"""
+        return post_definitions(definitions, vps, self.key, self.account)
+
+    def _submit_ping(
+        self,
+        target: str,
+        vps: list,
+        tag: str,
+        nb_packets: int,
+        description: str,
+        max_probes: int = MAX_PROBES_PER_MEASUREMENT,
+    ) -> int:
+        """submit one ping measurement, raise QuotaExceededError if Atlas refuses it"""
+        definition = self._ping_definition(target, tag, nb_packets, description)
+
+        # large vp sets are split in chunks, tracked as one measurement
+        measurement_id = submit_measurement(
+            definition,
+            vps,
+            self.key,
+            self.account,
+            tag=tag,
+            reuse_index=self.reuse_index,
+            chunk_size=max_probes,
+        )
+
+        # each chunk counts in Atlas quotas, the scheduler registers the measurement itself
+        for chunk_id in self.ledger.get_chunks([measurement_id]).get(measurement_id, []):
+            self.scheduler.register(chunk_id, target)
+
+        return measurement_id
+
+    def schedule_ping(
+        self,
+        target,
+        vps,
+        tag: str,
+        nb_packets: int = 3,
+        max_retry: int = 60,
+        description: str = "Dioptra Geolocation of {target}",
+        max_probes: int = MAX_PROBES_PER_MEASUREMENT,
+    ) -> Future:
+        """queue a ping measurement towards target from vps, return a future of its id"""
+        # an identical recent measurement is reused instead of submitting a new one
+        measurement_id = self.reuse_index.lookup(
+            self._ping_definition(target, tag, nb_packets, description), vps
+        )
+        if measurement_id is not None:
+            future = Future()
+            future.set_result(measurement_id)
+            return future
+
+        return self.scheduler.submit(
+            target,
+            max_retry=max_retry,
+            vps=vps,
+            tag=tag,
+            nb_packets=nb_packets,
+            description=description,
+            max_probes=max_probes,
+        )
 
     def ping(
-        self, target, vps, tag: str, nb_packets: int = 3, max_retry: int = 60
+        self,
+        target,
+        vps,
+        tag: str,
+        nb_packets: int = 3,
+        max_retry: int = 60,
+        description: str = "Dioptra Geolocation of {target}",
+        max_probes: int = MAX_PROBES_PER_MEASUREMENT,
     ) -> None:
         """start ping measurement towards target from vps, return Atlas measurement id"""
+        # the scheduler holds the submission until our quotas allow it
+        return self.schedule_ping(
+            target,
+            vps,
+            tag,
+            nb_packets=nb_packets,
+            max_retry=max_retry,
+            description=description,
+            max_probes=max_probes,
+        ).result()
+
+    def _submit_batches(
+        self,
+        targets: list,
+        vps: list,
+        tag: str,
+        nb_packets: int,
+        description: str,
+        max_definitions: int,
+        record,
+    ) -> tuple:
+        """
+        submit one ping per target from vps, packing max_definitions per request,
+        record(target, measurement_id) is called as soon as a batch is accepted,
+        return measurement id per target, the number of requests and the targets
+        refused because a quota is reached (left to the scheduler)
+        """
+        batches = [
+            targets[i : i + max_definitions]
+            for i in range(0, len(targets), max_definitions)
+        ]
+
+        measurement_ids = {}
+        nb_requests = 0
+        while batches:
+            batch = batches.pop(0)
+            definitions = [
+                self._ping_definition(target, tag, nb_packets, description)
+                for target in batch
+            ]
+
+            response = self._submit(definitions, vps)
+            nb_requests += 1
+
+            if response.ok:
+                # Atlas returns measurement ids in definitions order
+                for target, measurement_id in zip(
+                    batch, response.json()["measurements"]
+                ):
+                    record(target, measurement_id)
+                    # counted in our quotas until finished, as scheduled submissions
+                    self.scheduler.register(measurement_id, target)
+                    measurement_ids[target] = measurement_id
+                continue
+
+            # quotas are per account, the following batches would be refused too
+            if is_quota_refusal(response):
+                refused = batch + [target for batch in batches for target in batch]
+                logger.warning(
+                    f"{len(refused)} definitions refused: {get_error_detail(response)}"
+                )
+                return measurement_ids, nb_requests, refused
+
+            # request too large or with an invalid definition: split it in two
+            if response.status_code == 400 and len(batch) > 1:
+                half = len(batch) // 2
+                batches[:0] = [batch[:half], batch[half:]]
+                logger.warning(
+                    f"batch of {len(batch)} definitions rejected, splitting it"
+                )
+            elif response.status_code == 400:
+                logger.error(
+                    f"could not start ping towards {batch[0]}: {get_error_detail(response)}"
+                )
+            else:
+                raise RuntimeError(
+                    f"measurement submission failed ({response.status_code}): {response.text}"
+                )
+
+        return measurement_ids, nb_requests, []
+
+    def ping_batch(
+        self,
+        targets: list,
+        vps: list,
+        tag: str,
+        nb_packets: int = 3,
+        description: str = "Dioptra Geolocation of {target}",
+        max_definitions: int = MAX_DEFINITIONS_PER_REQUEST,
+        resume: bool = False,
+        max_probes: int = MAX_PROBES_PER_MEASUREMENT,
+        max_retry: int = 60,
+    ) -> dict:
+        """
+        start one ping measurement per target from vps,
+        pack as many definitions as possible per request,
+        vps are split in chunks of max_probes submitted concurrently,
+        definitions refused for quota are batched again once capacity frees up
+        (at most max_retry times), return Atlas measurement id per target.
+        With resume, targets already measured under tag (ledger) are not submitted again
+        """
+        targets = list(dict.fromkeys(targets))
+
+        measurement_ids = {}
+        partials = {}
+        if resume:
+            for measurement in self.ledger.find(
+                tag=tag, measurement_type="ping", targets=targets
+            ):
+                if measurement["status"] == STATUS_PARTIAL:
+                    partials[measurement["target"]] = measurement
+                elif measurement["status"] != STATUS_FAILED:
+                    measurement_ids[measurement["target"]] = measurement[
+                        "measurement_id"
+                    ]
+            logger.info(
+                f"resuming campaign {tag}: {len(measurement_ids)} targets done, "
+                f"{len(partials)} partially submitted"
+            )
+
+        # identical recent measurements are reused instead of submitting new ones
+        nb_reused = 0
+        for target in targets:
+            if target in measurement_ids or target in partials:
+                continue
+            measurement_id = self.reuse_index.lookup(
+                self._ping_definition(target, tag, nb_packets, description), vps
+            )
+            if measurement_id is not None:
+                measurement_ids[target] = measurement_id
+                nb_reused += 1
+
+        targets = [target for target in targets if target not in measurement_ids]
+        definitions = {
+            target: self._ping_definition(target, tag, nb_packets, description)
+            for target in targets
+        }
+
+        # the first chunk of vps gives the logical measurement of each target,
+        # recorded as soon as its batch is accepted
+        vp_chunks = chunk_vps(vps, max_probes) if targets else []
+        parents = {}
+        # indexes of the chunks accepted per target
+        accepted = {target: set() for target in targets}
+
+        def record_parent(target: str, measurement_id: int) -> None:
+            self.ledger.record(
+                measurement_id,
+                definitions[target],
+                vps,
+                tag,
+                status=STATUS_PARTIAL if len(vp_chunks) > 1 else STATUS_SUBMITTED,
+                reuse_key=get_reuse_key(definitions[target], vps),
+            )
+            parents[target] = measurement_id
+            accepted[target].add(0)
+
+        # partial measurements of the same vps only miss some chunks, they are
+        # completed in the same batches as the new targets
+        nb_resumed = 0
+        for target, measurement in partials.items():
+            if measurement["reuse_key"] != get_reuse_key(definitions[target], vps):
+                continue
 
+            measurement_id = measurement["measurement_id"]
+            chunk_ids = self.ledger.get_chunks([measurement_id]).get(measurement_id, [])
+            submitted = {tuple(self.ledger.get(chunk_id)["vps"]) for chunk_id in chunk_ids}
+            parents[target] = measurement_id
+            accepted[target].update(
+                index
+                for index, chunk in enumerate(vp_chunks)
+                if index == 0 or tuple(chunk) in submitted
+            )
+            nb_resumed += 1
+
+        def submit_round(round_targets: list) -> tuple:
+            """
+            submit the chunks round_targets miss, batched per chunk,
+            return the number of requests and the targets refused for quota
+            """
+            refused = set()
+            nb_requests = 0
+
+            first_targets = [target for target in round_targets if 0 not in accepted[target]]
+            if first_targets:
+                _, nb_requests, refused_targets = self._submit_batches(
+                    first_targets,
+                    vp_chunks[0],
+                    tag,
+                    nb_packets,
+                    description,
+                    max_definitions,
+                    record_parent,
+                )
+                refused.update(refused_targets)
+
+            # every other chunk receives the definitions accepted on the first one
+            def submit_chunk(index: int) -> tuple:
+                chunk = vp_chunks[index]
+
+                def record_chunk(target: str, chunk_id: int) -> None:
+                    self.ledger.record(
+                        chunk_id, definitions[target], chunk, tag, parent_id=parents[target]
+                    )
+                    accepted[target].add(index)
+
+                chunk_targets = [
+                    target
+                    for target in round_targets
+                    if target in parents and index not in accepted[target]
+                ]
+                if not chunk_targets:
+                    return 0, []
+
+                _, nb_chunk_requests, refused_targets = self._submit_batches(
+                    chunk_targets,
+                    chunk,
+                    tag,
+                    nb_packets,
+                    description,
+                    max_definitions,
+                    record_chunk,
+                )
+                return nb_chunk_requests, refused_targets
+
+            for nb_chunk_requests, refused_targets in fan_out(
+                submit_chunk, list(range(1, len(vp_chunks)))
+            ):
+                nb_requests += nb_chunk_requests
+                refused.update(refused_targets)
+
+            return nb_requests, refused
+
+        nb_requests, refused = submit_round(targets) if vp_chunks else (0, set())
+
+        # refused for quota: once in flight measurements finish, the missing chunks
+        # are batched again, as many as the scheduler has free slots for
         for _ in range(max_retry):
-            response = requests.post(
-                f"https://atlas.ripe.net/api/v2/measurements/?key={self.key}",
-                json={
-                    "definitions": [
-                        {
-                            "target": target,
-                            "af": 4,
-                            "packets": nb_packets,
-                            "size": 48,
-                            "tags": [tag],
-                            "description": f"Dioptra Geolocation of {target}",
-                            "resolve_on_probe": False,
-                            "skip_dns_check": True,
-                            "include_probe_id": False,
-                            "type": "ping",
-                        }
-                    ],
-                    "probes": [
-                        {"value": vp, "type": "probes", "requested": 1} for vp in vps
-                    ],
-                    "is_oneoff": True,
-                    "bill_to": self.account,
-                },
-            ).json()
-
-            try:
-                measurement_id = response["measurements"][0]
+            if not refused:
                 break
-            except KeyError:
-                logger.info(response)
-                logger.warning("Too much measurements. Waiting.")
-                time.sleep(60)
-        else:
-            raise Exception("Too much measurements. Stopping.")
 
-        if not response:
-            return
+            self.scheduler.block()
+            free_slots = self.scheduler.wait_for_capacity()
+
+            round_targets = []
+            nb_slots = 0
+            for target in targets:
+                if target not in refused:
+                    continue
+                nb_missing = len(vp_chunks) - len(accepted[target])
+                if round_targets and nb_slots + nb_missing > free_slots:
+                    break
+                round_targets.append(target)
+                nb_slots += nb_missing
+
+            logger.info(f"submitting again {len(round_targets)} refused measurements")
+            nb_round_requests, round_refused = submit_round(round_targets)
+            nb_requests += nb_round_requests
+            refused = (refused - set(round_targets)) | round_refused
+
+        if refused:
+            logger.error(
+                f"{len(refused)} measurements still refused after {max_retry} attempts"
+            )
+
+        # a measurement missing a chunk (refused or rejected) stays partial,
+        # it is completed by the next resume
+        complete = {
+            target: measurement_id
+            for target, measurement_id in parents.items()
+            if len(accepted[target]) == len(vp_chunks)
+        }
+        if len(parents) > len(complete):
+            logger.warning(
+                f"{len(parents) - len(complete)} measurements left partial, resume to complete them"
+            )
+        if len(vp_chunks) > 1:
+            for measurement_id in complete.values():
+                self.ledger.update_status(measurement_id, STATUS_SUBMITTED)
+        measurement_ids.update(complete)
+
+        logger.info(
+            f"{len(measurement_ids)} measurements ({nb_reused} reused, {nb_resumed} resumed) "
+            f"with {nb_requests} requests"
+        )
 
-        try:
-            return measurement_id
-        except (IndexError, KeyError):
-            return
+        return measurement_ids
 
     def traceroute_measurement(self, target, probes_selector, options):
         ripe_key, description, tags, is_public, packets, protocol = options
@@ -95,7 +482,7 @@ class RIPEAtlas(object):
 
         definitions = [parameters]
 
-        response = requests.post(
+        response = get_client().post(
             f"https://atlas.ripe.net/api/v2/measurements/?key={ripe_key}",
             json={
                 "definitions": definitions,
@@ -111,88 +498,95 @@ class RIPEAtlas(object):
 
 
 def ripe_traceroute_to_csv(traceroute):
-    protocols = {"ICMP": 1, "TCP": 6, "UDP": 17}
-    rows = []
-    try:
-        src_addr = traceroute["from"]
-        dst_addr = traceroute["dst_addr"]
-        af = traceroute["af"]
-        if af == 4:
-            dst_prefix = ".".join(dst_addr.split(".")[:3] + ["0"])
-        elif af == 6:
-            dst_prefix = str(
-                ipaddress.ip_network(dst_addr + "/48", strict=False).network_address
-            )
-    except (KeyError, ValueError):
-        return rows
+    """csv rows of each hop reply of a traceroute, the traceroute is left untouched"""
+    return list(iter_csv_rows(get_hop_table([traceroute])))
 
-    for hop in traceroute["result"]:
-        for response in hop.get("result", []):
-            if not response or response.get("error"):
-                continue
-            if response.get("x") == "*" or not response.get("rtt"):
-                response["from"] = "*"
-                response["rtt"] = 0
-                response["ttl"] = 0
-            proto = protocols[traceroute["proto"]]
-            try:
-                row = (
-                    src_addr,
-                    dst_prefix,
-                    dst_addr,
-                    response["from"],
-                    proto,
-                    hop["hop"],
-                    response["rtt"],
-                    response["ttl"],
-                    traceroute["prb_id"],
-                    traceroute["msm_id"],
-                    traceroute["timestamp"],
+
+def fetch_traceroute_hops(
+    measurement_ids, start=None, stop=None, probe_ids=None
+) -> HopTable:
+    """typed table of the hop replies of all traceroutes of measurement_ids"""
+    params = {}
+    if start:
+        params["start"] = start
+    if stop:
+        params["stop"] = stop
+
+    encoder = get_ip_encoder()
+
+    # long histories are downloaded by concurrent time windows
+    if start and stop and stop - start > DEFAULT_WINDOW:
+        return HopTable.concatenate(
+            [
+                table
+                for measurement_id in measurement_ids
+                for table in iter_hop_tables(
+                    iter_results_time_sliced(
+                        measurement_id, start, stop, probe_ids=probe_ids
+                    ),
+                    encoder=encoder,
                 )
-                row_str = "".join(f",{x}" for x in row)[1:]
-                rows.append(row_str)
-            except Exception:
-                print("ERROR", response)
+            ],
+            encoder,
+        )
+
+    # one builder per measurement, each measurement is streamed by a single thread
+    builders = {}
 
-    return rows
+    def add_traceroute(traceroute: dict) -> None:
+        msm_id = traceroute.get("msm_id")
+        if msm_id not in builders:
+            builders[msm_id] = HopTableBuilder(encoder)
+        builders[msm_id].add(traceroute)
+
+    # traceroutes are added to the table while their results are streamed
+    fetch_measurement_results(
+        measurement_ids,
+        params=params,
+        transform=add_traceroute,
+        probe_ids=probe_ids,
+    )
+
+    return HopTable.concatenate(
+        [builder.build() for builder in builders.values()], encoder
+    )
 
 
 def fetch_traceroutes_from_measurement_ids_no_csv(
-    measurement_ids, start=None, stop=None
+    measurement_ids, start=None, stop=None, probe_ids=None
 ):
-    res = []
-    for measurement_id in measurement_ids:
-        result_url = (
-            f"https://atlas.ripe.net/api/v2/measurements/{measurement_id}/results/?"
+    """csv rows of the hop replies of all traceroutes of measurement_ids"""
+    return list(
+        iter_csv_rows(
+            fetch_traceroute_hops(
+                measurement_ids, start=start, stop=stop, probe_ids=probe_ids
+            )
         )
-        if start:
-            result_url += f"start={start}"
-        if stop:
-            result_url += f"&stop={stop}"
-        traceroutes = requests.get(result_url).json()
-        if "error" in traceroutes:
-            print(traceroutes)
-            continue
-        for traceroute in traceroutes:
-            rows = ripe_traceroute_to_csv(traceroute)
-            for row in rows:
-                res.append(row)
-    return res
+    )
 
 
-def wait_for(measurement_id: str, max_retry: int = 30) -> None:
-    for _ in range(max_retry):
-        response = requests.get(
-            f"https://atlas.ripe.net/api/v2/measurements/{measurement_id}/"
-        ).json()
+def sync_traceroutes_from_measurement_ids(
+    measurement_ids, store: ResultStore = None, start=None
+):
+    """
+    fetch only traceroutes newer than the last synchronisation,
+    store them locally and return their csv rows
+    """
+    new_traceroutes = sync_measurements(measurement_ids, store=store, start=start)
+    table = get_hop_table(
+        traceroute
+        for traceroutes in new_traceroutes.values()
+        for traceroute in traceroutes
+    )
+    return list(iter_csv_rows(table))
 
-        # check if measurement is ongoing or not
-        if response["status"]["name"] != "Ongoing":
-            return response
-        else:
-            logger.info("no measurement retrieved...")
 
-        time.sleep(10)
+def wait_for(measurement_id: str, max_retry: int = 30) -> None:
+    """wait until measurement is finished, return its description"""
+    for _ in MeasurementTracker([measurement_id], max_polls=max_retry):
+        return get_client().get(f"{MEASUREMENTS_URL}{measurement_id}/").json()
+
+    logger.info("no measurement retrieved...")
 
     return None
 
@@ -231,107 +625,102 @@ def get_target_hitlist(target_prefix, nb_targets, targets_per_prefix):
 
 
 def is_geoloc_disputed(probe: dict) -> bool:
-    """check if geoloc disputed flag is contained in probe metadata"""
+    """check if geoloc disputed flag is contained in probe metadata (dict or Probe record)"""
+    if isinstance(probe, Probe):
+        return probe.geoloc_disputed
 
     tags = probe["tags"]
     for tag in tags:
-        if tag["slug"] == "system-geoloc-disputed":
+        if tag["slug"] == GEOLOC_DISPUTED_TAG:
             return True
     return False
 
 
-def get_measurement_url(measurement_id: int) -> str:
-    """return Atlas API url for get measurement request"""
-
-    return f"https://atlas.ripe.net/api/v2/measurements/{measurement_id}/results/"
-
-
-def get_response(url: str, max_retry: int = 60, wait_time: int = 2) -> list:
-    """request to Atlas API"""
-
-    for _ in range(max_retry):
-        response = requests.get(url)
-
-        # small parsing, as response might not be Json formatted
-        try:
-            response = json.loads(response.content)
-        except json.JSONDecodeError:
-            response = response.content.decode()
-            response = response.replace("}{", "}, {")
-            response = response.replace("} {", "}, {")
-            response = json.loads(response)
-
-        if response != []:
+def is_located(probe: dict) -> bool:
+    """check that a probe has a location, an IPv4 address and a country"""
+    return (
+        probe.get("geometry") is not None
+        and probe.get("address_v4") is not None
+        and probe.get("country_code") is not None
+    )
+
+
+def reduce_probe(probe: dict) -> dict:
+    """keep only the probe fields of our datasets"""
+    return {
+        "id": probe["id"],
+        "address_v4": probe["address_v4"],
+        "asn_v4": probe["asn_v4"],
+        "country_code": probe["country_code"],
+        "geometry": probe["geometry"],
+    }
+
+
+def reduce_anchor(anchor: dict) -> dict:
+    """keep only the anchor fields of our datasets"""
+    return {
+        "id": anchor["id"],
+        "status": anchor["status"],
+        "address_v4": anchor["address_v4"],
+        "asn_v4": anchor["asn_v4"],
+        "country_code": anchor["country_code"],
+        "geometry": anchor["geometry"],
+        "first_connected": anchor["first_connected"],
+        "is_anchor": anchor["is_anchor"],
+    }
+
+
+def get_response(
+    url: str, max_retry: int = 60, wait_time: int = 2, max_wait_time: int = 60
+) -> list:
+    """request to Atlas API, wait longer and longer while no result is available"""
+
+    for attempt in range(max_retry):
+        # results are decoded one by one, as they are read from the socket
+        response = list(stream_results(url))
+
+        if response != [] or attempt == max_retry - 1:
             break
-        time.sleep(wait_time)
 
-    return response
-
-
-def parse_measurements_results(response: list) -> dict:
-    """from get Atlas measurement request return parsed results"""
-
-    # parse response
-    measurement_results = defaultdict(dict)
-    for result in response:
-        # parse results and calculate geoloc
-        if result.get("result") is not None:
-            dst_addr = result["dst_addr"]
-            vp_addr = result["from"]
+        # results take minutes to arrive, do not poll at a fixed rate
+        time.sleep(min(wait_time * DEFAULT_BACKOFF**attempt, max_wait_time))
 
-            if type(result["result"]) == list:
-                rtt_list = [list(rtt.values())[0] for rtt in result["result"]]
-            else:
-                rtt_list = [result["result"]["rtt"]]
-
-            # remove stars from results
-            rtt_list = list(filter(lambda x: x != "*", rtt_list))
-            if not rtt_list:
-                continue
-
-            # sometimes connection error with vantage point cause result to be string message
-            try:
-                min_rtt = min(rtt_list)
-            except TypeError:
-                continue
+    return response
 
-            if isinstance(min_rtt, str):
-                continue
 
-            measurement_results[dst_addr][vp_addr] = {
-                "node": vp_addr,
-                "min_rtt": min_rtt,
-                "rtt_list": rtt_list,
-            }
+def parse_measurements_results(response: Iterable[dict]) -> PingResultsView:
+    """
+    from get Atlas measurement request return parsed results:
+    dst addr -> vp addr -> {node, min_rtt, rtt_list}, vps per increasing rtt.
+    Results are parsed into columns, dicts are only built when accessed,
+    to_dict() gives the plain dicts to save them as json
+    """
+    return parse_ping_results(response).as_dict()
 
-        else:
-            logger.warning(f"no results: {result}")
-
-    # order vps per increasing rtt
-    for dst_addr in measurement_results:
-        measurement_results[dst_addr] = OrderedDict(
-            {
-                vp: results
-                for vp, results in sorted(
-                    measurement_results[dst_addr].items(),
-                    key=lambda item: item[1]["min_rtt"],
-                )
-            }
-        )
 
-    return measurement_results
+def parse_measurements_results_file(
+    path: Path, max_workers: int = None
+) -> PingResultsView:
+    """same as parse_measurements_results for an NDJSON file, parsed by all cores"""
+    return parse_ping_file(path, max_workers=max_workers).as_dict()
 
 
 def get_measurement_from_id(
     measurement_id: int,
     max_retry: int = 60,
     wait_time: int = 10,
-) -> dict:
-    """retrieve measurement results from RIPE Atlas with measurement id"""
-
-    url = get_measurement_url(measurement_id)
-
-    response = get_response(url, max_retry=max_retry, wait_time=wait_time)
+) -> PingResultsView:
+    """
+    retrieve measurement results from RIPE Atlas with measurement id,
+    see parse_measurements_results
+    """
+
+    response = []
+    # measurements split over several vp sets are merged
+    chunk_ids = get_ledger().get_chunks([measurement_id]).get(measurement_id, [])
+    for chunk_id in [measurement_id] + chunk_ids:
+        url = get_measurement_url(chunk_id)
+        response.extend(get_response(url, max_retry=max_retry, wait_time=wait_time))
 
     measurement_result = parse_measurements_results(response)
 
@@ -350,13 +739,13 @@ def get_measurements_from_tag(tag: str) -> dict:
 
 def get_from_atlas(url: str):
     """get request url atlas endpoint"""
-    response = requests.get(url).json()
+    response = get_client().get(url).json()
     while True:
         for anchor in response["results"]:
             yield anchor
 
         if response["next"]:
-            response = requests.get(response["next"]).json()
+            response = get_client().get(response["next"]).json()
         else:
             break
 
@@ -366,13 +755,13 @@ def get_all_results_from_request(url: str, params: dict = None) -> dict:
     if not params:
         params = {}
 
-    response = requests.get(url=url, params=params).json()
+    response = get_client().get(url=url, params=params).json()
 
     while True:
         yield response
 
         if response["next"]:
-            response = requests.get(response["next"], params=params)
+            response = get_client().get(response["next"], params=params).json()
         else:
             break
 
@@ -383,35 +772,26 @@ def get_atlas_probes(max: int = 0) -> list:
     rejected = 0
     geoloc_disputed = 0
 
-    unfiltered_probes = get_from_atlas("https://atlas.ripe.net/api/v2/probes/")
+    # anchors and disconnected probes are filtered by Atlas API
+    unfiltered_probes = crawl_probes(
+        filters={"is_anchor": "false", "status": STATUS_CONNECTED},
+        fields=PROBE_FIELDS,
+    )
 
     for i, probe in enumerate(unfiltered_probes):
-        if max != 0 and i > 0:
+        if max != 0 and i >= max:
             break
 
         # filter probes based on generic criteria
-        if not probe["is_anchor"]:
-            if (
-                probe["status"]["name"] != "Connected"
-                or probe.get("geometry") is None
-                or probe.get("address_v4") is None
-                or probe.get("country_code") is None
-            ):
-                rejected += 1
-                continue
+        if not is_located(probe):
+            rejected += 1
+            continue
 
-            if is_geoloc_disputed(probe):
-                geoloc_disputed += 1
-                continue
+        if is_geoloc_disputed(probe):
+            geoloc_disputed += 1
+            continue
 
-            reduced_probe = {
-                "id": probe["id"],
-                "address_v4": probe["address_v4"],
-                "asn_v4": probe["asn_v4"],
-                "country_code": probe["country_code"],
-                "geometry": probe["geometry"],
-            }
-            probes.append(reduced_probe)
+        probes.append(reduce_probe(probe))
 
     return probes, rejected, geoloc_disputed
 
@@ -422,37 +802,26 @@ def get_atlas_anchors(max: int = 0) -> list:
     rejected = 0
     geoloc_disputed = 0
 
-    # unfiltered_anchors =
+    # only crawl anchors, not every probe
+    unfiltered_anchors = crawl_probes(
+        filters={"is_anchor": "true"},
+        fields=ANCHOR_FIELDS,
+    )
 
-    for i, anchor in enumerate(get_from_atlas("https://atlas.ripe.net/api/v2/probes/")):
+    for i, anchor in enumerate(unfiltered_anchors):
         # just in case we do not have enough memory disk space available
         if max != 0 and i > max:
             break
 
         # filter anchors based on generic criteria
-        if anchor["is_anchor"]:
-            if (
-                anchor.get("geometry") is None
-                or anchor.get("address_v4") is None
-                or anchor.get("country_code") is None
-            ):
-                rejected += 1
-                continue
+        if not is_located(anchor):
+            rejected += 1
+            continue
 
-            if is_geoloc_disputed(anchor):
-                geoloc_disputed += 1
-                continue
+        if is_geoloc_disputed(anchor):
+            geoloc_disputed += 1
+            continue
 
-            reduced_anchor = {
-                "id": anchor["id"],
-                "status": anchor["status"],
-                "address_v4": anchor["address_v4"],
-                "asn_v4": anchor["asn_v4"],
-                "country_code": anchor["country_code"],
-                "geometry": anchor["geometry"],
-                "first_connected": anchor["first_connected"],
-                "is_anchor": anchor["is_anchor"],
-            }
-            anchors.append(reduced_anchor)
+        anchors.append(reduce_anchor(anchor))
 
     return anchors, rejected, geoloc_disputed
@@ -0,0 +1,268 @@
+"""Streaming RTT summaries per (target, vp) pair: min, count, mean and a mergeable quantile sketch"""
+import math
+
+from typing import Iterable, Iterator
+
+from common.ripe.bulk_fetcher import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_WINDOW,
+    iter_measurement_results,
+    iter_results_time_sliced,
+    run_coroutine,
+)
+
+# quantiles are estimated within 1% of the true rtt
+DEFAULT_RELATIVE_ACCURACY: float = 0.01
+
+# with 1% accuracy, 2048 buckets cover rtts from 1 us to more than 10^11 ms
+DEFAULT_MAX_BUCKETS: int = 2048
+
+# results are summarized per target and per probe by default
+DEFAULT_KEY_FIELDS: tuple = ("dst_addr", "prb_id")
+
+
+def get_result_rtts(result: dict) -> list:
+    """rtts of a ping result, replies without rtt (timeouts, errors) are skipped"""
+    ping_results = result.get("result")
+    if not isinstance(ping_results, list):
+        return []
+
+    return [ping_result["rtt"] for ping_result in ping_results if "rtt" in ping_result]
+
+
+class QuantileSketch(object):
+    """
+    log bucketed histogram (DDSketch): a value is counted in the bucket
+    ceil(log_gamma(value)), so any quantile is known within relative_accuracy,
+    two sketches with the same accuracy merge by adding their buckets,
+    when there are more than max_buckets the lowest ones are collapsed
+    """
+
+    __slots__ = ("relative_accuracy", "max_buckets", "_log_gamma", "buckets", "zero_count", "count")
+
+    def __init__(
+        self,
+        relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+        max_buckets: int = DEFAULT_MAX_BUCKETS,
+    ) -> None:
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self._log_gamma = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value: float, count: int = 1) -> None:
+        self.count += count
+        if value <= 0:
+            self.zero_count += count
+            return
+
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def _collapse(self) -> None:
+        """merge the lowest buckets into the lowest one kept"""
+        indexes = sorted(self.buckets)
+        nb_collapsed = len(indexes) - self.max_buckets + 1
+        count = sum(self.buckets.pop(index) for index in indexes[:nb_collapsed])
+        self.buckets[indexes[nb_collapsed]] += count
+
+    def merge(self, other: "QuantileSketch") -> None:
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("sketches with different accuracies cannot be merged")
+
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def quantile(self, q: float) -> float:
+        """value of quantile q in [0, 1], None if the sketch is empty"""
+        if not self.count:
+            return None
+
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+
+        seen = self.zero_count
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # middle of the bucket (gamma^(i-1), gamma^i], in relative terms
+                return 2 * math.exp(index * self._log_gamma) / (
+                    1 + math.exp(self._log_gamma)
+                )
+
+        return None
+
+
+class RttSummary(object):
+    """exact min, count and mean of the rtts of a pair, approximate quantiles"""
+
+    __slots__ = ("count", "min", "total", "sketch")
+
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY) -> None:
+        self.count = 0
+        self.min = None
+        self.total = 0.0
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def add(self, rtt: float) -> None:
+        self.count += 1
+        self.total += rtt
+        if self.min is None or rtt < self.min:
+            self.min = rtt
+        self.sketch.add(rtt)
+
+    def extend(self, rtts: Iterable[float]) -> None:
+        for rtt in rtts:
+            self.add(rtt)
+
+    def merge(self, other: "RttSummary") -> None:
+        if not other.count:
+            return
+
+        self.count += other.count
+        self.total += other.total
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        self.sketch.merge(other.sketch)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else None
+
+    def quantile(self, q: float) -> float:
+        return self.sketch.quantile(q)
+
+    def as_dict(self) -> dict:
+        return {
+            "min_rtt": self.min,
+            "count": self.count,
+            "mean_rtt": self.mean,
+            "median_rtt": self.quantile(0.5),
+            "p95_rtt": self.quantile(0.95),
+        }
+
+    def __repr__(self) -> str:
+        return f"RttSummary(count={self.count}, min={self.min}, mean={self.mean})"
+
+
+class RttAggregator(object):
+    """
+    summaries of ping results per pair, keyed by the values of key_fields,
+    results are added one by one and never kept,
+    aggregators of different workers are combined with merge
+    """
+
+    def __init__(
+        self,
+        key_fields: tuple = DEFAULT_KEY_FIELDS,
+        relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+    ) -> None:
+        self.key_fields = tuple(key_fields)
+        self.relative_accuracy = relative_accuracy
+        self.summaries = {}
+
+    def _get_summary(self, key) -> RttSummary:
+        summary = self.summaries.get(key)
+        if summary is None:
+            summary = self.summaries[key] = RttSummary(self.relative_accuracy)
+
+        return summary
+
+    def add(self, key, rtts: Iterable[float]) -> None:
+        self._get_summary(key).extend(rtts)
+
+    def add_result(self, result: dict) -> bool:
+        """add the rtts of a ping result, return False if it has none"""
+        rtts = get_result_rtts(result)
+        if not rtts:
+            return False
+
+        self.add(tuple(result[field] for field in self.key_fields), rtts)
+
+        return True
+
+    def add_results(self, results: Iterable[dict]) -> "RttAggregator":
+        for result in results:
+            self.add_result(result)
+        return self
+
+    def merge(self, other: "RttAggregator") -> "RttAggregator":
+        if other.key_fields != self.key_fields:
+            raise ValueError("aggregators with different keys cannot be merged")
+
+        for key, summary in other.summaries.items():
+            self._get_summary(key).merge(summary)
+
+        return self
+
+    def min_rtts(self) -> dict:
+        return {key: summary.min for key, summary in self.summaries.items()}
+
+    def __getitem__(self, key) -> RttSummary:
+        return self.summaries[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self.summaries
+
+    def __iter__(self) -> Iterator:
+        return iter(self.summaries)
+
+    def __len__(self) -> int:
+        return len(self.summaries)
+
+    def items(self) -> Iterator[tuple]:
+        return iter(self.summaries.items())
+
+
+def aggregate_measurement_results(
+    measurement_ids: Iterable[int],
+    key_fields: tuple = DEFAULT_KEY_FIELDS,
+    max_concurrency: int = DEFAULT_CONCURRENCY,
+    probe_ids: Iterable[int] = None,
+    params: dict = None,
+) -> RttAggregator:
+    """
+    summarize the results of measurement_ids, each measurement results are
+    aggregated as soon as they are downloaded and dropped right after
+    """
+    aggregator = RttAggregator(key_fields)
+
+    async def aggregate() -> None:
+        async for _, results in iter_measurement_results(
+            measurement_ids,
+            max_concurrency=max_concurrency,
+            params=params,
+            probe_ids=probe_ids,
+        ):
+            aggregator.add_results(results)
+
+    run_coroutine(aggregate())
+
+    return aggregator
+
+
+def summarize_measurement(
+    measurement_id: int,
+    start: int,
+    stop: int,
+    key_fields: tuple = DEFAULT_KEY_FIELDS,
+    window: int = DEFAULT_WINDOW,
+    probe_ids: Iterable[int] = None,
+) -> RttAggregator:
+    """summarize a long recurring measurement window by window, in fixed memory"""
+    return RttAggregator(key_fields).add_results(
+        iter_results_time_sliced(
+            measurement_id, start, stop, window=window, probe_ids=probe_ids
+        )
+    )
@@ -0,0 +1,290 @@
+"""Quota aware scheduler for RIPE Atlas measurement submissions"""
+import threading
+import time
+
+from collections import defaultdict, deque
+from concurrent.futures import Future
+
+from common.ripe.tracker import get_finished_measurements
+from common.logger_config import logger
+
+# default RIPE Atlas user quotas
+DEFAULT_MAX_IN_FLIGHT: int = 100
+DEFAULT_MAX_PER_TARGET: int = 10
+
+# submission rate limit (token bucket)
+DEFAULT_SUBMISSION_RATE: float = 2.0  # submissions per second
+DEFAULT_BURST: int = 10
+
+DEFAULT_POLL_INTERVAL: float = 10
+
+
+class QuotaExceededError(Exception):
+    """Atlas refused a measurement because one of our quotas is reached"""
+
+
+class TokenBucket(object):
+    """token bucket, refilled with rate tokens per second up to capacity"""
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def wait_time(self) -> float:
+        """seconds before a token is available"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self._refill()
+        self.tokens -= 1
+
+
+class _Job(object):
+    def __init__(self, target: str, max_retry: int, kwargs: dict) -> None:
+        self.target = target
+        self.max_retry = max_retry
+        self.kwargs = kwargs
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.rejections = 0
+
+
+class MeasurementScheduler(object):
+    """
+    queue measurement submissions and release them as soon as
+    our concurrent measurements and per target quotas allow it
+    """
+
+    def __init__(
+        self,
+        submit_fn,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        max_per_target: int = DEFAULT_MAX_PER_TARGET,
+        submission_rate: float = DEFAULT_SUBMISSION_RATE,
+        burst: int = DEFAULT_BURST,
+        poll_interval: float = DEFAULT_POLL_INTERVAL,
+        status_fn=get_finished_measurements,
+    ) -> None:
+        # submit_fn(target, **kwargs) returns a measurement id or raise QuotaExceededError
+        self.submit_fn = submit_fn
+        self.status_fn = status_fn
+        self.max_in_flight = max_in_flight
+        self.max_per_target = max_per_target
+        self.poll_interval = poll_interval
+        self.bucket = TokenBucket(submission_rate, burst)
+
+        self._queue = deque()
+        self._in_flight = {}
+        self._per_target = defaultdict(int)
+        # set when Atlas refuses a submission, until some capacity frees up
+        self._blocked = False
+        self._last_poll = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+        # stats
+        self.submitted = 0
+        self.rejected = 0
+        self.total_wait_time = 0
+        self.max_wait_time = 0
+
+    def submit(self, target: str, max_retry: int = 60, **kwargs) -> Future:
+        """queue a measurement towards target, return a future of its measurement id"""
+        job = _Job(target, max_retry, kwargs)
+
+        with self._cond:
+            self._start()
+            self._queue.append(job)
+            self._cond.notify_all()
+
+        return job.future
+
+    def register(self, measurement_id: int, target: str) -> None:
+        """
+        count a measurement submitted outside the scheduler (batches, chunks)
+        in our quotas, it is released once finished like the others
+        """
+        with self._cond:
+            self._start()
+            if measurement_id in self._in_flight:
+                return
+
+            self._in_flight[measurement_id] = target
+            self._per_target[target] += 1
+            # the scheduler thread polls again now that something is in flight
+            self._cond.notify_all()
+
+    def block(self) -> None:
+        """
+        Atlas refused a submission made outside the scheduler,
+        hold submissions until in flight measurements finish or the next poll
+        """
+        with self._cond:
+            self._start()
+            self._blocked = True
+            self._last_poll = time.monotonic()
+            self._cond.notify_all()
+
+    def wait_for_capacity(self) -> int:
+        """block until submissions are allowed, return the number of free in flight slots"""
+        with self._cond:
+            self._start()
+            while not self._stopped and (
+                self._blocked or len(self._in_flight) >= self.max_in_flight
+            ):
+                self._cond.wait()
+
+            return max(self.max_in_flight - len(self._in_flight), 0)
+
+    def _start(self) -> None:
+        """start the scheduler thread on first use, called with the lock held"""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="measurement-scheduler", daemon=True
+            )
+            self._thread.start()
+
+    def release(self, measurement_id: int) -> None:
+        """a measurement is finished, free its capacity"""
+        with self._cond:
+            target = self._in_flight.pop(measurement_id, None)
+            if target is None:
+                return
+
+            self._per_target[target] -= 1
+            if not self._per_target[target]:
+                del self._per_target[target]
+
+            self._blocked = False
+            self._cond.notify_all()
+
+    def _next_job(self) -> _Job:
+        """first queued job that fits in our quotas, if any"""
+        if self._blocked or len(self._in_flight) >= self.max_in_flight:
+            return None
+
+        for job in self._queue:
+            if self._per_target.get(job.target, 0) < self.max_per_target:
+                self._queue.remove(job)
+                return job
+
+        return None
+
+    def _dispatch(self, job: _Job) -> None:
+        self.bucket.consume()
+        try:
+            measurement_id = self.submit_fn(job.target, **job.kwargs)
+        except QuotaExceededError as e:
+            with self._cond:
+                self.rejected += 1
+                job.rejections += 1
+                if job.rejections >= job.max_retry:
+                    job.future.set_exception(
+                        RuntimeError("Too much measurements. Stopping.")
+                    )
+                    return
+
+                # wait for in flight measurements to finish before trying again
+                logger.warning(f"Too much measurements, submission queued: {e}")
+                self._queue.appendleft(job)
+                self._blocked = True
+            return
+        except Exception as e:
+            job.future.set_exception(e)
+            return
+
+        wait_time = time.monotonic() - job.enqueued_at
+        with self._cond:
+            self._in_flight[measurement_id] = job.target
+            self._per_target[job.target] += 1
+            self.submitted += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+        job.future.set_result(measurement_id)
+
+    def _poll(self) -> None:
+        """release all in flight measurements that are finished"""
+        self._last_poll = time.monotonic()
+
+        with self._cond:
+            measurement_ids = list(self._in_flight)
+            # quota might be used by measurements we do not track, try again
+            self._blocked = False
+            self._cond.notify_all()
+
+        if not measurement_ids:
+            return
+
+        try:
+            finished = self.status_fn(measurement_ids)
+        except Exception as e:
+            logger.error(f"could not retrieve measurements status: {e}")
+            return
+
+        for measurement_id in finished:
+            self.release(measurement_id)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+
+                job = None
+                token_wait_time = self.bucket.wait_time()
+                if not token_wait_time:
+                    job = self._next_job()
+
+                if job is None:
+                    now = time.monotonic()
+                    waiting = self._queue or self._in_flight or self._blocked
+                    next_poll = self._last_poll + self.poll_interval
+                    if not waiting or now < next_poll:
+                        timeouts = []
+                        if waiting:
+                            timeouts.append(next_poll - now)
+                        if self._queue and token_wait_time:
+                            timeouts.append(token_wait_time)
+                        self._cond.wait(timeout=min(timeouts) if timeouts else None)
+                        continue
+
+            if job is not None:
+                self._dispatch(job)
+            else:
+                self._poll()
+
+    def close(self) -> None:
+        """stop the scheduler, queued submissions are cancelled"""
+        with self._cond:
+            self._stopped = True
+            for job in self._queue:
+                job.future.cancel()
+            self._queue.clear()
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queue_depth": len(self._queue),
+                "in_flight": len(self._in_flight),
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "mean_wait_time": self.total_wait_time / self.submitted
+                if self.submitted
+                else 0,
+                "max_wait_time": self.max_wait_time,
+            }
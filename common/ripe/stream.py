@@ -0,0 +1,210 @@
+"""Push based client of RIPE Atlas results stream, with reconnection and resume"""
+import asyncio
+import heapq
+import itertools
+import json
+import random
+
+from collections import defaultdict
+from typing import AsyncIterator, Iterable
+
+import websockets
+from websockets.exceptions import WebSocketException
+
+from common.ripe.bulk_fetcher import run_coroutine
+from common.ripe.http_client import get_client
+from common.ripe.utils import MEASUREMENTS_URL
+from common.logger_config import logger
+
+STREAM_URL: str = "wss://atlas-stream.ripe.net/stream/"
+
+# reconnection backoff (seconds)
+DEFAULT_RECONNECT_DELAY: float = 1
+DEFAULT_MAX_RECONNECT_DELAY: float = 60
+
+# on reconnection, results are replayed from this many seconds before the last one received
+DEFAULT_RESUME_OVERLAP: int = 5 * 60
+
+
+def get_measurement_ids_from_tag(tag: str) -> list:
+    """return the ids of all measurements with tag"""
+    measurement_ids = []
+
+    url = MEASUREMENTS_URL
+    params = {"tags": tag, "fields": "id", "page_size": 500}
+    while url:
+        page = get_client().get(url, params=params).json()
+        measurement_ids.extend(measurement["id"] for measurement in page["results"])
+
+        # next url already contains all parameters
+        url = page["next"]
+        params = None
+
+    return measurement_ids
+
+
+class ResultStream(object):
+    """
+    subscribe to the results of measurements (by id or tag) and yield each result
+    as soon as Atlas pushes it. Lost connections are reopened with a backoff and
+    results produced in between are replayed, each result is yielded only once
+    """
+
+    def __init__(
+        self,
+        measurement_ids: Iterable[int] = None,
+        tags: Iterable[str] = None,
+        url: str = STREAM_URL,
+        start_time: int = None,
+        reconnect_delay: float = DEFAULT_RECONNECT_DELAY,
+        max_reconnect_delay: float = DEFAULT_MAX_RECONNECT_DELAY,
+        resume_overlap: int = DEFAULT_RESUME_OVERLAP,
+        max_reconnect: int = None,
+    ) -> None:
+        self.measurement_ids = list(dict.fromkeys(measurement_ids or []))
+        self.tags = list(tags or [])
+        self.url = url
+        self.start_time = start_time
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.resume_overlap = resume_overlap
+        self.max_reconnect = max_reconnect
+
+        # timestamp of the last result received per measurement
+        self.cursors = {}
+        self._seen = set()
+        # per measurement heap of (timestamp, order, key) of the remembered results
+        self._seen_by_timestamp = defaultdict(list)
+        self._seen_order = itertools.count()
+        self._websocket = None
+        self._closed = False
+
+        self.nb_results = 0
+        self.nb_duplicates = 0
+        self.nb_reconnects = 0
+
+    def _subscriptions(self) -> list:
+        """subscription parameters of each measurement, resuming after the cursors"""
+        subscriptions = []
+        for measurement_id in self.measurement_ids:
+            params = {"streamType": "result", "msm": measurement_id}
+
+            # replay the results produced while we were disconnected
+            if measurement_id in self.cursors:
+                params["startTime"] = self.cursors[measurement_id] - self.resume_overlap
+            elif self.start_time is not None:
+                params["startTime"] = self.start_time
+
+            subscriptions.append(params)
+
+        return subscriptions
+
+    def _is_new(self, result: dict) -> bool:
+        """check that a result was not yielded yet and move its measurement cursor"""
+        measurement_id = result.get("msm_id")
+        timestamp = result.get("timestamp")
+        key = (measurement_id, result.get("prb_id"), timestamp)
+
+        if key in self._seen:
+            self.nb_duplicates += 1
+            return False
+        self._seen.add(key)
+
+        if timestamp is not None and timestamp > self.cursors.get(
+            measurement_id, timestamp - 1
+        ):
+            self.cursors[measurement_id] = timestamp
+
+        # results older than the replay window cannot be received twice
+        if timestamp is not None:
+            bucket = self._seen_by_timestamp[measurement_id]
+            heapq.heappush(bucket, (timestamp, next(self._seen_order), key))
+            window_start = self.cursors[measurement_id] - self.resume_overlap
+            while bucket[0][0] < window_start:
+                self._seen.discard(heapq.heappop(bucket)[2])
+
+        return True
+
+    async def _resolve_tags(self) -> None:
+        """add the measurements of each tag to the subscribed measurements"""
+        loop = asyncio.get_running_loop()
+        for tag in self.tags:
+            measurement_ids = await loop.run_in_executor(
+                None, get_measurement_ids_from_tag, tag
+            )
+            logger.info(f"tag {tag}: {len(measurement_ids)} measurements")
+            self.measurement_ids = list(
+                dict.fromkeys(self.measurement_ids + measurement_ids)
+            )
+        self.tags = []
+
+    async def __aiter__(self) -> AsyncIterator[dict]:
+        await self._resolve_tags()
+        if not self.measurement_ids:
+            logger.warning("no measurement to subscribe to")
+            return
+
+        delay = self.reconnect_delay
+        while not self._closed:
+            try:
+                async with websockets.connect(self.url) as websocket:
+                    self._websocket = websocket
+                    for params in self._subscriptions():
+                        await websocket.send(json.dumps(["atlas_subscribe", params]))
+
+                    async for message in websocket:
+                        try:
+                            event, payload = json.loads(message)
+                        except (ValueError, TypeError) as e:
+                            logger.warning(f"skipping malformed stream frame: {e}")
+                            continue
+
+                        if event == "atlas_result":
+                            # connection is healthy again
+                            delay = self.reconnect_delay
+                            if self._is_new(payload):
+                                self.nb_results += 1
+                                yield payload
+                        elif event == "atlas_error":
+                            logger.error(f"stream error: {payload}")
+                        elif event == "atlas_subscribed":
+                            logger.debug(f"subscribed to {payload}")
+
+            except (OSError, WebSocketException) as e:
+                logger.warning(f"stream connection lost: {e}")
+            finally:
+                self._websocket = None
+
+            if self._closed:
+                break
+
+            if self.max_reconnect is not None and self.nb_reconnects >= self.max_reconnect:
+                logger.error(f"stream closed after {self.nb_reconnects} reconnections")
+                break
+
+            # jittered exponential backoff between reconnections
+            self.nb_reconnects += 1
+            await asyncio.sleep(delay * random.uniform(0.5, 1))
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    async def close(self) -> None:
+        """stop the stream, the iteration ends after the current result"""
+        self._closed = True
+        if self._websocket is not None:
+            await self._websocket.close()
+
+    def run(self, callback) -> None:
+        """blocking, call callback on each result until the stream is closed"""
+
+        async def consume() -> None:
+            async for result in self:
+                callback(result)
+
+        run_coroutine(consume())
+
+    def stats(self) -> dict:
+        return {
+            "results": self.nb_results,
+            "duplicates": self.nb_duplicates,
+            "reconnects": self.nb_reconnects,
+        }
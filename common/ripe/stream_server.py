@@ -0,0 +1,140 @@
+"""Local stand-in for RIPE Atlas results stream, speaks the same protocol, for offline use"""
+import argparse
+import asyncio
+import json
+
+from pathlib import Path
+from typing import Iterable
+
+import websockets
+
+from common.logger_config import logger
+
+# subscription parameters and the result field they filter on
+FILTERS: dict = {
+    "msm": "msm_id",
+    "prb": "prb_id",
+    "type": "type",
+}
+
+
+def _matches(params: dict, result: dict) -> bool:
+    """check if a result matches a subscription"""
+    for param, field in FILTERS.items():
+        if param in params and result.get(field) != params[param]:
+            return False
+
+    if "startTime" in params and result.get("timestamp", 0) < params["startTime"]:
+        return False
+    if "stopTime" in params and result.get("timestamp", 0) > params["stopTime"]:
+        return False
+
+    return True
+
+
+class StandInStreamServer(object):
+    """
+    websocket server answering atlas_subscribe messages like atlas-stream:
+    published results are pushed to matching subscribers, and subscriptions
+    with a startTime first replay the already published results
+    """
+
+    def __init__(
+        self, results: Iterable[dict] = None, host: str = "localhost", port: int = 0
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.history = list(results or [])
+        self._connections = {}
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}:{self.port}/stream/"
+
+    async def start(self) -> None:
+        self._server = await websockets.serve(self._handle, self.host, self.port)
+        # port 0 lets the system pick a free port
+        self.port = list(self._server.sockets)[0].getsockname()[1]
+
+        logger.info(f"stand-in stream server listening on {self.url}")
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _send(self, websocket, event: str, payload) -> None:
+        try:
+            await websocket.send(json.dumps([event, payload]))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def _handle(self, websocket, path: str = None) -> None:
+        subscriptions = self._connections[websocket] = []
+        try:
+            async for message in websocket:
+                try:
+                    event, params = json.loads(message)
+                except ValueError:
+                    await self._send(websocket, "atlas_error", "malformed message")
+                    continue
+
+                if event != "atlas_subscribe":
+                    await self._send(websocket, "atlas_error", f"unknown event {event}")
+                    continue
+
+                subscriptions.append(params)
+                await self._send(websocket, "atlas_subscribed", params)
+
+                # replay history only when asked for, as atlas-stream does
+                if "startTime" in params:
+                    for result in list(self.history):
+                        if _matches(params, result):
+                            await self._send(websocket, "atlas_result", result)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            del self._connections[websocket]
+
+    async def publish(self, result: dict) -> None:
+        """push a new result to every matching subscriber"""
+        self.history.append(result)
+
+        for websocket, subscriptions in list(self._connections.items()):
+            live_subscriptions = [
+                {key: value for key, value in params.items() if key != "startTime"}
+                for params in subscriptions
+            ]
+            if any(_matches(params, result) for params in live_subscriptions):
+                await self._send(websocket, "atlas_result", result)
+
+    async def drop_connections(self) -> None:
+        """close every client connection, as a network failure would"""
+        for websocket in list(self._connections):
+            await websocket.close()
+
+
+async def _serve(results_path: Path, host: str, port: int, interval: float) -> None:
+    """publish each result of an NDJSON file, one every interval seconds"""
+    server = StandInStreamServer(host=host, port=port)
+    await server.start()
+
+    with results_path.open() as results:
+        for line in results:
+            if line.strip():
+                await server.publish(json.loads(line))
+                await asyncio.sleep(interval)
+
+    logger.info(f"{len(server.history)} results published")
+    await asyncio.Future()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("results", type=Path, help="NDJSON file of Atlas results")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--interval", type=float, default=1.0)
+    args = parser.parse_args()
+
+    asyncio.run(_serve(args.results, args.host, args.port, args.interval))
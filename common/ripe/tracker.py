@@ -0,0 +1,168 @@
+"""Track the completion of many RIPE Atlas measurements with one list query per poll"""
+import json
+import time
+
+from typing import Iterable, Iterator
+
+from common.ripe.cache import get_cache
+from common.ripe.http_client import get_client
+from common.ripe.utils import MEASUREMENTS_URL
+from common.logger_config import logger
+
+# measurement status names meaning the measurement is not finished yet
+PENDING_STATUSES: set = {"Specified", "Scheduled", "Ongoing"}
+
+# number of ids per list query, keeps urls short
+MAX_IDS_PER_QUERY: int = 100
+
+# adaptive polling intervals (seconds)
+DEFAULT_MIN_INTERVAL: float = 5
+DEFAULT_MAX_INTERVAL: float = 60
+DEFAULT_BACKOFF: float = 1.5
+
+
+def get_measurement_statuses(
+    measurement_ids: list, chunk_size: int = MAX_IDS_PER_QUERY
+) -> dict:
+    """
+    return status name per measurement id, using the list endpoint,
+    ids are compared as int but returned as given (str ids read from json files)
+    """
+    measurement_ids = list(measurement_ids)
+    statuses = {}
+    for i in range(0, len(measurement_ids), chunk_size):
+        chunk = {
+            int(measurement_id): measurement_id
+            for measurement_id in measurement_ids[i : i + chunk_size]
+        }
+        response = get_client().get(
+            MEASUREMENTS_URL,
+            params={
+                "id__in": ",".join(str(measurement_id) for measurement_id in chunk),
+                "fields": "id,status",
+                "page_size": len(chunk),
+            },
+        ).json()
+
+        for measurement in response["results"]:
+            measurement_id = chunk.get(int(measurement["id"]))
+            if measurement_id is not None:
+                statuses[measurement_id] = measurement["status"]["name"]
+
+    return statuses
+
+
+def get_finished_measurements(measurement_ids: list) -> set:
+    """return the measurement ids that are not pending anymore"""
+    return {
+        measurement_id
+        for measurement_id, status in get_measurement_statuses(measurement_ids).items()
+        if status not in PENDING_STATUSES
+    }
+
+
+def get_measurement_description(measurement_id: int) -> dict:
+    """return measurement description, finished measurements are cached forever"""
+    url = f"{MEASUREMENTS_URL}{measurement_id}/"
+
+    content = get_cache().get(url)
+    if content is not None:
+        return json.loads(content)
+
+    response = get_client().get(url)
+    measurement_description = response.json()
+
+    # a finished measurement description never changes
+    status = measurement_description.get("status", {}).get("name")
+    if response.ok and status is not None and status not in PENDING_STATUSES:
+        get_cache().put(url, None, response.content)
+
+    return measurement_description
+
+
+def is_measurement_finished(measurement_id: int) -> bool:
+    """check if a measurement is not pending anymore"""
+    measurement_description = get_measurement_description(measurement_id)
+    status = measurement_description.get("status", {}).get("name")
+
+    return status is not None and status not in PENDING_STATUSES
+
+
+class MeasurementTracker(object):
+    """
+    watch a set of measurements and yield each id as soon as it is finished,
+    polling faster when measurements finish and slower when nothing happens
+    """
+
+    def __init__(
+        self,
+        measurement_ids: Iterable[int],
+        min_interval: float = DEFAULT_MIN_INTERVAL,
+        max_interval: float = DEFAULT_MAX_INTERVAL,
+        backoff: float = DEFAULT_BACKOFF,
+        max_polls: int = None,
+    ) -> None:
+        self.pending = list(dict.fromkeys(measurement_ids))
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_polls = max_polls
+        self.statuses = {}
+        self.nb_polls = 0
+
+    def add(self, measurement_ids: Iterable[int]) -> None:
+        """watch more measurements"""
+        for measurement_id in measurement_ids:
+            if measurement_id not in self.pending:
+                self.pending.append(measurement_id)
+
+    def poll(self) -> list:
+        """query all pending measurements status once, return the finished ones"""
+        self.nb_polls += 1
+        statuses = get_measurement_statuses(self.pending)
+        self.statuses.update(statuses)
+
+        finished = []
+        for measurement_id in self.pending:
+            status = statuses.get(measurement_id)
+            if status is None:
+                logger.warning(f"measurement {measurement_id} not found, dropped")
+                finished.append(measurement_id)
+            elif status not in PENDING_STATUSES:
+                finished.append(measurement_id)
+
+        self.pending = [
+            measurement_id
+            for measurement_id in self.pending
+            if measurement_id not in finished
+        ]
+
+        return [
+            measurement_id
+            for measurement_id in finished
+            if statuses.get(measurement_id) is not None
+        ]
+
+    def __iter__(self) -> Iterator[int]:
+        interval = self.min_interval
+        while self.pending:
+            finished = self.poll()
+            yield from finished
+
+            if not self.pending:
+                break
+
+            if self.max_polls is not None and self.nb_polls >= self.max_polls:
+                logger.warning(f"{len(self.pending)} measurements still pending")
+                break
+
+            # poll again quickly if measurements are finishing, otherwise slow down
+            if finished:
+                interval = self.min_interval
+            else:
+                interval = min(interval * self.backoff, self.max_interval)
+
+            logger.info(
+                f"{len(self.pending)} measurements pending, next poll in {interval:.0f}s"
+            )
+            time.sleep(interval)
@@ -1,12 +1,29 @@
 """useful functions for working with response from RIPE Atlas"""
+import json
 import time
-import requests
 
 from numpy import mean
 from datetime import datetime
 
+from common.ripe.cache import get_cache
+from common.ripe.http_client import get_client
+from common.ripe.probe_crawler import PROBES_CACHE_TTL
+from common.ripe.records import Hop, Probe, get_probe_id
 from common.logger_config import logger
 
+MEASUREMENTS_URL: str = "https://atlas.ripe.net/api/v2/measurements/"
+
+
+def get_measurement_url(measurement_id: int) -> str:
+    """return Atlas API url for get measurement request"""
+
+    return f"{MEASUREMENTS_URL}{measurement_id}/results/"
+
+
+def get_cached_probes(url: str, params: dict = None) -> dict:
+    """return a probes page, cached locally and revalidated once expired"""
+    return json.loads(get_cache().fetch(url, params=params, ttl=PROBES_CACHE_TTL))
+
 
 def get_coordinates_from_addr(target_addr: str, targets: list) -> tuple:
     """return coordinates based on target IP address"""
@@ -17,13 +34,27 @@ def get_coordinates_from_addr(target_addr: str, targets: list) -> tuple:
 
 
 def get_coordinates_from_id(id: str, all_servers: list) -> tuple:
-    """return coordinates based on target IP address"""
-    # get target geo
+    """return coordinates based on probe id, servers are dicts or Probe records"""
+    # get target geo, anchors are matched on their probe id as Probe records are
     for server in all_servers:
-        if id == server["id"]:
+        if isinstance(server, Probe):
+            if id == server.id:
+                return server.coordinates
+        elif id == get_probe_id(server):
             return server["geometry"]["coordinates"]
 
 
+def get_hop_replies(hop_results) -> tuple:
+    """ttl and (address or None for stars, rtt or None) of each reply of a hop dict or Hop record"""
+    if isinstance(hop_results, Hop):
+        return hop_results.hop, hop_results.replies()
+
+    return hop_results["hop"], [
+        (result["from"], result.get("rtt")) if "from" in result else (None, None)
+        for result in hop_results["result"]
+    ]
+
+
 def get_traceroute_countries(traceroute: list) -> None:
     """from a traceroute result, get countries"""
     parsed_traceroute = []
@@ -33,16 +64,11 @@ def get_traceroute_countries(traceroute: list) -> None:
 
     for hop_results in traceroute:
         # get results metrics
-        ttl = hop_results["hop"]
+        ttl, replies = get_hop_replies(hop_results)
         responses = set()
-        for result in hop_results["result"]:
-            ttl = hop_results["hop"]
-
+        for reply_addr, _ in replies:
             # get all unique response for a given ttl
-            if "from" in result:
-                responses.add(result["from"])
-            else:
-                responses.add("*")
+            responses.add(reply_addr if reply_addr is not None else "*")
 
             # get country
             if len(responses) > 1 and "*" not in responses:
@@ -67,7 +93,7 @@ def get_traceroute_countries(traceroute: list) -> None:
                 continue
 
             params = {"resource": response}
-            maxmind_data = requests.get(geoloc_base_url, params=params).json()
+            maxmind_data = get_client().get(geoloc_base_url, params=params).json()
 
             maxmind_data = maxmind_data["data"]
 
@@ -109,19 +135,19 @@ def get_traceroute_countries(traceroute: list) -> None:
 
 
 def print_traceroute(traceroute_results: list) -> None:
-    """print traceroute result nicely"""
+    """print traceroute result nicely, hops are dicts or Hop records"""
     logger.info(f"TTL | results | rtt")
 
     for hop_results in traceroute_results:
         # get results metrics
-        ttl = hop_results["hop"]
+        ttl, replies = get_hop_replies(hop_results)
         response = ""
         rtts = []
-        for result in hop_results["result"]:
-            if "from" in result:
-                response += " " + result["from"]
-                if "rtt" in result:
-                    rtts.append(result["rtt"])
+        for reply_addr, rtt in replies:
+            if reply_addr is not None:
+                response += " " + reply_addr
+                if rtt is not None:
+                    rtts.append(rtt)
             else:
                 response += " *"
 